@@ -0,0 +1,52 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Measures /checkout throughput and latency through the gateway against a running stack:
+#   docker compose up --build
+#   python -m benchmarks.bench_checkout --orders 5000 --concurrency 64
+# Run it on the commit before and after a change to compare.
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def seed(session: requests.Session, url: str, orders: int):
+    n_items = n_users = max(orders // 10, 1)
+    session.post(f"{url}/stock/batch_init/{n_items}/1000000/1").raise_for_status()
+    session.post(f"{url}/payment/batch_init/{n_users}/1000000").raise_for_status()
+    session.post(f"{url}/orders/batch_init/{orders}/{n_items}/{n_users}/1").raise_for_status()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    seed(requests.Session(), args.url, args.orders)
+
+    def checkout(order_id: int) -> tuple[float, bool]:
+        start = time.perf_counter()
+        response = requests.post(f"{args.url}/orders/checkout/{order_id}")
+        return time.perf_counter() - start, response.status_code == 200
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(checkout, range(args.orders)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    failures = sum(1 for _, ok in results if not ok)
+    print(f"checkouts: {len(results)}  failures: {failures}  concurrency: {args.concurrency}")
+    print(f"throughput: {len(results) / elapsed:.1f} req/s")
+    for p in (0.5, 0.95, 0.99):
+        print(f"p{int(p * 100)}: {percentile(latencies, p) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
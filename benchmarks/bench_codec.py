@@ -0,0 +1,72 @@
+import ast
+import timeit
+
+import msgspec
+
+from events.base_event import BaseEvent
+from events.codec import EventDecoder, encode_event
+from events.payment.reserve_payment_event import ReservePaymentEvent
+from events.payment.reserve_payment_successfull import ReservePaymentSucessfull
+from events.registry import EVENT_TYPES
+from events.stock.reserve_stock_event import ReserveStockEvent, StockItem
+from events.stock.reserve_stock_successful_event import ReserveStockSucessfull
+
+# run from the repository root: python -m benchmarks.bench_codec
+
+ROUNDS = 20_000
+
+decoder = EventDecoder(EVENT_TYPES.values())
+
+
+class Properties:
+    # stand-in for pika.BasicProperties, the codec only reads these two attributes
+    def __init__(self, content_type=None, content_encoding=None):
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+
+
+def legacy_encode(event: BaseEvent) -> bytes:
+    return str(msgspec.to_builtins(event)).encode()
+
+
+def legacy_decode(body: bytes) -> BaseEvent:
+    # what the consumers used to do: literal_eval into a dict, then build the event from it
+    params = ast.literal_eval(body.decode())
+    return msgspec.convert(params, type=EVENT_TYPES[params["name"]])
+
+
+def sample_events() -> dict[str, BaseEvent]:
+    return {
+        "ReservePaymentEvent": ReservePaymentEvent(amount=10, user_id="42", order_id="7"),
+        "ReservePaymentSucessfull": ReservePaymentSucessfull(order_id="7"),
+        "ReserveStockSucessfull": ReserveStockSucessfull(order_id="7"),
+        "ReserveStockEvent[2]": ReserveStockEvent(
+            order_id="7", stock_items=[StockItem(item_id=f"{i}", quantity=1) for i in range(2)]),
+        "ReserveStockEvent[200]": ReserveStockEvent(
+            order_id="7", stock_items=[StockItem(item_id=f"{i}", quantity=1) for i in range(200)]),
+    }
+
+
+def per_call_us(fn, rounds: int) -> float:
+    return min(timeit.repeat(fn, number=rounds, repeat=3)) / rounds * 1e6
+
+
+def main():
+    print(f"{'event':<26}{'format':<8}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for label, event in sample_events().items():
+        rounds = ROUNDS // 20 if "200" in label else ROUNDS
+
+        legacy_body = legacy_encode(event)
+        encode_us = per_call_us(lambda: legacy_encode(event), rounds)
+        decode_us = per_call_us(lambda: legacy_decode(legacy_body), rounds)
+        print(f"{label:<26}{'text':<8}{len(legacy_body):>8}{encode_us:>12.2f}{decode_us:>12.2f}")
+
+        body, properties = encode_event(event)
+        props = Properties(**properties)
+        encode_us = per_call_us(lambda: encode_event(event), rounds)
+        decode_us = per_call_us(lambda: decoder.decode(body, props), rounds)
+        print(f"{label:<26}{'msgpack':<8}{len(body):>8}{encode_us:>12.2f}{decode_us:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
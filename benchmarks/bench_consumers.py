@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import gc
+import sys
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import msgspec
+import pika
+import redis
+
+from common.consumer_runtime import CONSUMER_CONCURRENCY, ConsumerRuntime
+from common.order_handlers import OrderHandlers
+from common.orders import OrderValue, checkout_events, order_fields, saga_follow_ups
+from common.outbox import CHECKOUT_LUA, checkout_call
+from common.partitioning import route
+from common.payment_handlers import PaymentHandlers
+from common.stock_handlers import StockHandlers
+from common.tracing import new_trace
+from events.base_event import BaseEvent
+from events.codec import encode_event
+from events.payment.reserve_payment_event import ReservePaymentEvent
+from events.payment.reserve_payment_successfull import ReservePaymentSucessfull
+from events.stock.reserve_stock_event import ReserveStockEvent, StockItem
+from events.stock.reserve_stock_successful_event import ReserveStockSucessfull
+from events.tracing import published
+
+# Consumer hot paths in process, without RabbitMQ: the handlers of common.stock_handlers,
+# common.payment_handlers and common.order_handlers run on an in-memory broker and a local
+# redis-server standing in for the consumer's Redis. Run from the repository root:
+#   redis-server --port 6390 --save '' &
+#   python -m benchmarks.bench_consumers --redis-port 6390 --events 20000 --batch-size 100
+# The chosen Redis database (--redis-db, default 15) is flushed.
+#
+# Per consumer and phase it prints events/s and two allocation figures from a second, traced
+# pass: the bytes allocated per event on top of what was live before (tracemalloc peak) and the
+# memory blocks still allocated per event afterwards, which should stay at 0.
+#   decode      body -> event through the consumer's dispatcher
+#   db          the batch handler against Redis, publishing into the void
+#   publish     encoding and publishing the handler's replies, not for order-consumer
+#   end_to_end  ConsumerRuntime lanes: delivery, handling in worker threads, publishing and ack on
+#               the in-memory broker
+# --consumer flash_sale runs stock-consumer's end_to_end with every reservation for one item, as a
+# plain item (cold) and as a hot item with --hot-shards sub-counters (hot).
+
+
+class MemoryBroker:
+    # EventPublisher whose messages are encoded and given properties as for RabbitMQ and kept per
+    # routing key
+    def __init__(self):
+        self.queues: dict[str, deque] = defaultdict(deque)
+
+    def publish(self, queue: str, event: BaseEvent, headers: dict | None = None):
+        body, properties = encode_event(event)
+        self.queues[route(queue, event)].append(
+            (body, pika.BasicProperties(delivery_mode=2, headers=published(headers), **properties)))
+
+
+class MemoryExchange:
+    # the default exchange of the runtime's channel, publishing into a MemoryBroker
+    def __init__(self, broker: MemoryBroker):
+        self._broker = broker
+
+    async def publish(self, message, routing_key: str):
+        self._broker.queues[routing_key].append(message)
+
+
+class MemoryChannel:
+    def __init__(self, broker: MemoryBroker):
+        self.default_exchange = MemoryExchange(broker)
+
+
+class MemoryMessage:
+    # the parts of an aio-pika incoming message the runtime uses
+    __slots__ = ("body", "content_type", "content_encoding", "headers")
+
+    def __init__(self, body: bytes, properties: pika.BasicProperties):
+        self.body = body
+        self.content_type = properties.content_type
+        self.content_encoding = properties.content_encoding
+        self.headers = properties.headers
+
+    async def ack(self, multiple=False):
+        pass
+
+
+class DistantRedis(redis.Redis):
+    # a redis-server across the network: every command waits --redis-rtt-ms before it is sent
+    rtt = 0.0
+
+    def execute_command(self, *args, **options):
+        time.sleep(self.rtt)
+        return super().execute_command(*args, **options)
+
+
+class NullPublisher:
+    def publish(self, queue: str, event: BaseEvent, headers: dict | None = None):
+        pass
+
+
+def encoded(events: list[BaseEvent]) -> list[tuple[bytes, pika.BasicProperties]]:
+    broker = MemoryBroker()
+    for event in events:
+        broker.publish("bench", event)
+    return [message for queue in broker.queues.values() for message in queue]
+
+
+def batched(items: list, size: int) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def measure(prepare: Callable[[int], list], run: Callable[[list], None], events: int, alloc_events: int,
+            batch_size: int) -> dict:
+    # prepare(n) builds fresh inputs for n events outside the timing, run handles one batch
+    batches = batched(prepare(events), batch_size)
+    start = time.perf_counter()
+    for batch in batches:
+        run(batch)
+    seconds = time.perf_counter() - start
+
+    batches = batched(prepare(alloc_events), batch_size)
+    allocated = 0
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    for batch in batches:
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        run(batch)
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks
+    return {"events_per_s": round(events / seconds), "alloc_bytes_per_event": round(allocated / alloc_events),
+            "retained_blocks_per_event": round(retained / alloc_events, 2)}
+
+
+def bench_consumer(name: str, handlers, broker: MemoryBroker, requests: Callable[[int], list[BaseEvent]],
+                   replies: Callable[[list[BaseEvent]], list[BaseEvent]] | None, reply_queue: str, handle: Callable,
+                   args: argparse.Namespace) -> dict[str, dict]:
+    # handlers publish to broker, requests(n) seeds Redis for n requests and returns them. replies
+    # is None for handlers that publish nothing, their output goes to the outbox.
+    dispatcher = handlers.dispatcher
+    results = {}
+
+    def decode(batch):
+        # the events are kept until the batch is done, like a lane does
+        return [dispatcher.decode(body, properties) for body, properties in batch]
+
+    results["decode"] = measure(lambda n: encoded(requests(n)), decode, args.events, args.alloc_events,
+                                args.batch_size)
+
+    if replies is None:
+        results["db"] = measure(requests, handle, args.events, args.alloc_events, args.batch_size)
+    else:
+        handlers.publisher = NullPublisher()
+        results["db"] = measure(requests, handle, args.events, args.alloc_events, args.batch_size)
+        handlers.publisher = broker
+
+        def publish(batch):
+            for event in batch:
+                broker.publish(reply_queue, event)
+            broker.queues.clear()
+
+        results["publish"] = measure(lambda n: replies(requests(n)), publish, args.events, args.alloc_events,
+                                     args.batch_size)
+
+    results["end_to_end"] = end_to_end(name, handlers, broker, requests, replies is not None, args)
+    report(name, results)
+    return results
+
+
+def report(name: str, results: dict[str, dict]):
+    for phase, stats in results.items():
+        print(f"{name} {phase}: {stats['events_per_s']} events/s, {stats['alloc_bytes_per_event']} B allocated "
+              f"and {stats['retained_blocks_per_event']} blocks retained per event")
+
+
+def end_to_end(name: str, handlers, broker: MemoryBroker, requests: Callable[[int], list[BaseEvent]], publishes: bool,
+               args: argparse.Namespace, lane_key: Callable[[BaseEvent], str] | None = None,
+               feed: int | None = None) -> dict:
+    # the runtime's lanes and worker threads on a loop of their own, feed messages (a batch by
+    # default) are handed to them at once and waited for until every message is acked
+    runtime = ConsumerRuntime(name, batch_size=args.batch_size)
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(CONSUMER_CONCURRENCY + 1))
+
+    async def start():
+        return runtime.start_lanes(handlers.dispatcher, MemoryChannel(broker), lane_key)
+
+    lanes = loop.run_until_complete(start())
+    if publishes:
+        handlers.publisher = runtime.publisher
+
+    async def deliver(batch):
+        for message in batch:
+            await runtime.on_message(message)
+        await runtime.drain()
+        broker.queues.clear()
+
+    result = measure(lambda n: [MemoryMessage(body, properties) for body, properties in encoded(requests(n))],
+                     lambda batch: loop.run_until_complete(deliver(batch)),
+                     args.events, args.alloc_events, feed or args.batch_size)
+    for lane in lanes:
+        lane.cancel()
+    loop.run_until_complete(asyncio.gather(*lanes, return_exceptions=True))
+    loop.close()
+    if publishes:
+        handlers.publisher = broker
+    return result
+
+
+def bench_flash_sale(db: redis.Redis, args: argparse.Namespace) -> dict[str, dict]:
+    # every reservation is for the same item, first as a plain item and then promoted to
+    # --hot-shards sub-counters, through the lanes with stock-consumer's lane key. The handlers'
+    # Redis is --redis-rtt-ms away.
+    distant = DistantRedis(connection_pool=db.connection_pool)
+    distant.rtt = args.redis_rtt_ms / 1000
+    results = {}
+    for phase, shards in (("cold", 0), ("hot", args.hot_shards)):
+        broker = MemoryBroker()
+        handlers = StockHandlers(distant, broker)
+        db.set("flash", msgspec.msgpack.encode({"stock": 10 ** 12, "price": 1}))
+        if shards:
+            handlers.store.promote("flash", shards)
+            # the store learns the sub-counters from its first reservation
+            handlers.store.reserve([[("flash", 1)]])
+        orders = 0
+
+        def requests(n: int) -> list[BaseEvent]:
+            nonlocal orders
+            orders += n
+            return [ReserveStockEvent(order_id=f"flash:{orders - n + i}",
+                                      stock_items=[StockItem(item_id="flash", quantity=1)]) for i in range(n)]
+
+        results[phase] = end_to_end("stock", handlers, broker, requests, True, args, handlers.lane_key,
+                                    feed=args.batch_size * CONSUMER_CONCURRENCY)
+        handlers.store.demote("flash")
+    report("stock flash_sale", results)
+    return results
+
+
+def stock_requests(db: redis.Redis, items: int) -> Callable[[int], list[BaseEvent]]:
+    # every call reserves for n new orders, each getting its own stock hold
+    db.mset({f"item:{i}": msgspec.msgpack.encode({"stock": 10 ** 12, "price": 1}) for i in range(items)})
+    orders = 0
+
+    def requests(n: int) -> list[BaseEvent]:
+        nonlocal orders
+        orders += n
+        return [ReserveStockEvent(order_id=f"{orders - n + i}",
+                                  stock_items=[StockItem(item_id=f"item:{i % items}", quantity=1),
+                                               StockItem(item_id=f"item:{(i + 1) % items}", quantity=1)])
+                for i in range(n)]
+
+    return requests
+
+
+def payment_requests(db: redis.Redis, users: int) -> Callable[[int], list[BaseEvent]]:
+    db.mset({f"user:{i}": msgspec.msgpack.encode({"credit": 10 ** 12}) for i in range(users)})
+
+    def requests(n: int) -> list[BaseEvent]:
+        return [ReservePaymentEvent(user_id=f"user:{i % users}", amount=2, order_id=f"{i}") for i in range(n)]
+
+    return requests
+
+
+def order_requests(db: redis.Redis, items: int, users: int) -> Callable[[int], list[BaseEvent]]:
+    # every call checks out n / 2 new orders, the requests are their stock and payment replies
+    checkout = db.register_script(CHECKOUT_LUA)
+    orders = 0
+
+    def requests(n: int) -> list[BaseEvent]:
+        nonlocal orders
+        order_ids = [f"order:{orders + i}" for i in range((n + 1) // 2)]
+        orders += len(order_ids)
+        pipe = db.pipeline(transaction=False)
+        for i, order_id in enumerate(order_ids):
+            order = OrderValue(payment_status="pending", stock_status="pending", items=[(f"item:{i % items}", 1)],
+                               user_id=f"user:{i % users}", total_cost=1)
+            pipe.hset(order_id, mapping=order_fields(order))
+            _, stock_event = checkout_events(order_id, order)
+            keys, args = checkout_call(order_id, [], new_trace(), saga_follow_ups(order_id, order, stock_event))
+            checkout(keys=keys, args=args, client=pipe)
+        pipe.execute()
+        replies = []
+        for order_id in order_ids:
+            replies.append(ReserveStockSucessfull(order_id=order_id))
+            replies.append(ReservePaymentSucessfull(order_id=order_id))
+        return replies[:n]
+
+    return requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=15)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--alloc-events", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--hot-shards", type=int, default=CONSUMER_CONCURRENCY)
+    parser.add_argument("--redis-rtt-ms", type=float, default=0.5)
+    parser.add_argument("--consumer", choices=("stock", "payment", "order", "flash_sale", "all"), default="all")
+    args = parser.parse_args()
+
+    db = redis.Redis(host=args.redis_host, port=args.redis_port, db=args.redis_db)
+    db.flushdb()
+    if args.consumer in ("stock", "all"):
+        broker = MemoryBroker()
+        handlers = StockHandlers(db, broker)
+        bench_consumer("stock", handlers, broker, stock_requests(db, args.items),
+                       lambda events: [ReserveStockSucessfull(order_id=event.order_id) for event in events],
+                       "order", handlers.remove_stock_batch, args)
+    if args.consumer in ("payment", "all"):
+        broker = MemoryBroker()
+        handlers = PaymentHandlers(db, broker)
+        bench_consumer("payment", handlers, broker, payment_requests(db, args.users),
+                       lambda events: [ReservePaymentSucessfull(order_id=event.order_id) for event in events],
+                       "order", handlers.reserve_money_batch, args)
+    if args.consumer in ("order", "all"):
+        # the saga scripts append the commits to the outbox instead of publishing
+        handlers = OrderHandlers(db)
+        bench_consumer("order", handlers, MemoryBroker(), order_requests(db, args.items, args.users), None,
+                       "stock", handlers.handle_replies, args)
+    if args.consumer in ("flash_sale", "all"):
+        bench_flash_sale(db, args)
+    db.flushdb()
+
+
+if __name__ == '__main__':
+    main()
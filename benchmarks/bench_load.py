@@ -0,0 +1,323 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable
+
+import aiohttp
+from msgspec import Struct
+
+from benchmarks.bench_checkout import percentile
+
+# Open-loop load against a running stack through the gateway, one scenario or all of them:
+#   docker compose up --build
+#   python -m benchmarks.bench_load --scenario all --orders 2000 --rate 200 --output results.json
+#   python -m benchmarks.bench_load --scenario all --baseline results.json
+# Every scenario reseeds items, users and orders with the batch_init routes. Orders arrive at
+# --rate per second whether or not earlier ones finished, and latencies are measured from when a
+# request was due, so a backed up stack shows up in the tail instead of lowering the load. Once
+# all checkouts are in, it waits for their sagas and checks stock and credit against the
+# approved orders.
+
+SCENARIOS = ("uniform", "flash_sale", "low_credit", "mixed")
+FIND_BATCH_SIZE = 1000
+PERCENTILES = (0.5, 0.95, 0.99)
+
+Flow = Callable[[float], Awaitable[None]]
+
+
+class Setup(Struct):
+    # the orders of a scenario, with one flow per order, and the stock and credit all items and
+    # users were seeded with
+    flows: list[Flow]
+    stock: int
+    credit: int
+    max_approved: int | None = None
+
+
+class Recorder:
+    # latencies and failures per request kind, with the ids of the orders that were checked out
+    def __init__(self, session: aiohttp.ClientSession, url: str):
+        self.session = session
+        self.url = url
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.checked_out: list[str] = []
+
+    async def call(self, kind: str, method: str, path: str, due: float | None = None, **kwargs) -> int | None:
+        loop = asyncio.get_running_loop()
+        start = loop.time() if due is None else due
+        try:
+            async with self.session.request(method, f"{self.url}{path}", **kwargs) as response:
+                await response.read()
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            status = None
+        self.latencies[kind].append(loop.time() - start)
+        if status is None or status >= 400:
+            self.errors[kind] += 1
+        return status
+
+    async def checkout(self, order_id: str, due: float | None = None):
+        if await self.call("checkout", "POST", f"/orders/checkout/{order_id}", due) == 200:
+            self.checked_out.append(order_id)
+
+    def report(self, elapsed: float) -> dict:
+        requests = {}
+        for kind, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            stats = {"count": len(latencies), "errors": self.errors[kind],
+                     "throughput": round(len(latencies) / elapsed, 1)}
+            for p in PERCENTILES:
+                stats[f"p{int(p * 100)}_ms"] = round(percentile(latencies, p) * 1000, 1)
+            stats["max_ms"] = round(latencies[-1] * 1000, 1)
+            requests[kind] = stats
+        return requests
+
+
+async def post(session: aiohttp.ClientSession, url: str) -> bytes:
+    async with session.post(url) as response:
+        response.raise_for_status()
+        return await response.read()
+
+
+async def seed(session: aiohttp.ClientSession, args: argparse.Namespace, stock: int, credit: int,
+               batch_orders: bool = True):
+    await post(session, f"{args.url}/stock/batch_init/{args.items}/{stock}/{args.price}")
+    await post(session, f"{args.url}/payment/batch_init/{args.users}/{credit}")
+    if batch_orders:
+        await post(session, f"{args.url}/orders/batch_init/{args.orders}/{args.items}/{args.users}/{args.price}")
+
+
+async def create_orders(session: aiohttp.ClientSession, args: argparse.Namespace,
+                        items: Callable[[], list[str]]) -> list[str]:
+    # orders of args.orders users in turn, with the items given per order
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def create(i: int) -> str:
+        async with limit:
+            order_id = json.loads(await post(session, f"{args.url}/orders/create/{i % args.users}"))["order_id"]
+            for item_id in items():
+                await post(session, f"{args.url}/orders/addItem/{order_id}/{item_id}/1")
+            return order_id
+
+    return list(await asyncio.gather(*(create(i) for i in range(args.orders))))
+
+
+def checkout_flows(recorder: Recorder, order_ids: list[str]) -> list[Flow]:
+    return [lambda due, order_id=order_id: recorder.checkout(order_id, due) for order_id in order_ids]
+
+
+async def uniform(recorder: Recorder, args: argparse.Namespace) -> Setup:
+    # checkouts of orders over all items and users, with plenty of stock and credit
+    await seed(recorder.session, args, args.stock, args.credit)
+    return Setup(checkout_flows(recorder, [str(i) for i in range(args.orders)]), args.stock, args.credit)
+
+
+async def flash_sale(recorder: Recorder, args: argparse.Namespace) -> Setup:
+    # every order wants the one hot item, which has --hot-stock units
+    await seed(recorder.session, args, args.hot_stock, args.credit, batch_orders=False)
+    order_ids = await create_orders(recorder.session, args, lambda: ["0"])
+    return Setup(checkout_flows(recorder, order_ids), args.hot_stock, args.credit, max_approved=args.hot_stock)
+
+
+async def low_credit(recorder: Recorder, args: argparse.Namespace) -> Setup:
+    # users can pay for one item, every order has two
+    await seed(recorder.session, args, args.stock, args.price)
+    return Setup(checkout_flows(recorder, [str(i) for i in range(args.orders)]), args.stock, args.price,
+                 max_approved=0)
+
+
+async def mixed(recorder: Recorder, args: argparse.Namespace) -> Setup:
+    # empty orders get --add-items random items one addItem at a time, then are checked out
+    await seed(recorder.session, args, args.stock, args.credit, batch_orders=False)
+    order_ids = await create_orders(recorder.session, args, lambda: [])
+
+    async def flow(due: float, order_id: str):
+        for i in range(args.add_items):
+            await recorder.call("addItem", "POST", f"/orders/addItem/{order_id}/{random.randrange(args.items)}/1",
+                                due if i == 0 else None)
+        await recorder.checkout(order_id, None if args.add_items else due)
+
+    return Setup([lambda due, order_id=order_id: flow(due, order_id) for order_id in order_ids],
+                 args.stock, args.credit)
+
+
+SEEDS: dict[str, Callable[[Recorder, argparse.Namespace], Awaitable[Setup]]] = {
+    "uniform": uniform,
+    "flash_sale": flash_sale,
+    "low_credit": low_credit,
+    "mixed": mixed,
+}
+
+
+async def run_open_loop(flows: list[Flow], rate: float) -> float:
+    # starts flow i at i / rate seconds, returns the seconds until the last one finished
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    tasks = []
+    for i, flow in enumerate(flows):
+        due = start + i / rate
+        if due > loop.time():
+            await asyncio.sleep(due - loop.time())
+        tasks.append(asyncio.create_task(flow(due)))
+    await asyncio.gather(*tasks)
+    return loop.time() - start
+
+
+async def find_batch(session: aiohttp.ClientSession, url: str, ids: list[str]) -> list[dict | None]:
+    found = []
+    for i in range(0, len(ids), FIND_BATCH_SIZE):
+        async with session.post(url, json=ids[i:i + FIND_BATCH_SIZE]) as response:
+            response.raise_for_status()
+            found.extend(await response.json(content_type=None))
+    return found
+
+
+async def wait_for_results(recorder: Recorder, args: argparse.Namespace) -> dict[str, int]:
+    limit = asyncio.Semaphore(args.concurrency)
+    outcomes: dict[str, int] = defaultdict(int)
+
+    async def wait(order_id: str):
+        async with limit:
+            async with recorder.session.get(f"{recorder.url}/orders/checkout/{order_id}/result",
+                                            params={"timeout": str(args.result_timeout)}) as response:
+                if response.status != 200:
+                    outcomes["pending"] += 1
+                    return
+                order = await response.json(content_type=None)
+        approved = order["payment_status"] == order["stock_status"] == "approved"
+        outcomes["approved" if approved else "rejected"] += 1
+
+    await asyncio.gather(*(wait(order_id) for order_id in recorder.checked_out))
+    return dict(outcomes)
+
+
+def check(setup: Setup, orders: list[dict | None], items: list[dict | None], users: list[dict | None]) -> dict:
+    # stock and credit taken must match the approved orders exactly, never more
+    sold: dict[str, int] = defaultdict(int)
+    spent: dict[str, int] = defaultdict(int)
+    approved = 0
+    for order in orders:
+        if order is None or not order["payment_status"] == order["stock_status"] == "approved":
+            continue
+        approved += 1
+        spent[order["user_id"]] += order["total_cost"]
+        for item_id, quantity in order["items"]:
+            sold[item_id] += quantity
+    taken = [(item["item_id"], setup.stock - item["stock"]) for item in items if item is not None]
+    charged = [(user["user_id"], setup.credit - user["credit"]) for user in users if user is not None]
+    return {
+        "oversold_items": sum(1 for item_id, n in taken if n > sold[item_id] or n > setup.stock),
+        "stock_mismatches": sum(1 for item_id, n in taken if n != sold[item_id]),
+        "negative_credit_users": sum(1 for user in users if user is not None and user["credit"] < 0),
+        "overcharged_users": sum(1 for user_id, n in charged if n > spent[user_id]),
+        "credit_mismatches": sum(1 for user_id, n in charged if n != spent[user_id]),
+        "unexpected_approvals": max(0, approved - setup.max_approved) if setup.max_approved is not None else 0,
+    }
+
+
+async def verify(recorder: Recorder, setup: Setup, args: argparse.Namespace) -> dict:
+    # compensations finish after the results are published, so the checks are repeated until
+    # they pass or --settle seconds are over
+    session, url = recorder.session, recorder.url
+    item_ids = [str(i) for i in range(args.items)]
+    user_ids = [str(i) for i in range(args.users)]
+    deadline = time.monotonic() + args.settle
+    while True:
+        orders = await find_batch(session, f"{url}/orders/find_batch", recorder.checked_out)
+        items = await find_batch(session, f"{url}/stock/find_batch", item_ids)
+        users = await find_batch(session, f"{url}/payment/find_batch", user_ids)
+        checks = check(setup, orders, items, users)
+        if not any(checks.values()) or time.monotonic() >= deadline:
+            return checks
+        await asyncio.sleep(0.5)
+
+
+async def run_scenario(session: aiohttp.ClientSession, scenario: str, args: argparse.Namespace) -> dict:
+    recorder = Recorder(session, args.url)
+    setup = await SEEDS[scenario](recorder, args)
+    elapsed = await run_open_loop(setup.flows, args.rate)
+    outcomes = await wait_for_results(recorder, args)
+    checks = await verify(recorder, setup, args)
+    return {
+        "scenario": scenario,
+        "orders": len(setup.flows),
+        "elapsed_s": round(elapsed, 3),
+        "orders_per_s": round(len(setup.flows) / elapsed, 1),
+        "requests": recorder.report(elapsed),
+        "outcomes": outcomes,
+        "checks": checks,
+        "passed": not any(checks.values()) and not outcomes.get("pending"),
+    }
+
+
+def print_result(result: dict):
+    print(f"{result['scenario']}: {result['orders']} orders in {result['elapsed_s']} s "
+          f"({result['orders_per_s']} orders/s), outcomes: {result['outcomes']}")
+    for kind, stats in result["requests"].items():
+        print(f"  {kind}: {stats['count']} requests, {stats['errors']} errors, {stats['throughput']} req/s, "
+              f"p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms, p99 {stats['p99_ms']} ms")
+    failed = {name: count for name, count in result["checks"].items() if count}
+    print(f"  checks: {'passed' if result['passed'] else f'FAILED {failed}'}")
+
+
+def compare(results: list[dict], baseline: list[dict]):
+    # throughput and p99 change per scenario and request kind against an earlier --output file
+    before = {result["scenario"]: result for result in baseline}
+    for result in results:
+        if result["scenario"] not in before:
+            continue
+        for kind, stats in result["requests"].items():
+            old = before[result["scenario"]]["requests"].get(kind)
+            if old is None:
+                continue
+            print(f"{result['scenario']} {kind}: throughput {old['throughput']} -> {stats['throughput']} req/s, "
+                  f"p99 {old['p99_ms']} -> {stats['p99_ms']} ms")
+
+
+async def run(args: argparse.Namespace) -> list[dict]:
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        results = []
+        for scenario in SCENARIOS if args.scenario == "all" else (args.scenario,):
+            results.append(await run_scenario(session, scenario, args))
+            print_result(results[-1])
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--scenario", choices=(*SCENARIOS, "all"), default="all")
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=200, help="orders started per second")
+    parser.add_argument("--concurrency", type=int, default=256, help="open connections")
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--price", type=int, default=1)
+    parser.add_argument("--stock", type=int, default=1_000_000)
+    parser.add_argument("--credit", type=int, default=1_000_000)
+    parser.add_argument("--hot-stock", type=int, default=100)
+    parser.add_argument("--add-items", type=int, default=2)
+    parser.add_argument("--result-timeout", type=float, default=30)
+    parser.add_argument("--settle", type=float, default=10)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare with the JSON results of an earlier run")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f)["results"])
+    if not all(result["passed"] for result in results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Protocol
+
+import pika
+from pika.adapters.select_connection import IOLoop
+
+from common.metrics import AMQP_CONFIRM_DURATION
+from events.base_event import BaseEvent
+
+logger = logging.getLogger(__name__)
+
+RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'rabbitmq')
+CHANNEL_POOL_SIZE = int(os.environ.get('PUBLISHER_CHANNELS', 4))
+PUBLISH_TIMEOUT = float(os.environ.get('PUBLISH_TIMEOUT', 5))
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+
+
+class PublishError(Exception):
+    pass
+
+
+class _ConfirmChannel:
+    def __init__(self, channel):
+        self.channel = channel
+        self.delivery_tags = itertools.count(1)
+        # delivery tag -> (future, time handed to the publisher), in publish order
+        self.unconfirmed: OrderedDict[int, tuple[Future, float]] = OrderedDict()
+
+
+class ConfirmingPublisher:
+    # Publishes through a pool of confirm-mode channels on one connection owned by a background
+    # IO loop thread. publish() only hands the message to that thread and returns a future that
+    # resolves when the broker confirms it. Messages queued between two IO loop turns are written
+    # together and the broker acks them together (multiple=True). On connection loss unconfirmed
+    # messages fail, and the connection is re-established with backoff.
+    def __init__(self, queues: tuple[str, ...] = (), host: str = RABBITMQ_HOST,
+                 channel_pool_size: int = CHANNEL_POOL_SIZE, fanout_exchanges: tuple[str, ...] = ()):
+        self._parameters = pika.ConnectionParameters(host=host, port=5672, heartbeat=60,
+                                                     blocked_connection_timeout=300)
+        self._queues = queues
+        self._fanout_exchanges = fanout_exchanges
+        self._channel_pool_size = channel_pool_size
+        self._ioloop = IOLoop()
+        self._connection = None
+        self._channels: list[_ConfirmChannel] = []
+        self._next_channel = 0
+        self._reconnect_delay = RECONNECT_DELAY
+        self._outbox: deque[tuple[str, str, bytes, pika.BasicProperties, Future, float]] = deque()
+        self._lock = threading.Lock()
+        self._wakeup_pending = False
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="amqp-publisher", daemon=True)
+        self._thread.start()
+
+    def publish(self, routing_key: str, body: bytes, properties: pika.BasicProperties,
+                exchange: str = "") -> Future:
+        future = Future()
+        with self._lock:
+            self._outbox.append((exchange, routing_key, body, properties, future, time.perf_counter()))
+            wake = not self._wakeup_pending
+            self._wakeup_pending = True
+        if wake:
+            self._ioloop.add_callback_threadsafe(self._drain)
+        return future
+
+    def close(self):
+        self._closing = True
+        self._ioloop.add_callback_threadsafe(self._shutdown)
+        self._thread.join(timeout=PUBLISH_TIMEOUT)
+
+    def _run(self):
+        self._connect()
+        self._ioloop.start()
+
+    def _connect(self):
+        if self._closing:
+            return
+        self._connection = pika.SelectConnection(
+            self._parameters,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_open_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self._ioloop,
+        )
+
+    def _schedule_reconnect(self):
+        if self._closing:
+            return
+        logger.warning(f"Reconnecting publisher in {self._reconnect_delay}s")
+        self._ioloop.call_later(self._reconnect_delay, self._connect)
+        self._reconnect_delay = min(self._reconnect_delay * 2, MAX_RECONNECT_DELAY)
+
+    def _on_connection_open(self, connection):
+        self._reconnect_delay = RECONNECT_DELAY
+        for _ in range(self._channel_pool_size):
+            connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        logger.warning(f"Publisher connection failed: {error}")
+        self._schedule_reconnect()
+
+    def _on_connection_closed(self, connection, reason):
+        for confirm_channel in self._channels:
+            self._fail_unconfirmed(confirm_channel, reason)
+        self._channels = []
+        if self._closing:
+            self._ioloop.stop()
+        else:
+            self._schedule_reconnect()
+
+    def _on_channel_open(self, channel):
+        for queue in self._queues:
+            channel.queue_declare(queue=queue, durable=True)
+        for exchange in self._fanout_exchanges:
+            channel.exchange_declare(exchange=exchange, exchange_type='fanout', durable=True)
+        confirm_channel = _ConfirmChannel(channel)
+        channel.confirm_delivery(ack_nack_callback=lambda frame: self._on_confirm(confirm_channel, frame))
+        channel.add_on_close_callback(lambda ch, reason: self._on_channel_closed(confirm_channel, reason))
+        self._channels.append(confirm_channel)
+        self._drain()
+
+    def _on_channel_closed(self, confirm_channel: _ConfirmChannel, reason):
+        if confirm_channel in self._channels:
+            self._channels.remove(confirm_channel)
+        self._fail_unconfirmed(confirm_channel, reason)
+        if self._connection is not None and self._connection.is_open and not self._closing:
+            self._connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_confirm(self, confirm_channel: _ConfirmChannel, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        unconfirmed = confirm_channel.unconfirmed
+        if method.multiple:
+            delivery_tags = list(itertools.takewhile(lambda tag: tag <= method.delivery_tag, unconfirmed))
+        else:
+            delivery_tags = [method.delivery_tag] if method.delivery_tag in unconfirmed else []
+        now = time.perf_counter()
+        for delivery_tag in delivery_tags:
+            future, published_at = unconfirmed.pop(delivery_tag)
+            AMQP_CONFIRM_DURATION.observe(now - published_at)
+            if acked:
+                future.set_result(None)
+            else:
+                future.set_exception(PublishError("Message was nacked by the broker"))
+
+    def _fail_unconfirmed(self, confirm_channel: _ConfirmChannel, reason):
+        while confirm_channel.unconfirmed:
+            _, (future, _) = confirm_channel.unconfirmed.popitem(last=False)
+            future.set_exception(PublishError(f"Channel closed before confirm: {reason}"))
+
+    def _drain(self):
+        with self._lock:
+            self._wakeup_pending = False
+            if not self._channels:
+                # published as soon as a channel opens
+                return
+            batch, self._outbox = self._outbox, deque()
+        for exchange, routing_key, body, properties, future, published_at in batch:
+            confirm_channel = self._channels[self._next_channel % len(self._channels)]
+            self._next_channel += 1
+            try:
+                confirm_channel.channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                                                      body=body, properties=properties)
+            except Exception as e:
+                future.set_exception(PublishError(str(e)))
+                continue
+            confirm_channel.unconfirmed[next(confirm_channel.delivery_tags)] = (future, published_at)
+
+    def _shutdown(self):
+        with self._lock:
+            batch, self._outbox = self._outbox, deque()
+        for *_, future, _ in batch:
+            future.set_exception(PublishError("Publisher closed"))
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+        else:
+            self._ioloop.stop()
+
+
+class EventPublisher(Protocol):
+    # what the consumer handlers publish through: an event to the partition of queue for its key
+    def publish(self, queue: str, event: BaseEvent, headers: dict | None = None):
+        ...
+
+
+_publisher: ConfirmingPublisher | None = None
+_publisher_pid: int | None = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher(queues: tuple[str, ...] = (), fanout_exchanges: tuple[str, ...] = ()) -> ConfirmingPublisher:
+    # One publisher per process, created on first use so that every gunicorn worker gets its own
+    # connection after the fork instead of sharing a socket inherited from the master.
+    global _publisher, _publisher_pid
+    with _publisher_lock:
+        if _publisher is None or _publisher_pid != os.getpid():
+            _publisher = ConfirmingPublisher(queues, fanout_exchanges=fanout_exchanges)
+            _publisher_pid = os.getpid()
+        return _publisher
+
+
+def subscribe_fanout(exchange: str, on_message, on_connect=None, host: str = RABBITMQ_HOST) -> threading.Thread:
+    # Consumes a fanout exchange through an exclusive, auto-deleted queue on a daemon thread and
+    # reconnects with backoff. on_connect runs after every (re)connect, because messages published
+    # while the subscriber was disconnected never reach it.
+    def run():
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=5672, heartbeat=60))
+                channel = connection.channel()
+                channel.exchange_declare(exchange=exchange, exchange_type='fanout', durable=True)
+                queue = channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+                channel.queue_bind(queue=queue, exchange=exchange)
+                if on_connect is not None:
+                    on_connect()
+                delay = RECONNECT_DELAY
+                channel.basic_consume(queue=queue, on_message_callback=on_message, auto_ack=True)
+                channel.start_consuming()
+            except pika.exceptions.AMQPError as e:
+                logger.warning(f"Subscription to {exchange} lost, reconnecting in {delay}s: {e!r}")
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    thread = threading.Thread(target=run, name=f"amqp-subscriber-{exchange}", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import threading
+import uuid
+from typing import Any, Awaitable, Callable, Iterable
+
+import redis
+import redis.asyncio
+
+logger = logging.getLogger(__name__)
+
+# keys per MSET, and MSETs sent per pipeline round trip
+BATCH_INIT_CHUNK_SIZE = int(os.environ.get('BATCH_INIT_CHUNK_SIZE', 10_000))
+BATCH_INIT_PIPELINE_DEPTH = 4
+JOB_KEY_PREFIX = "batch_init:job:"
+JOB_TTL = 24 * 60 * 60
+
+# generate_chunk(start, stop) returns the encoded values for keys start..stop-1
+ChunkGenerator = Callable[[int, int], dict[str, Any]]
+# write_chunk(pipe, chunk) queues the commands that store one chunk
+ChunkWriter = Callable[[Any, dict[str, Any]], None]
+
+
+def mset_chunk(pipe, chunk: dict[str, bytes]):
+    pipe.mset(chunk)
+
+
+def hset_chunk(pipe, chunk: dict[str, dict[str, Any]]):
+    # values are hash fields, existing keys are dropped first since they may hold another type
+    pipe.unlink(*chunk)
+    for key, fields in chunk.items():
+        pipe.hset(key, mapping=fields)
+
+
+def clear_keys(db: redis.Redis, patterns: Iterable[str]):
+    # batch_init writes the ids 0..n-1 again, so what was kept about the old entries under them
+    # is deleted first. Keys are found with SCAN and unlinked a chunk at a time.
+    for pattern in patterns:
+        keys = []
+        for key in db.scan_iter(match=pattern, count=BATCH_INIT_CHUNK_SIZE):
+            keys.append(key)
+            if len(keys) == BATCH_INIT_CHUNK_SIZE:
+                db.unlink(*keys)
+                keys = []
+        if keys:
+            db.unlink(*keys)
+
+
+async def clear_keys_async(db: redis.asyncio.Redis, patterns: Iterable[str]):
+    for pattern in patterns:
+        keys = []
+        async for key in db.scan_iter(match=pattern, count=BATCH_INIT_CHUNK_SIZE):
+            keys.append(key)
+            if len(keys) == BATCH_INIT_CHUNK_SIZE:
+                await db.unlink(*keys)
+                keys = []
+        if keys:
+            await db.unlink(*keys)
+
+
+def constant_chunks(value: bytes) -> ChunkGenerator:
+    # every key gets the same value, so it is encoded once instead of once per key
+    return lambda start, stop: dict.fromkeys(map(str, range(start, stop)), value)
+
+
+def write_chunks(db: redis.Redis, n: int, generate_chunk: ChunkGenerator,
+                 on_progress: Callable[[int], None] | None = None, write_chunk: ChunkWriter = mset_chunk):
+    # Memory stays bounded by one pipeline of chunks and Redis never sees one huge command.
+    for pipeline_start in range(0, n, BATCH_INIT_CHUNK_SIZE * BATCH_INIT_PIPELINE_DEPTH):
+        pipeline_stop = min(n, pipeline_start + BATCH_INIT_CHUNK_SIZE * BATCH_INIT_PIPELINE_DEPTH)
+        pipe = db.pipeline(transaction=False)
+        for start in range(pipeline_start, pipeline_stop, BATCH_INIT_CHUNK_SIZE):
+            write_chunk(pipe, generate_chunk(start, min(pipeline_stop, start + BATCH_INIT_CHUNK_SIZE)))
+        pipe.execute()
+        if on_progress is not None:
+            on_progress(pipeline_stop)
+
+
+async def write_chunks_async(db: redis.asyncio.Redis, n: int, generate_chunk: ChunkGenerator,
+                             on_progress: Callable[[int], Awaitable[None]] | None = None,
+                             write_chunk: ChunkWriter = mset_chunk):
+    for pipeline_start in range(0, n, BATCH_INIT_CHUNK_SIZE * BATCH_INIT_PIPELINE_DEPTH):
+        pipeline_stop = min(n, pipeline_start + BATCH_INIT_CHUNK_SIZE * BATCH_INIT_PIPELINE_DEPTH)
+        pipe = db.pipeline(transaction=False)
+        for start in range(pipeline_start, pipeline_stop, BATCH_INIT_CHUNK_SIZE):
+            write_chunk(pipe, generate_chunk(start, min(pipeline_stop, start + BATCH_INIT_CHUNK_SIZE)))
+        await pipe.execute()
+        if on_progress is not None:
+            await on_progress(pipeline_stop)
+
+
+def job_key(job_id: str) -> str:
+    return f"{JOB_KEY_PREFIX}{job_id}"
+
+
+def queue_job(pipe, job_id: str, n: int):
+    pipe.hset(job_key(job_id), mapping={"status": "running", "total": n, "written": 0})
+    pipe.expire(job_key(job_id), JOB_TTL)
+
+
+def start_job(db: redis.Redis, n: int, generate_chunk: ChunkGenerator,
+              write_chunk: ChunkWriter = mset_chunk, clear_patterns: Iterable[str] = ()) -> str:
+    # Runs the init on a thread of this worker and records its progress in a Redis hash, so any
+    # worker can answer status requests. A job whose worker dies stays "running" until it expires.
+    # The keys matching clear_patterns are cleared by the job too, before it writes.
+    job_id = str(uuid.uuid4())
+    key = job_key(job_id)
+    pipe = db.pipeline()
+    queue_job(pipe, job_id, n)
+    pipe.execute()
+
+    def run():
+        try:
+            clear_keys(db, clear_patterns)
+            write_chunks(db, n, generate_chunk, on_progress=lambda written: db.hset(key, "written", written),
+                         write_chunk=write_chunk)
+            db.hset(key, "status", "done")
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Batch init job {job_id} failed: {e}")
+            db.hset(key, mapping={"status": "failed", "error": str(e)})
+
+    threading.Thread(target=run, name=f"batch-init-{job_id}", daemon=True).start()
+    return job_id
+
+
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def start_job_async(db: redis.asyncio.Redis, n: int, generate_chunk: ChunkGenerator,
+                          write_chunk: ChunkWriter = mset_chunk, clear_patterns: Iterable[str] = ()) -> str:
+    # asyncio counterpart of start_job, the init runs as a task on the worker's event loop
+    job_id = str(uuid.uuid4())
+    key = job_key(job_id)
+    pipe = db.pipeline()
+    queue_job(pipe, job_id, n)
+    await pipe.execute()
+
+    async def on_progress(written: int):
+        await db.hset(key, "written", written)
+
+    async def run():
+        try:
+            await clear_keys_async(db, clear_patterns)
+            await write_chunks_async(db, n, generate_chunk, on_progress=on_progress, write_chunk=write_chunk)
+            await db.hset(key, "status", "done")
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Batch init job {job_id} failed: {e}")
+            await db.hset(key, mapping={"status": "failed", "error": str(e)})
+
+    # the event loop only keeps weak references to tasks
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return job_id
+
+
+def job_status(entry: dict[bytes, bytes]) -> dict:
+    status = {field.decode(): value.decode() for field, value in entry.items()}
+    for field in ("total", "written"):
+        status[field] = int(status[field])
+    return status
+
+
+def get_job_status(db: redis.Redis, job_id: str) -> dict | None:
+    entry = db.hgetall(job_key(job_id))
+    return job_status(entry) if entry else None
@@ -0,0 +1,47 @@
+from typing import Any, Callable, Iterator
+
+import msgspec
+import redis
+
+# keys per MGET, keeps single commands and response chunks small for very long id lists
+BULK_CHUNK_SIZE = 1000
+
+_ids_decoder = msgspec.json.Decoder(list[str])
+_json_encoder = msgspec.json.Encoder()
+
+
+class InvalidIdList(Exception):
+    pass
+
+
+def decode_id_list(body: bytes) -> list[str]:
+    # request bodies of the batch lookup endpoints are JSON arrays of ids
+    try:
+        return _ids_decoder.decode(body)
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        raise InvalidIdList(f"Expected a JSON array of ids: {e}") from e
+
+
+def render_chunk(keys: list[str], entries: list[Any | None], render: Callable[[str, Any], Any]) -> bytes:
+    # comma separated JSON elements, render(key, entry) for found keys and null for missing ones
+    return b",".join(_json_encoder.encode(render(key, entry) if entry else None)
+                     for key, entry in zip(keys, entries))
+
+
+def stream_json_array(db: redis.Redis, keys: list[str], render: Callable[[str, Any], Any],
+                      fetch: Callable[[list[str]], list] | None = None) -> Iterator[bytes]:
+    # Looks the keys up with one MGET (or fetch call) per chunk and yields a JSON array with one
+    # element per key. The first chunk is read before returning so that Redis errors surface
+    # before the response has started.
+    fetch = fetch or db.mget
+    first = keys[:BULK_CHUNK_SIZE]
+    first_entries = fetch(first) if first else []
+
+    def generate() -> Iterator[bytes]:
+        yield b"[" + render_chunk(first, first_entries, render)
+        for start in range(BULK_CHUNK_SIZE, len(keys), BULK_CHUNK_SIZE):
+            chunk = keys[start:start + BULK_CHUNK_SIZE]
+            yield b"," + render_chunk(chunk, fetch(chunk), render)
+        yield b"]"
+
+    return generate()
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+import time
+
+import msgspec
+import redis
+import redis.asyncio
+from msgspec import Struct
+
+from common.orders import CHECKOUT_FIELD, ORDER_FIELDS, OrderValue, order_from_fields
+
+logger = logging.getLogger(__name__)
+
+# order-consumer publishes the result of every finished or timed out saga on one Redis channel.
+# Clients wait for it on /checkout/<order_id>/result instead of polling /find. In asyncio mode one
+# subscription per worker fans the results out to all waiting requests.
+CHECKOUT_RESULTS_CHANNEL = "checkout:results"
+CHECKOUT_WAIT_TIMEOUT = float(os.environ.get('CHECKOUT_WAIT_TIMEOUT', 30))
+# below the gateway's 60 second proxy read timeout
+MAX_CHECKOUT_WAIT_TIMEOUT = 55
+SSE_KEEPALIVE_INTERVAL = 15
+RESUBSCRIBE_DELAY = 1
+
+
+class CheckoutResult(Struct):
+    order_id: str
+    payment_status: str
+    stock_status: str
+
+
+result_encoder = msgspec.json.Encoder()
+result_decoder = msgspec.json.Decoder(CheckoutResult)
+
+
+class NotCheckedOut(Exception):
+    pass
+
+
+def queue_publish_result(pipe, order_id: str, payment_status: str, stock_status: str):
+    pipe.publish(CHECKOUT_RESULTS_CHANNEL, result_encoder.encode(CheckoutResult(order_id, payment_status, stock_status)))
+
+
+def wait_timeout(value: str | None) -> float:
+    # the ?timeout= of a wait request, raises ValueError when it is not a number
+    if value is None:
+        return CHECKOUT_WAIT_TIMEOUT
+    return min(max(float(value), 0.0), MAX_CHECKOUT_WAIT_TIMEOUT)
+
+
+def checkout_fields() -> list[str]:
+    return [*ORDER_FIELDS, CHECKOUT_FIELD]
+
+
+def checked_out_order(order_id: str, fields: list[bytes | None]) -> OrderValue | None:
+    # fields as returned by HMGET <order_id> *checkout_fields()
+    order = order_from_fields(fields[:len(ORDER_FIELDS)])
+    if order is not None and fields[-1] is None:
+        raise NotCheckedOut(f"Order: {order_id} is not checked out!")
+    return order
+
+
+def finished(order: OrderValue) -> bool:
+    return order.payment_status != 'pending' and order.stock_status != 'pending'
+
+
+def with_result(order: OrderValue, result: CheckoutResult) -> OrderValue:
+    return msgspec.structs.replace(order, payment_status=result.payment_status, stock_status=result.stock_status)
+
+
+def wait_for_result(db: redis.Redis, order_id: str, timeout: float) -> OrderValue | None:
+    # Blocking wait for the Flask app, holds the worker and one Redis connection while it waits.
+    # Subscribes before reading the order, so a result published in between is not missed.
+    # Returns the order, pending if the timeout passed first, or None if it does not exist.
+    pubsub = db.pubsub()
+    try:
+        pubsub.subscribe(CHECKOUT_RESULTS_CHANNEL)
+        # the subscribe confirmation
+        pubsub.get_message(timeout=timeout)
+        order = checked_out_order(order_id, db.hmget(order_id, checkout_fields()))
+        if order is None or finished(order):
+            return order
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            message = pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message is None:
+                continue
+            result = result_decoder.decode(message['data'])
+            if result.order_id == order_id:
+                return with_result(order, result)
+        return order
+    finally:
+        pubsub.close()
+
+
+class CheckoutWaiters:
+    # Futures of the requests waiting per order, resolved by one subscription per process
+    def __init__(self):
+        self._waiters: dict[str, set[asyncio.Future]] = {}
+        self.subscribed = False
+
+    def __len__(self) -> int:
+        return sum(map(len, self._waiters.values()))
+
+    def resolve(self, result: CheckoutResult):
+        for future in self._waiters.pop(result.order_id, ()):
+            if not future.done():
+                future.set_result(result)
+
+    async def listen(self, db: redis.asyncio.Redis):
+        # runs as a task for the lifetime of the app, resubscribing after connection errors
+        while True:
+            try:
+                async with db.pubsub() as pubsub:
+                    await pubsub.subscribe(CHECKOUT_RESULTS_CHANNEL)
+                    self.subscribed = True
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self.resolve(result_decoder.decode(message['data']))
+            except redis.RedisError as e:
+                logger.warning(f"Checkout results subscription lost: {e}")
+            self.subscribed = False
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
+
+    async def wait(self, db: redis.asyncio.Redis, order_id: str, timeout: float,
+                   on_keepalive=None) -> OrderValue | None:
+        # Same contract as wait_for_result. The future is registered before the order is read, so
+        # a result published in between is not missed. on_keepalive is awaited every
+        # SSE_KEEPALIVE_INTERVAL seconds of waiting.
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(order_id, set()).add(future)
+        try:
+            order = checked_out_order(order_id, await db.hmget(order_id, checkout_fields()))
+            if order is None or finished(order):
+                return order
+            deadline = time.monotonic() + timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                interval = remaining if on_keepalive is None else min(remaining, SSE_KEEPALIVE_INTERVAL)
+                try:
+                    return with_result(order, await asyncio.wait_for(asyncio.shield(future), interval))
+                except asyncio.TimeoutError:
+                    if on_keepalive is not None:
+                        await on_keepalive()
+            return order
+        finally:
+            waiters = self._waiters.get(order_id)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    del self._waiters[order_id]
@@ -0,0 +1,286 @@
+import asyncio
+import contextvars
+import logging
+import os
+import signal
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Hashable
+
+import aio_pika
+
+from common.amqp import MAX_RECONNECT_DELAY, PUBLISH_TIMEOUT, RABBITMQ_HOST, RECONNECT_DELAY
+from common.metrics import QUEUE_MESSAGES, QUEUE_SAMPLE_INTERVAL, start_flusher, watch_dispatcher
+from common.partitioning import PARTITION, partition_queue, partition_queues, route
+from events.base_event import BaseEvent
+from events.codec import EventDecodeError, encode_event
+from events.registry import EventDispatcher
+from events.retry import RetryPolicy, retry_queues
+from events.tracing import published
+
+logger = logging.getLogger(__name__)
+
+# The consumers' shared runtime, on asyncio and aio-pika. Messages of the partition queue are
+# decoded as they arrive and put in one of CONSUMER_CONCURRENCY lanes by their partition key (or a
+# lane key the consumer gives), so events of the same key are handled one after the other in
+# arrival order while the lanes run side by side. A lane hands whatever it has queued, up to BATCH_SIZE events, to the
+# dispatcher's batch handlers in a worker thread, waits for the confirms of everything they
+# published and then acks. Handlers stay plain functions on the synchronous Redis stores shared
+# with the services, the threads let their round trips overlap.
+# On SIGTERM the runtime stops consuming, handles what it already received for up to
+# DRAIN_TIMEOUT seconds and closes. A lost connection is opened again with backoff, what was not
+# acked yet is redelivered by the broker.
+CONSUMER_CONCURRENCY = int(os.environ.get('CONSUMER_CONCURRENCY', 8))
+# BATCH_SIZE=1 hands the handlers one event at a time
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 1))
+CONSUMER_HEARTBEAT = int(os.environ.get('CONSUMER_HEARTBEAT', 30))
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', 5))
+# unset, every lane can have two batches waiting
+PREFETCH_COUNT = int(os.environ.get('PREFETCH_COUNT', 0))
+
+# the publishes of the lane batch running in this thread, None outside of one
+_pending_publishes: contextvars.ContextVar[list[Future] | None] = contextvars.ContextVar(
+    "pending_publishes", default=None)
+
+
+def partition_key(event: BaseEvent) -> str:
+    return event.partition_key()
+
+
+class LoopPublisher:
+    # common.amqp.EventPublisher for handlers running in the runtime's worker threads. Publishes of
+    # a lane batch are confirmed together before its messages are acked, publishes from anywhere
+    # else wait for their own confirm.
+    def __init__(self, runtime: "ConsumerRuntime"):
+        self._runtime = runtime
+
+    def publish(self, queue: str, event: BaseEvent, headers: dict | None = None):
+        body, properties = encode_event(event)
+        message = aio_pika.Message(body, delivery_mode=aio_pika.DeliveryMode.PERSISTENT, headers=published(headers),
+                                   **properties)
+        future = asyncio.run_coroutine_threadsafe(self._runtime.publish(message, route(queue, event)),
+                                                  self._runtime.loop)
+        pending = _pending_publishes.get()
+        if pending is None:
+            future.result(timeout=PUBLISH_TIMEOUT)
+        else:
+            pending.append(future)
+
+
+class ConsumerRuntime:
+    # Consumes partition_queue(queue, PARTITION) into a dispatcher. declares are the queues the
+    # handlers publish to, every partition of them is declared.
+    def __init__(self, queue: str, declares: tuple[str, ...] = (), concurrency: int = CONSUMER_CONCURRENCY,
+                 batch_size: int = BATCH_SIZE, host: str = RABBITMQ_HOST):
+        self.queue = partition_queue(queue, PARTITION)
+        self._declares = tuple(dict.fromkeys((queue, *declares)))
+        self._concurrency = concurrency
+        self._batch_size = batch_size
+        self._host = host
+        self.publisher = LoopPublisher(self)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._channel: aio_pika.abc.AbstractChannel | None = None
+        self._dispatcher: EventDispatcher | None = None
+        self._lanes: list[asyncio.Queue] = []
+        self._lane_key: Callable[[BaseEvent], Hashable] = partition_key
+        self._periodic: list[tuple[float, Callable[[], object]]] = []
+        self._stopping: asyncio.Event | None = None
+
+    def every(self, interval: float, fn: Callable[[], object]):
+        # runs fn in a worker thread every interval seconds while connected
+        self._periodic.append((interval, fn))
+
+    def run(self, dispatcher: EventDispatcher, lane_key: Callable[[BaseEvent], Hashable] | None = None):
+        # lane_key picks the lane of an event, its partition key when not given
+        watch_dispatcher(dispatcher)
+        start_flusher()
+        asyncio.run(self._run(dispatcher, lane_key))
+
+    async def publish(self, message: aio_pika.Message, routing_key: str):
+        if self._channel is None:
+            raise ConnectionError("not connected to RabbitMQ")
+        await self._channel.default_exchange.publish(message, routing_key=routing_key)
+
+    async def _run(self, dispatcher: EventDispatcher, lane_key: Callable[[BaseEvent], Hashable] | None):
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(self._concurrency + 1))
+        self._stopping = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self._stopping.set)
+        delay = RECONNECT_DELAY
+        while not self._stopping.is_set():
+            try:
+                connection = await aio_pika.connect(host=self._host, heartbeat=CONSUMER_HEARTBEAT)
+            except Exception as e:
+                logger.warning(f"Cannot connect to RabbitMQ, retrying in {delay}s: {e}")
+                await self._sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            delay = RECONNECT_DELAY
+            try:
+                await self._serve(connection, dispatcher, lane_key)
+            except Exception as e:
+                logger.error(f"Consuming {self.queue} failed: {e}")
+            finally:
+                self._channel = None
+                if not connection.is_closed:
+                    await connection.close()
+        logger.info(f"Stopped consuming {self.queue}")
+
+    async def _sleep(self, seconds: float):
+        # returns early on shutdown
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def start_lanes(self, dispatcher: EventDispatcher, channel: aio_pika.abc.AbstractChannel,
+                    lane_key: Callable[[BaseEvent], Hashable] | None = None) -> list[asyncio.Task]:
+        # Starts the lanes on the running loop, handing events to dispatcher and publishing
+        # through channel. Messages are fed to on_message. Tests and benchmarks use it with an
+        # in-memory channel.
+        self.loop = asyncio.get_running_loop()
+        self._lane_key = lane_key or partition_key
+        if dispatcher.retry is None:
+            dispatcher.retry = RetryPolicy(self.queue)
+        self._dispatcher = dispatcher
+        self._channel = channel
+        self._lanes = [asyncio.Queue() for _ in range(self._concurrency)]
+        return [asyncio.create_task(self._lane(lane)) for lane in self._lanes]
+
+    async def drain(self):
+        # waits until every message fed so far is settled
+        await asyncio.gather(*(lane.join() for lane in self._lanes))
+
+    async def _serve(self, connection: aio_pika.abc.AbstractConnection, dispatcher: EventDispatcher,
+                     lane_key: Callable[[BaseEvent], Hashable] | None):
+        channel = await connection.channel()
+        for queue in self._declares:
+            for name in partition_queues(queue):
+                await channel.declare_queue(name, durable=True)
+        for name, arguments in retry_queues(self.queue):
+            await channel.declare_queue(name, durable=True, arguments=arguments)
+        await channel.set_qos(prefetch_count=PREFETCH_COUNT or 2 * self._concurrency * self._batch_size)
+        queue = await channel.declare_queue(self.queue, durable=True)
+
+        tasks = self.start_lanes(dispatcher, channel, lane_key)
+        tasks += [asyncio.create_task(self._every(interval, fn)) for interval, fn in self._periodic]
+        tasks.append(asyncio.create_task(self._sample_queue_depth(channel)))
+        # exclusive: a second consumer on the same partition is refused instead of racing this one
+        consumer_tag = await queue.consume(self.on_message, exclusive=True)
+        logger.info(f"Consuming {self.queue} with {self._concurrency} lanes")
+        stopping = asyncio.create_task(self._stopping.wait())
+        closed = asyncio.ensure_future(connection.closed())
+        try:
+            await asyncio.wait([stopping, closed], return_when=asyncio.FIRST_COMPLETED)
+            if stopping.done() and not connection.is_closed:
+                await queue.cancel(consumer_tag)
+                try:
+                    await asyncio.wait_for(self.drain(), DRAIN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Drain of {self.queue} timed out, unacked messages will be redelivered")
+            else:
+                logger.warning("Connection to RabbitMQ lost, reconnecting")
+        finally:
+            stopping.cancel()
+            closed.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def on_message(self, message: aio_pika.abc.AbstractIncomingMessage):
+        # aio-pika consume callback, called in delivery order. Nothing is awaited before the event
+        # is in its lane.
+        try:
+            event = self._dispatcher.decode(message.body, message)
+        except EventDecodeError as e:
+            await self._fail(message, e)
+            return
+        self._dispatcher.received(event, message)
+        self._lanes[hash(self._lane_key(event)) % len(self._lanes)].put_nowait((event, message))
+
+    async def _lane(self, lane: asyncio.Queue):
+        while True:
+            batch = [await lane.get()]
+            while len(batch) < self._batch_size and not lane.empty():
+                batch.append(lane.get_nowait())
+            try:
+                await self._handle(batch)
+            except Exception as e:
+                # only publishing or settling can fail here, the broker redelivers what was not acked
+                logger.error(f"Settling a batch of {len(batch)} failed: {e}")
+            finally:
+                for _ in batch:
+                    lane.task_done()
+
+    async def _handle(self, batch: list[tuple[BaseEvent, aio_pika.abc.AbstractIncomingMessage]]):
+        events = [event for event, _ in batch]
+        try:
+            await self._call(self._dispatcher.dispatch_batch, events)
+        except Exception as e:
+            if len(batch) > 1:
+                # handled again one by one so only the failing events are retried
+                logger.warning(f"Batch of {len(batch)} failed, handling its events one by one: {e}")
+                for event, message in batch:
+                    await self._handle_one(event, message)
+                return
+            logger.warning(f"Handling {events[0].name} {events[0].event_id} failed: {e}")
+            self._dispatcher.settled(events)
+            await self._fail(batch[0][1], e)
+            return
+        try:
+            for _, message in batch:
+                await message.ack()
+        except Exception:
+            self._dispatcher.settled(events)
+            raise
+        self._dispatcher.settled(events, handled=True)
+
+    async def _handle_one(self, event: BaseEvent, message: aio_pika.abc.AbstractIncomingMessage):
+        try:
+            await self._call(self._dispatcher.dispatch, event)
+        except Exception as e:
+            logger.warning(f"Handling {event.name} {event.event_id} failed: {e}")
+            self._dispatcher.settled([event])
+            await self._fail(message, e)
+            return
+        try:
+            await message.ack()
+        except Exception:
+            self._dispatcher.settled([event])
+            raise
+        self._dispatcher.settled([event], handled=True)
+
+    async def _call(self, fn: Callable, arg):
+        # runs a handler in a worker thread and waits for the confirms of what it published
+        pending: list[Future] = []
+        context = contextvars.copy_context()
+        context.run(_pending_publishes.set, pending)
+        await self.loop.run_in_executor(None, context.run, fn, arg)
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in pending))
+
+    async def _fail(self, message: aio_pika.abc.AbstractIncomingMessage, error: Exception):
+        # The copy is published before the original is acked, so a crash in between duplicates the
+        # message instead of losing it. Consumers drop the duplicate by its event_id.
+        routing_key, headers = self._dispatcher.retry.route(message, error)
+        await self.publish(aio_pika.Message(message.body, delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                                            content_type=message.content_type,
+                                            content_encoding=message.content_encoding, headers=headers),
+                           routing_key)
+        await message.ack()
+
+    async def _every(self, interval: float, fn: Callable[[], object]):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.loop.run_in_executor(None, fn)
+            except Exception as e:
+                logger.error(f"{getattr(fn, '__name__', fn)} failed: {e}")
+
+    async def _sample_queue_depth(self, channel: aio_pika.abc.AbstractChannel):
+        while True:
+            try:
+                queue = await channel.declare_queue(self.queue, passive=True)
+                QUEUE_MESSAGES.labels(self.queue).set(queue.declaration_result.message_count)
+            except Exception as e:
+                logger.warning(f"Cannot sample queue {self.queue}: {e}")
+            await asyncio.sleep(QUEUE_SAMPLE_INTERVAL)
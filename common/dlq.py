@@ -0,0 +1,102 @@
+import argparse
+import logging
+
+import pika
+
+from common.amqp import RABBITMQ_HOST
+from common.partitioning import partition_queues
+from events.codec import EventDecodeError, EventDecoder
+from events.registry import EVENT_TYPES
+from events.retry import ERROR_HEADER, QUEUE_HEADER, RETRIES_HEADER, dead_letter_queue
+import events.payment.refund_payment_event
+import events.payment.reserve_payment_event
+import events.payment.reserve_payment_failed_event
+import events.payment.reserve_payment_successfull
+import events.stock.item_price_changed_event
+import events.stock.release_stock_event
+import events.stock.reserve_stock_event
+import events.stock.reserve_stock_failed_event
+import events.stock.reserve_stock_successful_event
+
+# Inspects and replays the dead-letter queues:
+#   python -m common.dlq list stock [--limit 20]
+#   python -m common.dlq replay stock [--limit 1000]
+# "stock", "payment" and "order" stand for the dead-letter queues of all their partitions, any
+# other name for the dead-letter queue of that one queue (e.g. stock.2). Replayed messages go back
+# to the queue they failed on with their retry count reset.
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LOGICAL_QUEUES = ("stock", "payment", "order")
+
+
+def dead_letter_queues(name: str) -> list[str]:
+    queues = partition_queues(name) if name in LOGICAL_QUEUES else [name]
+    return [dead_letter_queue(queue) for queue in queues]
+
+
+def describe(decoder: EventDecoder, properties: pika.BasicProperties, body: bytes) -> str:
+    headers = properties.headers or {}
+    try:
+        event = decoder.decode(body, properties)
+        event_str = f"{event.name} {event.event_id}"
+    except EventDecodeError:
+        event_str = f"undecodable body of {len(body)} bytes"
+    return f"{event_str}, retries: {headers.get(RETRIES_HEADER, 0)}, error: {headers.get(ERROR_HEADER)}"
+
+
+def list_messages(channel, queues: list[str], limit: int):
+    # basic_get without ack, the messages go back to their queue when the connection closes
+    decoder = EventDecoder(EVENT_TYPES.values())
+    for queue in queues:
+        count = channel.queue_declare(queue=queue, durable=True, passive=True).method.message_count
+        print(f"{queue}: {count} messages")
+        for _ in range(min(count, limit)):
+            method, properties, body = channel.basic_get(queue=queue, auto_ack=False)
+            if method is None:
+                break
+            print(f"  {describe(decoder, properties, body)}")
+
+
+def replay(channel, queues: list[str], limit: int) -> int:
+    # with confirms basic_publish returns once the broker has the message, only then is the
+    # dead-lettered copy acked
+    channel.confirm_delivery()
+    replayed = 0
+    for queue in queues:
+        while replayed < limit:
+            method, properties, body = channel.basic_get(queue=queue, auto_ack=False)
+            if method is None:
+                break
+            headers = dict(properties.headers or {})
+            target = headers.pop(QUEUE_HEADER, None)
+            if target is None:
+                logger.warning(f"Message in {queue} has no {QUEUE_HEADER} header, leaving it")
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                break
+            headers.pop(RETRIES_HEADER, None)
+            headers.pop(ERROR_HEADER, None)
+            properties.headers = headers
+            channel.basic_publish(exchange="", routing_key=target, body=body, properties=properties)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            replayed += 1
+    return replayed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=("list", "replay"))
+    parser.add_argument("queue", help="stock, payment, order or a single queue name")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--host", default=RABBITMQ_HOST)
+    args = parser.parse_args()
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=args.host, port=5672))
+    channel = connection.channel()
+    queues = dead_letter_queues(args.queue)
+    if args.command == "list":
+        list_messages(channel, queues, 20 if args.limit is None else args.limit)
+    else:
+        logger.info(f"Replayed {replay(channel, queues, float('inf') if args.limit is None else args.limit)} messages")
+    connection.close()
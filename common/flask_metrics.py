@@ -0,0 +1,36 @@
+import time
+
+from flask import Flask, Response, g, request
+
+from common import metrics
+from common.metrics import HTTP_REQUEST_DURATION, HTTP_REQUESTS_IN_FLIGHT
+
+
+def instrument_flask(app: Flask):
+    # Times every request by its route template and serves /metrics for all workers. Streamed
+    # responses are timed until their first byte.
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_status(response: Response) -> Response:
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def observe(error=None):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return
+        HTTP_REQUESTS_IN_FLIGHT.dec()
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        HTTP_REQUEST_DURATION.labels(request.method, route, str(g.pop("metrics_status", 500))).observe(
+            time.perf_counter() - start)
+
+    @app.get('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    metrics.start_flusher()
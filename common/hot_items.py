@@ -0,0 +1,69 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from typing import Iterable
+
+from common.stock_store import HITS_KEY_PREFIX, StockStore
+
+logger = logging.getLogger(__name__)
+
+# Hot-item mode: stock-consumer splits items that take most reservations over HOT_ITEM_SHARDS
+# sub-counters (0, the default, turns it off). Each consumer process counts reservations per item
+# and adds its counts to a shared hash per window of HOT_ITEM_WINDOW seconds. When a process
+# enters a new window it looks at the last complete one: items reserved at least
+# HOT_ITEM_PROMOTE_AT times over all consumers are promoted, hot items reserved fewer than
+# HOT_ITEM_DEMOTE_BELOW times are demoted. Promoting and demoting are idempotent, so it does not
+# matter how many processes decide the same.
+HOT_ITEM_SHARDS = int(os.environ.get('HOT_ITEM_SHARDS', 0))
+HOT_ITEM_WINDOW = float(os.environ.get('HOT_ITEM_WINDOW', 10))
+HOT_ITEM_PROMOTE_AT = int(os.environ.get('HOT_ITEM_PROMOTE_AT', 1000))
+HOT_ITEM_DEMOTE_BELOW = int(os.environ.get('HOT_ITEM_DEMOTE_BELOW', 100))
+
+
+class HotItemTracker:
+    def __init__(self, store: StockStore, shards: int = HOT_ITEM_SHARDS, window: float = HOT_ITEM_WINDOW,
+                 promote_at: int = HOT_ITEM_PROMOTE_AT, demote_below: int = HOT_ITEM_DEMOTE_BELOW):
+        self._store = store
+        self._shards = shards
+        self._window = window
+        self._promote_at = promote_at
+        self._demote_below = demote_below
+        self._hits: Counter[str] = Counter()
+        self._current: int | None = None
+        # observe is called from the consumer runtime's worker threads
+        self._lock = threading.Lock()
+
+    def observe(self, reservations: Iterable[Iterable[tuple[str, int]]], now: float | None = None):
+        window = int((time.time() if now is None else now) // self._window)
+        with self._lock:
+            for reservation in reservations:
+                for item_id, quantity in reservation:
+                    if quantity > 0:
+                        self._hits[item_id] += 1
+            if self._current is None:
+                self._current = window
+            if window == self._current:
+                return
+            hits, self._hits = self._hits, Counter()
+            previous, self._current = self._current, window
+        self.rebalance(window, previous, hits)
+
+    def rebalance(self, window: int, previous: int, own_hits: Counter[str]):
+        # adds this process' counts to the window they were made in, then decides on the last
+        # complete window
+        pipe = self._store.db.pipeline(transaction=False)
+        if own_hits:
+            for item_id, count in own_hits.items():
+                pipe.hincrby(f"{HITS_KEY_PREFIX}{previous}", item_id, count)
+            pipe.expire(f"{HITS_KEY_PREFIX}{previous}", int(3 * self._window) + 1)
+        pipe.hgetall(f"{HITS_KEY_PREFIX}{window - 1}")
+        hits = {item_id.decode(): int(count) for item_id, count in pipe.execute()[-1].items()}
+        hot = self._store.hot_items()
+        for item_id, count in hits.items():
+            if item_id not in hot and count >= self._promote_at and self._store.promote(item_id, self._shards):
+                logger.info(f"Item: {item_id} promoted to {self._shards} sub-counters, {count} reservations")
+        for item_id in hot:
+            if hits.get(item_id, 0) < self._demote_below and self._store.demote(item_id):
+                logger.info(f"Item: {item_id} demoted, {hits.get(item_id, 0)} reservations")
@@ -0,0 +1,192 @@
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 1))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 3))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+HTTP_RETRY_BACKOFF = 0.05
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 10))
+
+RETRYABLE_STATUS_CODES = frozenset((502, 503, 504))
+
+
+class UpstreamUnavailable(requests.exceptions.RequestException):
+    pass
+
+
+class CircuitBreaker:
+    # closed: requests flow, consecutive failures are counted
+    # open: requests fail fast until reset_timeout passed
+    # half open: one trial request decides between closed and open
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+
+class InternalClient:
+    # Keep-alive session for service-to-service calls through the gateway. Timeouts are strict,
+    # failed idempotent calls are retried a bounded number of times with jittered backoff, and
+    # each upstream (first path segment, e.g. /stock) has its own circuit breaker.
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, retries: int = HTTP_RETRIES):
+        self.retries = retries
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.retried = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, idempotent=True, **kwargs)
+
+    def post(self, url: str, idempotent: bool = False, **kwargs) -> requests.Response:
+        return self.request("POST", url, idempotent=idempotent, **kwargs)
+
+    def request(self, method: str, url: str, idempotent: bool, **kwargs) -> requests.Response:
+        upstream = self._upstream(url)
+        breaker = self._breaker(upstream)
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            if not breaker.allow():
+                with self._lock:
+                    self.rejected += 1
+                raise UpstreamUnavailable(f"Circuit open for {upstream}")
+            try:
+                response = self._send(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                breaker.record_failure()
+                if attempt + 1 == attempts:
+                    with self._lock:
+                        self.failed += 1
+                    raise
+                logger.warning(f"{method} {url} failed, retrying: {e}")
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                if attempt + 1 == attempts:
+                    with self._lock:
+                        self.failed += 1
+                    return response
+                response.close()
+            with self._lock:
+                self.retried += 1
+            # full jitter: sleep somewhere between 0 and the exponential backoff
+            time.sleep(random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** attempt))
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return self.session.request(method, url, timeout=self.timeout, **kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _upstream(self, url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.netloc}/{parts.path.lstrip('/').split('/', 1)[0]}"
+
+    def _breaker(self, upstream: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(upstream)
+            if breaker is None:
+                breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+                self._breakers[upstream] = breaker
+            return breaker
+
+    def stats(self) -> dict:
+        pools = []
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            pools.append({
+                "host": f"{pool.host}:{pool.port}",
+                "maxsize": pool.pool.maxsize,
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle": idle,
+            })
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "pool_size": self.pool_size,
+                "utilization": self.in_flight / self.pool_size,
+                "requests": self.requests,
+                "retried": self.retried,
+                "failed": self.failed,
+                "rejected_by_breaker": self.rejected,
+                "breakers": {upstream: breaker.state for upstream, breaker in self._breakers.items()},
+                "pools": pools,
+            }
+
+
+_client: InternalClient | None = None
+_client_pid: int | None = None
+_client_lock = threading.Lock()
+
+
+def get_internal_client() -> InternalClient:
+    # one client, and so one connection pool, per worker process
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client, _client_pid = InternalClient(), os.getpid()
+        return _client
@@ -0,0 +1,22 @@
+import os
+
+from common.lru import TTLCache
+
+# Every event carries an event_id. The stock and payment scripts record the outcome of each event
+# under processed:<event_id> in the same call that applies it, and replay that outcome when the
+# event is delivered again. The records expire after IDEMPOTENCY_TTL seconds, which bounds their
+# memory to the event rate times the TTL. The stock and payment Redis evict the records closest
+# to expiry first under memory pressure (maxmemory-policy volatile-ttl), never the data itself.
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 60 * 60))
+PROCESSED_KEY_PREFIX = "processed:"
+
+# Optional per-consumer set of recently handled event ids (0 disables it). Redeliveries found in
+# it are acked without touching Redis. It is exact rather than probabilistic, since a false
+# positive would drop a new event.
+IDEMPOTENCY_PREFILTER_SIZE = int(os.environ.get('IDEMPOTENCY_PREFILTER_SIZE', 0))
+
+
+def recent_events() -> TTLCache[str, bool] | None:
+    if not IDEMPOTENCY_PREFILTER_SIZE:
+        return None
+    return TTLCache(maxsize=IDEMPOTENCY_PREFILTER_SIZE, ttl=IDEMPOTENCY_TTL)
@@ -0,0 +1,380 @@
+import bisect
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+import redis
+import redis.asyncio
+from msgspec import msgpack
+
+logger = logging.getLogger(__name__)
+
+# Counters, gauges and latency histograms kept in process memory. Every METRICS_FLUSH_INTERVAL
+# seconds each process writes a snapshot to METRICS_DIR/<pid>.msgpack, and /metrics merges the
+# snapshots of all live processes, so one scrape covers every gunicorn worker of a service or
+# every partition process of a supervisor. Snapshots of dead processes are dropped, which shows
+# up as a counter reset. Gauges are summed over the processes.
+# Every value has its own lock, since the consumers' worker threads update the same metrics.
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+# side port of processes without an HTTP server of their own (consumers, outbox relay)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+QUEUE_SAMPLE_INTERVAL = 5
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from half a millisecond to ten seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def sample(self) -> float:
+        return self.value
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        # per bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        bucket = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def sample(self) -> list[float]:
+        with self._lock:
+            return [*self.counts, self.sum]
+
+
+class Metric:
+    def __init__(self, name: str, help: str, type: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._children: dict[tuple[str, ...], _Value | _Buckets] = {}
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, _Buckets(self.buckets) if self.type == HISTOGRAM else _Value())
+        return child
+
+    # shortcuts for metrics without labels
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self) -> list:
+        return [[list(values), child.sample()] for values, child in list(self._children.items())]
+
+
+class CallbackMetric(Metric):
+    # a counter or gauge read from fn() when a snapshot is taken, for values kept elsewhere
+    def __init__(self, name: str, help: str, type: str, fn: Callable[[], float]):
+        super().__init__(name, help, type)
+        self.fn = fn
+
+    def samples(self) -> list:
+        return [[[], float(self.fn())]]
+
+
+_metrics: dict[str, Metric] = {}
+
+
+def _register(metric: Metric) -> Metric:
+    existing = _metrics.setdefault(metric.name, metric)
+    if existing.type != metric.type or existing.labelnames != metric.labelnames:
+        raise ValueError(f"Metric {metric.name} is already registered as a different {existing.type}")
+    return existing
+
+
+def counter(name: str, help: str, labelnames: tuple[str, ...] = ()) -> Metric:
+    return _register(Metric(name, help, COUNTER, labelnames))
+
+
+def gauge(name: str, help: str, labelnames: tuple[str, ...] = ()) -> Metric:
+    return _register(Metric(name, help, GAUGE, labelnames))
+
+
+def histogram(name: str, help: str, labelnames: tuple[str, ...] = (),
+              buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Metric:
+    return _register(Metric(name, help, HISTOGRAM, labelnames, buckets))
+
+
+def callback(name: str, help: str, type: str, fn: Callable[[], float]) -> Metric:
+    # replaces an earlier callback of the same name, e.g. of a recreated object
+    metric = CallbackMetric(name, help, type, fn)
+    _metrics[name] = metric
+    return metric
+
+
+def snapshot() -> dict[str, list]:
+    return {metric.name: [metric.type, metric.help, list(metric.labelnames), list(metric.buckets), metric.samples()]
+            for metric in list(_metrics.values())}
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"{pid}.msgpack")
+
+
+def flush():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = _snapshot_path(os.getpid())
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(msgpack.encode(snapshot()))
+    os.replace(f"{path}.tmp", path)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(merged: dict[str, list], snap: dict[str, list]):
+    for name, (type, help, labelnames, buckets, samples) in snap.items():
+        entry = merged.setdefault(name, [type, help, labelnames, buckets, {}])
+        values = entry[4]
+        for labels, sample in samples:
+            labels = tuple(labels)
+            current = values.get(labels)
+            if current is None:
+                values[labels] = sample
+            elif isinstance(sample, list):
+                values[labels] = [a + b for a, b in zip(current, sample)]
+            else:
+                values[labels] = current + sample
+
+
+def collect() -> dict[str, list]:
+    # this process's live metrics plus the snapshots of all other live processes
+    merged: dict[str, list] = {}
+    _merge(merged, snapshot())
+    own = os.getpid()
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        pid, _, ext = name.partition(".")
+        if ext != "msgpack" or not pid.isdigit() or int(pid) == own:
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        if not _alive(int(pid)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        try:
+            with open(path, "rb") as f:
+                _merge(merged, msgpack.decode(f.read()))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping metrics snapshot {name}: {e}")
+    return merged
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labelnames: list[str], values: tuple, le=None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render(merged: dict[str, list] | None = None) -> str:
+    # Prometheus text exposition format
+    lines = []
+    for name, (type, help, labelnames, buckets, values) in sorted((merged or collect()).items()):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for labels, sample in values.items():
+            if type != HISTOGRAM:
+                lines.append(f"{name}{_labels(labelnames, labels)} {sample}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*buckets, "+Inf"], sample):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labelnames, labels, bound)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labelnames, labels)} {sample[-1]}")
+            lines.append(f"{name}_count{_labels(labelnames, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+_flusher: threading.Thread | None = None
+
+
+def start_flusher():
+    # idempotent, call it after forking
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+
+    def run():
+        while True:
+            try:
+                flush()
+            except OSError as e:
+                logger.warning(f"Cannot write metrics snapshot: {e}")
+            time.sleep(METRICS_FLUSH_INTERVAL)
+
+    _flusher = threading.Thread(target=run, name="metrics-flusher", daemon=True)
+    _flusher.start()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int = METRICS_PORT) -> ThreadingHTTPServer:
+    # /metrics on a side port, served from a background thread
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    start_flusher()
+    return server
+
+
+HTTP_REQUEST_DURATION = histogram("http_request_duration_seconds", "Time to produce a response, by route",
+                                  ("method", "route", "status"))
+HTTP_REQUESTS_IN_FLIGHT = gauge("http_requests_in_flight", "Requests being handled")
+REDIS_DURATION = histogram("redis_command_duration_seconds", "Redis command and pipeline round trip time",
+                           ("command",))
+AMQP_CONFIRM_DURATION = histogram("amqp_confirm_duration_seconds",
+                                  "Time from handing a message to the publisher until the broker confirmed it")
+EVENT_HANDLER_DURATION = histogram("event_handler_duration_seconds", "Time of one event handler call, a batch "
+                                   "handler call covers its whole batch", ("handler",))
+EVENTS = counter("events_total", "Events passed to a handler, by outcome", ("handler", "outcome"))
+QUEUE_MESSAGES = gauge("queue_messages", "Messages ready in a queue, sampled by its consumer", ("queue",))
+
+
+class TimedRedis(redis.Redis):
+    # redis.Redis recording every command and pipeline in redis_command_duration_seconds
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            REDIS_DURATION.labels(str(args[0])).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class TimedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            REDIS_DURATION.labels("MULTI" if self.transaction else "PIPELINE").observe(time.perf_counter() - start)
+
+
+class TimedAsyncRedis(redis.asyncio.Redis):
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_DURATION.labels(str(args[0])).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class TimedAsyncPipeline(redis.asyncio.client.Pipeline):
+    async def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_DURATION.labels("MULTI" if self.is_transaction else "PIPELINE").observe(time.perf_counter() - start)
+
+
+class EventMetrics:
+    # events.registry.HandlerMetrics recording into event_handler_duration_seconds and events_total
+    def observe(self, handler: str, count: int, seconds: float, failed: bool):
+        EVENT_HANDLER_DURATION.labels(handler).observe(seconds)
+        EVENTS.labels(handler, "failed" if failed else "handled").inc(count)
+
+
+def watch_dispatcher(dispatcher):
+    # exposes the counters an events.registry.EventDispatcher and its retry policy keep
+    callback("events_skipped_total", "Redeliveries skipped by the recent events prefilter", COUNTER,
+             lambda: dispatcher.skipped)
+    callback("messages_retried_total", "Failed messages sent to a retry queue", COUNTER,
+             lambda: dispatcher.retry.retried if dispatcher.retry is not None else 0)
+    callback("messages_dead_lettered_total", "Failed messages sent to the dead-letter queue", COUNTER,
+             lambda: dispatcher.retry.dead_lettered if dispatcher.retry is not None else 0)
@@ -0,0 +1,63 @@
+import logging
+import os
+
+import msgspec
+import redis
+from msgspec import msgpack
+
+from common.orders import OrderValue, order_fields
+
+# Converts orders stored as one msgpack OrderValue string into the hash layout of common.orders:
+#   python -m common.migrate_orders
+# with the REDIS_* variables of the order database. Keys are streamed with SCAN, only string keys
+# are visited, and each batch is converted in one MULTI so no order is ever half converted.
+# Stop order-service and order-consumer while it runs, the old code cannot read hashes and the
+# new code cannot read strings. Running it again skips what was already converted.
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 1000))
+
+order_value_decoder = msgpack.Decoder(OrderValue)
+
+
+def migrate_batch(db: redis.Redis, keys: list[bytes]) -> int:
+    pipe = db.pipeline(transaction=True)
+    converted = 0
+    for key, entry in zip(keys, db.mget(keys)):
+        if entry is None:
+            continue
+        try:
+            order = order_value_decoder.decode(entry)
+        except (msgspec.DecodeError, msgspec.ValidationError):
+            # not an order
+            continue
+        pipe.delete(key)
+        pipe.hset(key, mapping=order_fields(order))
+        converted += 1
+    if converted:
+        pipe.execute()
+    return converted
+
+
+def migrate(db: redis.Redis, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    converted = 0
+    batch: list[bytes] = []
+    for key in db.scan_iter(count=batch_size, _type="string"):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            converted += migrate_batch(db, batch)
+            batch = []
+            logger.info(f"Converted {converted} orders")
+    if batch:
+        converted += migrate_batch(db, batch)
+    return converted
+
+
+if __name__ == '__main__':
+    db = redis.Redis(host=os.environ['REDIS_HOST'],
+                     port=int(os.environ['REDIS_PORT']),
+                     password=os.environ['REDIS_PASSWORD'],
+                     db=int(os.environ['REDIS_DB']))
+    logger.info(f"Done, converted {migrate(db)} orders")
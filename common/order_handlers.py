@@ -0,0 +1,107 @@
+import logging
+
+import redis
+
+from common.checkout_results import queue_publish_result
+from common.outbox import OUTBOX_STREAM
+from common.saga import COMPLETE, EXPIRED, LATE, SAGA_SWEEP_BATCH, UNKNOWN, SagaReply, SagaResult, SagaStore
+from common.tracing import queue_record_finish, queue_record_hops, trace_key
+from events.base_event import BaseEvent
+from events.payment.reserve_payment_failed_event import ReservePaymentFailed
+from events.payment.reserve_payment_successfull import ReservePaymentSucessfull
+from events.registry import EventDispatcher
+from events.stock.reserve_stock_failed_event import ReserveStockFailed
+from events.stock.reserve_stock_successful_event import ReserveStockSucessfull
+from events.tracing import Trace
+
+logger = logging.getLogger(__name__)
+
+# participant replies: event type -> (participant, succeeded)
+REPLIES: dict[type[BaseEvent], tuple[str, bool]] = {
+    ReserveStockSucessfull: ("stock", True),
+    ReserveStockFailed: ("stock", False),
+    ReservePaymentSucessfull: ("payment", True),
+    ReservePaymentFailed: ("payment", False),
+}
+
+
+def saga_reply(event: BaseEvent) -> SagaReply:
+    participant, ok = REPLIES[type(event)]
+    return SagaReply(event.order_id, participant, ok)
+
+
+def reply_status(reply: bool | None) -> str:
+    # no reply means the participant timed out
+    return 'approved' if reply else 'rejected'
+
+
+class OrderHandlers:
+    # order-consumer's saga handlers on any Redis client, registered on the dispatcher. They publish
+    # nothing themselves, the saga scripts append what follows a saga to the outbox.
+    def __init__(self, db: redis.Redis, dispatcher: EventDispatcher | None = None):
+        self.db = db
+        self.saga_store = SagaStore(db, OUTBOX_STREAM)
+        self.dispatcher = EventDispatcher() if dispatcher is None else dispatcher
+        self.dispatcher.handler(*REPLIES)(self.handle_reply)
+        self.dispatcher.batch_handler(*REPLIES)(self.handle_replies)
+
+    def finish_sagas(self, results: list[SagaResult], traces: dict[str, Trace] | None = None, pipe=None):
+        # The saga scripts already set the final statuses and queued the commit or compensations in
+        # the outbox. The statuses are published to the clients waiting for them and sagas with a
+        # trace get their end recorded in it.
+        traces = traces or {}
+        pipe = self.db.pipeline(transaction=False) if pipe is None else pipe
+        for result in results:
+            if not result.approved:
+                logger.info(f"Order: {result.order_id} rejected")
+            queue_publish_result(pipe, result.order_id, reply_status(result.payment), reply_status(result.stock))
+            if result.order_id in traces:
+                queue_record_finish(pipe, result.order_id, traces[result.order_id].started_at,
+                                    'approved' if result.approved else 'rejected')
+        pipe.execute()
+
+    def handle_reply(self, event: BaseEvent):
+        self.handle_replies([event])
+
+    def handle_replies(self, events: list[BaseEvent]):
+        # records all replies in one round trip, a reply completes its saga by bringing the pending
+        # counter to zero. The hops of traced replies are written with the saga results.
+        replies = [saga_reply(event) for event in events]
+        results: list[SagaResult] = []
+        for reply, (outcome, result) in zip(replies, self.saga_store.record(replies)):
+            if outcome == COMPLETE:
+                results.append(result)
+            elif outcome == EXPIRED:
+                logger.warning(f"Saga of order: {reply.order_id} timed out before its {reply.participant} reply")
+                results.append(result)
+            elif outcome == LATE and reply.ok:
+                logger.info(f"Late {reply.participant} reply for order: {reply.order_id} compensated")
+            elif outcome == UNKNOWN:
+                logger.warning(f"No saga for order: {reply.order_id}, ignoring {reply.participant} reply")
+        pipe = self.db.pipeline(transaction=False)
+        traces: dict[str, Trace] = {}
+        for event in events:
+            delivery = self.dispatcher.delivery(event)
+            if delivery is None:
+                continue
+            traces[event.order_id] = trace = delivery.continued()
+            queue_record_hops(pipe, event.order_id, trace, trace.hops)
+        self.finish_sagas(results, traces, pipe)
+
+    def saga_traces(self, order_ids: list[str]) -> dict[str, Trace]:
+        # the traces of sagas that ended without a reply, from their trace hashes
+        pipe = self.db.pipeline(transaction=False)
+        for order_id in order_ids:
+            pipe.hmget(trace_key(order_id), ['trace_id', 'started_at'])
+        return {order_id: Trace(trace_id.decode(), float(started_at))
+                for order_id, (trace_id, started_at) in zip(order_ids, pipe.execute()) if trace_id and started_at}
+
+    def sweep_expired_sagas(self):
+        # sagas past their deadline are taken off the deadline index in batches and rejected
+        while True:
+            expired = self.saga_store.expire_due()
+            for result in expired:
+                logger.warning(f"Saga of order: {result.order_id} timed out")
+            self.finish_sagas(expired, traces=self.saga_traces([result.order_id for result in expired]))
+            if len(expired) < SAGA_SWEEP_BATCH:
+                break
@@ -0,0 +1,159 @@
+import random
+from typing import Literal
+
+from msgspec import Struct, msgpack
+
+from common.saga import COMMIT_STOCK, REFUND_PAYMENT, RELEASE_STOCK
+from events.base_event import BaseEvent
+from events.payment.refund_payment_event import RefundPaymentEvent
+from events.payment.reserve_payment_event import ReservePaymentEvent
+from events.stock.commit_stock_event import CommitStockEvent
+from events.stock.release_stock_event import ReleaseStockEvent
+from events.stock.reserve_stock_event import ReserveStockEvent, StockItem
+
+
+class OrderValue(Struct):
+    items: list[tuple[str, int]]
+    user_id: str
+    total_cost: int
+    payment_status: Literal['pending', 'approved', 'rejected']
+    stock_status: Literal['pending', 'approved', 'rejected']
+
+
+# Orders are stored as Redis hashes. The items, user and total cost are one msgpack OrderData blob
+# that only addItem rewrites, and each status is a field of its own, so order-consumer sets a
+# status with a single HSET without decoding the items or overwriting the other status.
+DATA_FIELD = "data"
+PAYMENT_STATUS_FIELD = "payment_status"
+STOCK_STATUS_FIELD = "stock_status"
+ORDER_FIELDS = (DATA_FIELD, PAYMENT_STATUS_FIELD, STOCK_STATUS_FIELD)
+# set by the checkout script in common.outbox when the order is checked out
+CHECKOUT_FIELD = "checkout"
+
+DATA_SET = 1
+DATA_CHECKED_OUT = 0
+DATA_NOT_FOUND = -1
+
+# KEYS[1]: the order. ARGV[1]: its new data. Writes the data only while the order is not checked
+# out, so items added after checkout cannot change what its saga charges or refunds. Returns 1,
+# 0 when the order was checked out or -1 when it does not exist.
+SET_ORDER_DATA_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+if redis.call('HEXISTS', KEYS[1], 'checkout') == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'data', ARGV[1])
+return 1
+"""
+
+
+class OrderData(Struct):
+    items: list[tuple[str, int]]
+    user_id: str
+    total_cost: int
+
+
+order_data_encoder = msgpack.Encoder()
+order_data_decoder = msgpack.Decoder(OrderData)
+
+
+def order_data(order: OrderValue) -> bytes:
+    return order_data_encoder.encode(OrderData(items=order.items, user_id=order.user_id, total_cost=order.total_cost))
+
+
+def order_fields(order: OrderValue) -> dict[str, bytes | str]:
+    return {
+        DATA_FIELD: order_data(order),
+        PAYMENT_STATUS_FIELD: order.payment_status,
+        STOCK_STATUS_FIELD: order.stock_status,
+    }
+
+
+def order_from_fields(fields: list[bytes | None]) -> OrderValue | None:
+    # fields as returned by HMGET <order_id> *ORDER_FIELDS, None when the order does not exist
+    data, payment_status, stock_status = fields
+    if data is None:
+        return None
+    data = order_data_decoder.decode(data)
+    return OrderValue(items=data.items, user_id=data.user_id, total_cost=data.total_cost,
+                      payment_status=payment_status.decode(), stock_status=stock_status.decode())
+
+
+def queue_order_reads(pipe, order_ids: list[str]):
+    # one HMGET per order on a sync or asyncio pipeline, see found_orders
+    for order_id in order_ids:
+        pipe.hmget(order_id, ORDER_FIELDS)
+
+
+def found_orders(results: list[list[bytes | None]]) -> list[list[bytes | None] | None]:
+    return [fields if fields[0] is not None else None for fields in results]
+
+
+def get_order_entries(db, order_ids: list[str]) -> list[list[bytes | None] | None]:
+    pipe = db.pipeline(transaction=False)
+    queue_order_reads(pipe, order_ids)
+    return found_orders(pipe.execute())
+
+
+def order_to_json(order_id: str, order: OrderValue) -> dict:
+    return {
+        "order_id": order_id,
+        "items": order.items,
+        "user_id": order.user_id,
+        "total_cost": order.total_cost,
+        "payment_status": order.payment_status,
+        "stock_status": order.stock_status
+    }
+
+
+def checkout_events(order_id: str, order: OrderValue) -> tuple[ReservePaymentEvent, ReserveStockEvent]:
+    payment_event = ReservePaymentEvent(
+        amount=order.total_cost,
+        user_id=order.user_id,
+        order_id=order_id
+    )
+    stock_event = ReserveStockEvent(
+        order_id=order_id,
+        stock_items=[
+            StockItem(
+                item_id=item_id, quantity=quantity
+            ) for item_id, quantity in order.items
+        ]
+    )
+    return payment_event, stock_event
+
+
+def saga_follow_ups(order_id: str, order: OrderValue,
+                    stock_event: ReserveStockEvent) -> dict[str, tuple[str, BaseEvent]]:
+    # the events that may follow the checkout's saga, stored with it by the checkout script: the
+    # commit of the stock hold and the compensations, for exactly what the checkout reserves. The
+    # hold is the one of this checkout's stock reservation.
+    return {
+        COMMIT_STOCK: ("stock", CommitStockEvent(order_id=order_id, hold_id=stock_event.event_id)),
+        RELEASE_STOCK: ("stock", ReleaseStockEvent(order_id=order_id, stock_items=stock_event.stock_items,
+                                                   hold_id=stock_event.event_id)),
+        REFUND_PAYMENT: ("payment", RefundPaymentEvent(amount=order.total_cost, user_id=order.user_id,
+                                                       order_id=order_id)),
+    }
+
+
+def random_order_chunks(n_items: int, n_users: int, item_price: int):
+    # batch_init chunk generator: all random ids of a chunk are drawn with two choices() calls
+    # instead of three randint() calls per order
+    items, users = range(n_items), range(n_users)
+
+    def generate_chunk(start: int, stop: int) -> dict[str, dict[str, bytes | str]]:
+        size = stop - start
+        user_ids = random.choices(users, k=size)
+        item_ids = random.choices(items, k=2 * size)
+        return {
+            f"{i}": order_fields(OrderValue(payment_status='pending', stock_status='pending',
+                                            items=[(f"{item_ids[2 * j]}", 1), (f"{item_ids[2 * j + 1]}", 1)],
+                                            user_id=f"{user_ids[j]}",
+                                            total_cost=2 * item_price))
+            for j, i in enumerate(range(start, stop))
+        }
+
+    return generate_chunk
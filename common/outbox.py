@@ -0,0 +1,176 @@
+import logging
+import os
+import socket
+import time
+from concurrent.futures import wait
+
+import pika
+import redis
+
+from common.amqp import PUBLISH_TIMEOUT, ConfirmingPublisher
+from common.partitioning import route
+from common.saga import PARTICIPANTS, SAGA_DEADLINES_KEY, SAGA_TIMEOUT, saga_key
+from common.tracing import TRACE_TTL, trace_key
+from events.base_event import BaseEvent
+from events.codec import CONTENT_TYPE, encode_event
+from events.tracing import TRACE_HEADER, Trace, published, trace_headers
+
+logger = logging.getLogger(__name__)
+
+# Checkout writes its events to a Redis stream in the order database instead of publishing them.
+# The outbox relay reads the stream through a consumer group, publishes the entries in confirmed
+# batches and deletes them once the broker confirmed. Entries of a relay that died stay pending
+# in the group and are claimed by a relay after OUTBOX_CLAIM_IDLE_MS.
+OUTBOX_STREAM = "outbox"
+OUTBOX_GROUP = "relay"
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 500))
+OUTBOX_BLOCK_MS = int(os.environ.get('OUTBOX_BLOCK_MS', 1000))
+OUTBOX_CLAIM_IDLE_MS = int(os.environ.get('OUTBOX_CLAIM_IDLE_MS', 30_000))
+OUTBOX_RETRY_DELAY = 0.5
+
+ALREADY_CHECKED_OUT = 0
+CHECKED_OUT = 1
+ORDER_NOT_FOUND = -1
+
+# KEYS[1]: the order, KEYS[2]: its saga, KEYS[3]: the saga deadline index, KEYS[4]: the outbox,
+# KEYS[5]: its trace. ARGV: order id, now, saga deadline, number of saga participants, trace id,
+# trace ttl, number of events, then per event its routing key, body, content encoding ("" for
+# none) and trace header, then per saga follow-up its name and the same four.
+# Marks the order as checked out, starts its saga and trace and appends its events to the outbox,
+# all in one atomic step. Returns 1, 0 when the order was already checked out or -1 when it does
+# not exist.
+CHECKOUT_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+if redis.call('HSETNX', KEYS[1], 'checkout', ARGV[2]) == 0 then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+redis.call('HSET', KEYS[2], 'state', 'running', 'pending', ARGV[4])
+local follow_ups = 8 + 4 * tonumber(ARGV[7])
+for i = follow_ups, #ARGV, 5 do
+    local field = 'then:' .. ARGV[i]
+    redis.call('HSET', KEYS[2], field, ARGV[i + 1], field .. ':body', ARGV[i + 2], field .. ':encoding', ARGV[i + 3],
+               field .. ':trace', ARGV[i + 4])
+end
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[1])
+redis.call('DEL', KEYS[5])
+redis.call('HSET', KEYS[5], 'trace_id', ARGV[5], 'started_at', ARGV[2])
+redis.call('EXPIRE', KEYS[5], ARGV[6])
+for i = 8, follow_ups - 1, 4 do
+    redis.call('XADD', KEYS[4], '*', 'routing_key', ARGV[i], 'body', ARGV[i + 1], 'content_encoding', ARGV[i + 2],
+               'trace', ARGV[i + 3])
+end
+return 1
+"""
+
+
+def outbox_fields(queue: str, event: BaseEvent, header: str) -> tuple[str, bytes, str, str]:
+    body, properties = encode_event(event)
+    return route(queue, event), body, properties.get("content_encoding", ""), header
+
+
+def checkout_call(order_id: str, events: list[tuple[str, BaseEvent]], trace: Trace,
+                  follow_ups: dict[str, tuple[str, BaseEvent]] | None = None) -> tuple[list[str], list]:
+    # keys and args of CHECKOUT_LUA for events and saga follow-ups given as (queue, event)
+    header = trace_headers(trace)[TRACE_HEADER]
+    args = [order_id, trace.started_at, trace.started_at + SAGA_TIMEOUT, len(PARTICIPANTS), trace.trace_id, TRACE_TTL,
+            len(events)]
+    for queue, event in events:
+        args.extend(outbox_fields(queue, event, header))
+    for name, (queue, event) in (follow_ups or {}).items():
+        args.extend((name, *outbox_fields(queue, event, header)))
+    return [order_id, saga_key(order_id), SAGA_DEADLINES_KEY, OUTBOX_STREAM, trace_key(order_id)], args
+
+
+class Outbox:
+    def __init__(self, db: redis.Redis):
+        self._checkout = db.register_script(CHECKOUT_LUA)
+
+    def checkout(self, order_id: str, events: list[tuple[str, BaseEvent]], trace: Trace,
+                 follow_ups: dict[str, tuple[str, BaseEvent]] | None = None) -> int:
+        keys, args = checkout_call(order_id, events, trace, follow_ups)
+        return self._checkout(keys=keys, args=args)
+
+
+def entry_properties(fields: dict[bytes, bytes]) -> pika.BasicProperties:
+    content_encoding = fields.get(b"content_encoding") or None
+    trace = fields.get(b"trace")
+    return pika.BasicProperties(delivery_mode=2, content_type=CONTENT_TYPE,
+                                content_encoding=content_encoding and content_encoding.decode(),
+                                headers=published({TRACE_HEADER: trace.decode()}) if trace else None)
+
+
+class OutboxRelay:
+    def __init__(self, db: redis.Redis, publisher: ConfirmingPublisher,
+                 batch_size: int = OUTBOX_BATCH_SIZE, consumer: str | None = None):
+        self.db = db
+        self.publisher = publisher
+        self.batch_size = batch_size
+        self.consumer = consumer or socket.gethostname()
+        # start with this consumer's own pending entries, left over from a previous run
+        self._read_pending = True
+        self._last_claim = 0.0
+        self.published = 0
+        self.failed = 0
+
+    def ensure_group(self):
+        try:
+            self.db.xgroup_create(OUTBOX_STREAM, OUTBOX_GROUP, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self) -> list[tuple[bytes, dict[bytes, bytes]]]:
+        if time.monotonic() - self._last_claim >= OUTBOX_CLAIM_IDLE_MS / 1000:
+            # take over the entries of relays that stopped before publishing them
+            self._last_claim = time.monotonic()
+            _, claimed, *_ = self.db.xautoclaim(OUTBOX_STREAM, OUTBOX_GROUP, self.consumer,
+                                                min_idle_time=OUTBOX_CLAIM_IDLE_MS, count=self.batch_size)
+            if claimed:
+                return claimed
+        if self._read_pending:
+            entries = self.db.xreadgroup(OUTBOX_GROUP, self.consumer, {OUTBOX_STREAM: "0"}, count=self.batch_size)
+            entries = entries[0][1] if entries else []
+            if entries:
+                return entries
+            self._read_pending = False
+        entries = self.db.xreadgroup(OUTBOX_GROUP, self.consumer, {OUTBOX_STREAM: ">"},
+                                     count=self.batch_size, block=OUTBOX_BLOCK_MS)
+        return entries[0][1] if entries else []
+
+    def relay_batch(self) -> int:
+        # Publishes one batch and waits for all confirms together. Confirmed entries are acked
+        # and deleted with one pipeline, the others stay pending and are read again.
+        entries = self.read()
+        if not entries:
+            return 0
+        futures = {self.publisher.publish(fields[b"routing_key"].decode(), fields[b"body"],
+                                          entry_properties(fields)): entry_id
+                   for entry_id, fields in entries}
+        wait(futures, timeout=PUBLISH_TIMEOUT)
+        confirmed = [entry_id for future, entry_id in futures.items()
+                     if future.done() and future.exception() is None]
+        if confirmed:
+            pipe = self.db.pipeline()
+            pipe.xack(OUTBOX_STREAM, OUTBOX_GROUP, *confirmed)
+            pipe.xdel(OUTBOX_STREAM, *confirmed)
+            pipe.execute()
+        self.published += len(confirmed)
+        if len(confirmed) < len(entries):
+            self.failed += len(entries) - len(confirmed)
+            logger.warning(f"{len(entries) - len(confirmed)} outbox entries not confirmed, retrying")
+            self._read_pending = True
+            time.sleep(OUTBOX_RETRY_DELAY)
+        return len(confirmed)
+
+    def run(self):
+        self.ensure_group()
+        while True:
+            try:
+                self.relay_batch()
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Outbox relay failed: {e}")
+                self._read_pending = True
+                time.sleep(OUTBOX_RETRY_DELAY)
@@ -0,0 +1,51 @@
+import bisect
+import hashlib
+import os
+
+# Every logical queue ("stock", "payment", "order") is split into QUEUE_PARTITIONS queues and an
+# event goes to the partition owning its key, so all events for one key are consumed in order by
+# a single process. With one partition the plain queue name is used.
+QUEUE_PARTITIONS = int(os.environ.get('QUEUE_PARTITIONS', 1))
+# partition consumed by this process, set by the supervisor
+PARTITION = int(os.environ.get('PARTITION', 0))
+VIRTUAL_NODES = 64
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    # Consistent hashing with virtual nodes. Going from n to n+1 partitions moves about 1/(n+1)
+    # of the keys, and only onto the new partition.
+    def __init__(self, partitions: int, virtual_nodes: int = VIRTUAL_NODES):
+        self.partitions = partitions
+        points = sorted((_hash(f"{partition}-{vnode}"), partition)
+                        for partition in range(partitions) for vnode in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [partition for _, partition in points]
+
+    def partition(self, key: str) -> int:
+        if self.partitions == 1:
+            return 0
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[i]
+
+
+ring = HashRing(QUEUE_PARTITIONS)
+
+
+def partition_queue(queue: str, partition: int) -> str:
+    return queue if QUEUE_PARTITIONS == 1 else f"{queue}.{partition}"
+
+
+def partition_queues(queue: str) -> list[str]:
+    return [partition_queue(queue, partition) for partition in range(QUEUE_PARTITIONS)]
+
+
+def queue_for(queue: str, key: str) -> str:
+    return partition_queue(queue, ring.partition(key))
+
+
+def route(queue: str, event) -> str:
+    return queue_for(queue, event.partition_key())
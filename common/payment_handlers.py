@@ -0,0 +1,53 @@
+import logging
+
+import redis
+
+from common.amqp import EventPublisher
+from common.payment_store import PaymentStore
+from events.payment.refund_payment_event import RefundPaymentEvent
+from events.payment.reserve_payment_event import ReservePaymentEvent
+from events.payment.reserve_payment_failed_event import ReservePaymentFailed
+from events.payment.reserve_payment_successfull import ReservePaymentSucessfull
+from events.registry import EventDispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentHandlers:
+    # payment-consumer's handlers on any Redis client and publisher, registered on the dispatcher
+    def __init__(self, db: redis.Redis, publisher: EventPublisher, dispatcher: EventDispatcher | None = None):
+        self.store = PaymentStore(db)
+        self.publisher = publisher
+        self.dispatcher = EventDispatcher() if dispatcher is None else dispatcher
+        self.dispatcher.handler(ReservePaymentEvent)(self.reserve_money)
+        self.dispatcher.batch_handler(ReservePaymentEvent)(self.reserve_money_batch)
+        self.dispatcher.handler(RefundPaymentEvent)(self.refund_money)
+        self.dispatcher.batch_handler(RefundPaymentEvent)(self.refund_money_batch)
+
+    def reserve_money(self, event: ReservePaymentEvent):
+        self.reserve_money_batch([event])
+
+    def reserve_money_batch(self, events: list[ReservePaymentEvent]):
+        # every payment in the batch is settled by one atomic script call
+        # a redelivered event is not applied twice, it gets its first outcome and the reply is sent again
+        failures, _ = self.store.reserve([(event.user_id, int(event.amount)) for event in events],
+                                         [event.event_id for event in events])
+        for event, failure in zip(events, failures):
+            if failure is not None:
+                logger.warning(f"User: {event.user_id} {failure} for order: {event.order_id}")
+                self.publisher.publish("order", ReservePaymentFailed(
+                    order_id=event.order_id, reason=f"User: {event.user_id} {failure}"),
+                    self.dispatcher.trace_headers(event))
+                continue
+            self.publisher.publish("order", ReservePaymentSucessfull(order_id=event.order_id),
+                                   self.dispatcher.trace_headers(event))
+
+    def refund_money(self, event: RefundPaymentEvent):
+        self.refund_money_batch([event])
+
+    def refund_money_batch(self, events: list[RefundPaymentEvent]):
+        failures = self.store.refund([(event.user_id, int(event.amount)) for event in events],
+                                     [event.event_id for event in events])
+        for event, failure in zip(events, failures):
+            if failure is not None:
+                logger.error(f"Cannot refund order: {event.order_id}, user: {event.user_id} {failure}")
@@ -0,0 +1,101 @@
+import itertools
+import threading
+from typing import Iterable
+
+import redis
+
+from common.idempotency import IDEMPOTENCY_TTL, PROCESSED_KEY_PREFIX
+
+# Users are stored as msgpack encoded UserValue maps ({"credit": int}), the script below reads
+# and writes them with the cmsgpack library bundled in Redis.
+
+# KEYS: the user charged by each reservation. ARGV: the idempotency record prefix and TTL, then
+# the event id ("" for none) and amount of each reservation.
+# Reservations are applied in order and never take a user below zero credit. Every user is read
+# once and written once at the end, so settling a batch of payments costs one round trip. The
+# status of each reservation with an event id is recorded under <prefix><event id>; an event id
+# seen before is not applied again and gets its recorded status.
+# Returns {statuses, credits, duplicates}: a status per reservation (0 reserved, 1 not enough
+# credit, -1 user does not exist), the user's credit after the batch (nil for missing users) and
+# 1 per reservation that was a duplicate, 0 otherwise.
+RESERVE_CREDIT_LUA = """
+local prefix = ARGV[1]
+local ttl = ARGV[2]
+local users = {}
+local changed = {}
+local statuses = {}
+local duplicates = {}
+for i, key in ipairs(KEYS) do
+    local user = users[key]
+    if user == nil then
+        local entry = redis.call('GET', key)
+        user = entry and cmsgpack.unpack(entry) or false
+        users[key] = user
+    end
+    local event_id = ARGV[1 + 2 * i]
+    local amount = tonumber(ARGV[2 + 2 * i])
+    local recorded = event_id ~= '' and redis.call('GET', prefix .. event_id)
+    if recorded then
+        statuses[i] = tonumber(recorded)
+    elseif not user then
+        statuses[i] = -1
+    elseif user.credit < amount then
+        statuses[i] = 1
+    else
+        user.credit = user.credit - amount
+        changed[key] = true
+        statuses[i] = 0
+    end
+    if event_id ~= '' and not recorded then
+        redis.call('SET', prefix .. event_id, statuses[i], 'EX', ttl)
+    end
+    duplicates[i] = recorded and 1 or 0
+end
+for key in pairs(changed) do
+    redis.call('SET', key, cmsgpack.pack(users[key]))
+end
+local credits = {}
+for i, key in ipairs(KEYS) do
+    credits[i] = users[key] and users[key].credit or false
+end
+return {statuses, credits, duplicates}
+"""
+
+NOT_FOUND = "not found"
+NOT_ENOUGH_CREDIT = "not enough credit"
+
+
+class PaymentStore:
+    def __init__(self, db: redis.Redis):
+        self.db = db
+        self._reserve_credit = db.register_script(RESERVE_CREDIT_LUA)
+        # reservations skipped as already applied, counted by all consumer threads
+        self.duplicates = 0
+        self._duplicates_lock = threading.Lock()
+
+    def reserve(self, reservations: Iterable[tuple[str, int]],
+                event_ids: Iterable[str | None] | None = None) -> tuple[list[str | None], dict[str, int]]:
+        # Atomically charges each (user_id, amount) in order. A reservation whose event id was
+        # already applied is not applied again, it gets the original outcome.
+        # Returns None or the failure reason per reservation, and the resulting credit per user.
+        user_ids: list[str] = []
+        args: list[int | str] = [PROCESSED_KEY_PREFIX, IDEMPOTENCY_TTL]
+        event_ids = itertools.repeat(None) if event_ids is None else event_ids
+        for (user_id, amount), event_id in zip(reservations, event_ids):
+            user_ids.append(user_id)
+            args.extend((event_id or "", int(amount)))
+        if not user_ids:
+            return [], {}
+        statuses, credits, duplicates = self._reserve_credit(keys=user_ids, args=args)
+        with self._duplicates_lock:
+            self.duplicates += sum(duplicates)
+        failures = [None if status == 0 else NOT_FOUND if status < 0 else NOT_ENOUGH_CREDIT
+                    for status in statuses]
+        return failures, {user_id: credit for user_id, credit in zip(user_ids, credits) if credit is not None}
+
+    def refund(self, refunds: Iterable[tuple[str, int]],
+               event_ids: Iterable[str | None] | None = None) -> list[str | None]:
+        # Gives charged credit back. Negative amounts always pass the script's credit check,
+        # so a refund only fails when the user no longer exists.
+        failures, _ = self.reserve(((user_id, -int(amount)) for user_id, amount in refunds), event_ids)
+        return failures
@@ -0,0 +1,41 @@
+import logging
+import os
+import threading
+
+from common.amqp import subscribe_fanout
+from common.lru import TTLCache
+from events.codec import EventDecodeError, EventDecoder
+from events.stock.item_price_changed_event import ItemPriceChanged
+
+logger = logging.getLogger(__name__)
+
+PRICE_CHANGES_EXCHANGE = "price_changes"
+PRICE_CACHE_SIZE = int(os.environ.get('PRICE_CACHE_SIZE', 10_000))
+PRICE_CACHE_TTL = float(os.environ.get('PRICE_CACHE_TTL', 60))
+
+_decoder = EventDecoder([ItemPriceChanged])
+_cache: TTLCache[str, int] | None = None
+_cache_pid: int | None = None
+_cache_lock = threading.Lock()
+
+
+def get_price_cache() -> TTLCache[str, int]:
+    # One item price cache per process. Its invalidation subscription starts on first use, so
+    # every gunicorn worker subscribes after the fork.
+    global _cache, _cache_pid
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            cache = TTLCache(maxsize=PRICE_CACHE_SIZE, ttl=PRICE_CACHE_TTL)
+
+            def on_price_changed(ch, method, properties, body: bytes):
+                try:
+                    event = _decoder.decode(body, properties)
+                except EventDecodeError as e:
+                    logger.warning(f"Ignoring message on {PRICE_CHANGES_EXCHANGE}: {e}")
+                    return
+                cache.invalidate(event.item_id)
+
+            # changes published while disconnected are missed, so start over after every reconnect
+            subscribe_fanout(PRICE_CHANGES_EXCHANGE, on_price_changed, on_connect=cache.clear)
+            _cache, _cache_pid = cache, os.getpid()
+        return _cache
@@ -0,0 +1,196 @@
+import os
+import time
+from typing import Iterable, NamedTuple
+
+import redis
+
+# Checkout saga state, kept in the order Redis next to the orders. Per order one small hash
+# saga:<order_id> with the number of replies still pending and one field per participant that
+# replied ("ok" or "failed"), plus one sorted set of running sagas scored by their deadline.
+# Sagas are started by the checkout script in common.outbox.
+#
+# The checkout also stores the events that may have to follow the saga, as the fields of their
+# outbox entries under then:<name>: the stock commit and the compensation of each participant,
+# fixed to what the checkout reserved.
+# The scripts that finish a saga set the order's statuses and append the follow-up events to the
+# outbox in the same atomic step, so they cannot get lost between recording a reply and publishing.
+
+SAGA_TIMEOUT = float(os.environ.get('SAGA_TIMEOUT', 30))
+SAGA_SWEEP_INTERVAL = float(os.environ.get('SAGA_SWEEP_INTERVAL', 1))
+SAGA_SWEEP_BATCH = 100
+# finished sagas are kept this long, so duplicate and late replies are still recognised
+SAGA_TTL = 60 * 60
+SAGA_KEY_PREFIX = "saga:"
+SAGA_DEADLINES_KEY = "saga:deadlines"
+# every saga and the deadline index, dropped by batch_init since it reuses order ids
+SAGA_STATE_PATTERNS = (f"{SAGA_KEY_PREFIX}*",)
+
+PARTICIPANTS = ("stock", "payment")
+OK = "ok"
+FAILED = "failed"
+
+# follow-up events
+COMMIT_STOCK = "commit_stock"
+RELEASE_STOCK = "release_stock"
+REFUND_PAYMENT = "refund_payment"
+FOLLOW_UP_PREFIX = "then:"
+
+# reply outcomes
+WAITING = "waiting"
+COMPLETE = "complete"
+DUPLICATE = "duplicate"
+LATE = "late"
+EXPIRED = "expired"
+UNKNOWN = "unknown"
+
+# Shared by the scripts below. finish sets the order's statuses, then appends the commit of an
+# approved saga or the compensations of the participants that succeeded in a rejected one.
+FINISH_SAGA_LUA = """
+local compensations = {stock = 'release_stock', payment = 'refund_payment'}
+local function follow_up(saga, outbox, name)
+    local field = 'then:' .. name
+    local event = redis.call('HMGET', saga, field, field .. ':body', field .. ':encoding', field .. ':trace')
+    if event[1] then
+        redis.call('XADD', outbox, '*', 'routing_key', event[1], 'body', event[2], 'content_encoding', event[3],
+                   'trace', event[4])
+    end
+end
+local function finish(saga, order, outbox, stock, payment)
+    if redis.call('EXISTS', order) == 1 then
+        redis.call('HSET', order, 'stock_status', stock == 'ok' and 'approved' or 'rejected',
+                   'payment_status', payment == 'ok' and 'approved' or 'rejected')
+    end
+    if stock == 'ok' and payment == 'ok' then
+        follow_up(saga, outbox, 'commit_stock')
+        return
+    end
+    if stock == 'ok' then
+        follow_up(saga, outbox, compensations.stock)
+    end
+    if payment == 'ok' then
+        follow_up(saga, outbox, compensations.payment)
+    end
+end
+"""
+
+# KEYS[1]: the saga hash, KEYS[2]: the deadline index, KEYS[3]: the order, KEYS[4]: the outbox.
+# ARGV: order id, participant, "ok" or "failed", ttl, now.
+# Records a participant's reply once and decrements the pending counter. The reply that brings it
+# to zero finishes the saga and gets every participant's reply back. A reply to a running saga
+# past its deadline times the saga out first, as the sweep would have, and returns "expired" with
+# the replies before it, so no saga is approved late. A success after the saga timed out has its
+# compensation appended right away.
+RECORD_REPLY_LUA = FINISH_SAGA_LUA + """
+local state = redis.call('HGET', KEYS[1], 'state')
+if not state then
+    return {'unknown'}
+end
+local expired
+if state == 'running' then
+    local deadline = redis.call('ZSCORE', KEYS[2], ARGV[1])
+    if deadline and tonumber(deadline) <= tonumber(ARGV[5]) then
+        state = 'timed_out'
+        redis.call('HSET', KEYS[1], 'state', state)
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        redis.call('ZREM', KEYS[2], ARGV[1])
+        local replies = redis.call('HMGET', KEYS[1], 'stock', 'payment')
+        finish(KEYS[1], KEYS[3], KEYS[4], replies[1], replies[2])
+        expired = {'expired', replies[1], replies[2]}
+    end
+end
+if redis.call('HSETNX', KEYS[1], ARGV[2], ARGV[3]) == 0 then
+    return expired or {'duplicate'}
+end
+if state ~= 'running' then
+    if ARGV[3] == 'ok' then
+        follow_up(KEYS[1], KEYS[4], compensations[ARGV[2]])
+    end
+    return expired or {'late'}
+end
+if redis.call('HINCRBY', KEYS[1], 'pending', -1) > 0 then
+    return {'waiting'}
+end
+redis.call('HSET', KEYS[1], 'state', 'done')
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('ZREM', KEYS[2], ARGV[1])
+local replies = redis.call('HMGET', KEYS[1], 'stock', 'payment')
+finish(KEYS[1], KEYS[3], KEYS[4], replies[1], replies[2])
+return {'complete', replies[1], replies[2]}
+"""
+
+# KEYS[1]: the deadline index, KEYS[2]: the outbox. ARGV: now, batch size, saga key prefix, ttl.
+# Takes up to batch size sagas past their deadline off the index, marks them timed out, finishes
+# them and returns them with the replies they got so far (false for no reply).
+EXPIRE_SAGAS_LUA = FINISH_SAGA_LUA + """
+local order_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local expired = {}
+for _, order_id in ipairs(order_ids) do
+    local key = ARGV[3] .. order_id
+    redis.call('ZREM', KEYS[1], order_id)
+    if redis.call('HGET', key, 'state') == 'running' then
+        redis.call('HSET', key, 'state', 'timed_out')
+        redis.call('EXPIRE', key, ARGV[4])
+        local replies = redis.call('HMGET', key, 'stock', 'payment')
+        finish(key, order_id, KEYS[2], replies[1], replies[2])
+        expired[#expired + 1] = {order_id, replies[1], replies[2]}
+    end
+end
+return expired
+"""
+
+
+class SagaReply(NamedTuple):
+    order_id: str
+    participant: str
+    ok: bool
+
+
+class SagaResult(NamedTuple):
+    # replies per participant: True ok, False failed, None no reply (timed out)
+    order_id: str
+    stock: bool | None
+    payment: bool | None
+
+    @property
+    def approved(self) -> bool:
+        return self.stock is True and self.payment is True
+
+
+def saga_key(order_id: str) -> str:
+    return f"{SAGA_KEY_PREFIX}{order_id}"
+
+
+def _reply(value: bytes | None) -> bool | None:
+    return None if value is None else value.decode() == OK
+
+
+class SagaStore:
+    # outbox is the stream the follow-up events are appended to
+    def __init__(self, db: redis.Redis, outbox: str):
+        self.db = db
+        self._outbox = outbox
+        self._record_reply = db.register_script(RECORD_REPLY_LUA)
+        self._expire_sagas = db.register_script(EXPIRE_SAGAS_LUA)
+
+    def record(self, replies: Iterable[SagaReply], now: float | None = None) -> list[tuple[str, SagaResult | None]]:
+        # One round trip for all replies. Returns the outcome per reply, with the saga's result
+        # for the reply that completed it or found it past its deadline.
+        replies = list(replies)
+        now = time.time() if now is None else now
+        pipe = self.db.pipeline(transaction=False)
+        for reply in replies:
+            self._record_reply(keys=[saga_key(reply.order_id), SAGA_DEADLINES_KEY, reply.order_id, self._outbox],
+                               args=[reply.order_id, reply.participant, OK if reply.ok else FAILED, SAGA_TTL, now],
+                               client=pipe)
+        outcomes = []
+        for reply, (outcome, *results) in zip(replies, pipe.execute()):
+            outcome = outcome.decode()
+            result = SagaResult(reply.order_id, *map(_reply, results)) if outcome in (COMPLETE, EXPIRED) else None
+            outcomes.append((outcome, result))
+        return outcomes
+
+    def expire_due(self, now: float | None = None, batch_size: int = SAGA_SWEEP_BATCH) -> list[SagaResult]:
+        expired = self._expire_sagas(keys=[SAGA_DEADLINES_KEY, self._outbox],
+                                     args=[time.time() if now is None else now, batch_size, SAGA_KEY_PREFIX, SAGA_TTL])
+        return [SagaResult(order_id.decode(), _reply(stock), _reply(payment))
+                for order_id, stock, payment in expired]
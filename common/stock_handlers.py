@@ -0,0 +1,112 @@
+import logging
+from collections.abc import Hashable
+
+import redis
+
+from common.amqp import EventPublisher
+from common.hot_items import HotItemTracker
+from common.stock_store import HOLD_NOT_FOUND, HOLD_RETAKEN, HOLD_SWEEP_BATCH, StockStore, first_shard
+from events.base_event import BaseEvent
+from events.registry import EventDispatcher
+from events.stock.commit_stock_event import CommitStockEvent
+from events.stock.release_stock_event import ReleaseStockEvent
+from events.stock.reserve_stock_event import ReserveStockEvent
+from events.stock.reserve_stock_failed_event import ReserveStockFailed
+from events.stock.reserve_stock_successful_event import ReserveStockSucessfull
+
+logger = logging.getLogger(__name__)
+
+
+def stock_reservation(event: ReserveStockEvent | ReleaseStockEvent) -> list[tuple[str, int]]:
+    return [(item.item_id, item.quantity) for item in event.stock_items]
+
+
+def hold_id(event: ReleaseStockEvent | CommitStockEvent) -> str:
+    # events published before holds were keyed by reservation id carry no hold_id, their hold is
+    # keyed by order id
+    return event.hold_id or event.order_id
+
+
+class StockHandlers:
+    # stock-consumer's handlers on any Redis client and publisher, registered on the dispatcher.
+    # With hot_item_shards, items under heavy reservation get split into that many sub-counters.
+    def __init__(self, db: redis.Redis, publisher: EventPublisher, dispatcher: EventDispatcher | None = None,
+                 hot_item_shards: int = 0):
+        self.store = StockStore(db)
+        self.hot_items = HotItemTracker(self.store, hot_item_shards) if hot_item_shards else None
+        self.publisher = publisher
+        self.dispatcher = EventDispatcher() if dispatcher is None else dispatcher
+        self.dispatcher.handler(ReserveStockEvent)(self.remove_stock)
+        self.dispatcher.batch_handler(ReserveStockEvent)(self.remove_stock_batch)
+        self.dispatcher.handler(ReleaseStockEvent)(self.release_stock)
+        self.dispatcher.batch_handler(ReleaseStockEvent)(self.release_stock_batch)
+        self.dispatcher.handler(CommitStockEvent)(self.commit_stock)
+        self.dispatcher.batch_handler(CommitStockEvent)(self.commit_stock_batch)
+
+    def lane_key(self, event: BaseEvent) -> Hashable:
+        # The consumer runtime's lane key. A reservation of a hot item goes to the lane after the
+        # item's by the sub-counter it starts at, so the reservations of one hot item run side by
+        # side in all lanes instead of queueing up in the item's lane. The reserve script is
+        # atomic whatever lane a reservation is in.
+        if isinstance(event, ReserveStockEvent):
+            for item_id in sorted(item.item_id for item in event.stock_items):
+                shards = self.store.shards(item_id)
+                if shards:
+                    return hash(item_id) + first_shard(event.event_id) % shards
+        return event.partition_key()
+
+    def remove_stock(self, event: ReserveStockEvent):
+        self.remove_stock_batch([event])
+
+    def remove_stock_batch(self, events: list[ReserveStockEvent]):
+        # the whole batch is checked and decremented by one atomic script call
+        # a redelivered event is not applied twice, it gets its first outcome and the reply is sent again
+        # the stock is held under the reservation's event id until its saga commits or releases it
+        reservations = [stock_reservation(event) for event in events]
+        event_ids = [event.event_id for event in events]
+        failures, _ = self.store.reserve(reservations, event_ids, event_ids)
+        if self.hot_items is not None:
+            self.hot_items.observe(reservations)
+        for event, failure in zip(events, failures):
+            if failure is not None:
+                logger.error(f"Stock item: {failure.item_id} {failure.reason} for order: {event.order_id}")
+                self.publisher.publish("order", ReserveStockFailed(
+                    order_id=event.order_id, reason=f"Stock item: {failure.item_id} {failure.reason}"),
+                    self.dispatcher.trace_headers(event))
+                continue
+            self.publisher.publish("order", ReserveStockSucessfull(order_id=event.order_id),
+                                   self.dispatcher.trace_headers(event))
+
+    def release_stock(self, event: ReleaseStockEvent):
+        self.release_stock_batch([event])
+
+    def release_stock_batch(self, events: list[ReleaseStockEvent]):
+        # gives back what the order's hold took, so a release of a hold that expired or was
+        # released before gives nothing back twice
+        for event, outcome in zip(events, self.store.release_holds([hold_id(event) for event in events])):
+            if outcome == HOLD_NOT_FOUND:
+                logger.warning(f"No stock hold of order: {event.order_id} to release")
+
+    def commit_stock(self, event: CommitStockEvent):
+        self.commit_stock_batch([event])
+
+    def commit_stock_batch(self, events: list[CommitStockEvent]):
+        for event, outcome in zip(events, self.store.commit_holds([hold_id(event) for event in events])):
+            if outcome == HOLD_RETAKEN:
+                # the reaper gave the stock back already and it was taken again, an item's stock
+                # below zero shows the approved order oversold it
+                logger.error(f"Stock hold of order: {event.order_id} expired before it was committed, "
+                             f"its stock was taken again")
+            elif outcome == HOLD_NOT_FOUND:
+                logger.warning(f"No stock hold of order: {event.order_id} to commit")
+
+    def expire_holds(self) -> int:
+        # holds past their expiry are taken off the index in batches and released
+        count = 0
+        while True:
+            expired = self.store.expire_holds()
+            count += len(expired)
+            if expired:
+                logger.warning(f"Released {len(expired)} expired stock holds")
+            if len(expired) < HOLD_SWEEP_BATCH:
+                return count
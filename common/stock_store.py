@@ -0,0 +1,509 @@
+import itertools
+import os
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from typing import Iterable, NamedTuple
+
+import redis
+from msgspec import msgpack
+
+from common.idempotency import IDEMPOTENCY_TTL, PROCESSED_KEY_PREFIX
+
+# Stock items are stored as msgpack encoded StockValue maps ({"stock": int, "price": int}),
+# the scripts below read and write them with the cmsgpack library bundled in Redis.
+#
+# Hot items have their stock split over n sub-counters, plain integers under
+# <item_id>:shard:<k> for k in 0..n-1, and "shards": n in their map. The map's own stock then
+# only holds what is left after promotion or added later, an item's available stock is that plus
+# all its sub-counters.
+#
+# Reservations made for an order are held: the stock is taken at once, and a hold
+# hold:<reservation event id> records what was taken, indexed in the stock:holds sorted set by
+# the time it expires. Committing the hold keeps the stock taken, releasing it gives the stock
+# back. Holds nobody finalized in time are released by the reaper, oldest first, so stock of a
+# saga that got lost is not leaked. A commit that arrives after that takes the stock again. Item
+# stock is always what is left to reserve, reading it needs no holds.
+
+# KEYS: the m items touched by the reservations, then the sub-counters of each of them that the
+# caller takes to be hot, in item order.
+# ARGV: the idempotency record prefix and TTL, the hold prefix, the hold index, the time new holds
+# expire and m, then per item its number of sub-counters in KEYS (0 for none), then for each
+# reservation its event id and hold id ("" for none), its starting sub-counter s and number of
+# items n, followed by n (index into KEYS, quantity) pairs.
+# When an item has a different number of sub-counters than the caller passed, nothing is done and
+# the actual numbers are returned, the caller then calls again with the right keys.
+# Reservations are applied in order, each one all or nothing. Every key is read once and the keys
+# that changed are written once at the end, so a batch costs one round trip however many orders
+# hit the same item. A reservation of a hot item with n sub-counters starts at sub-counter s % n
+# and only reads the following ones (and then the item's own stock) when that one runs dry;
+# releases go to the starting sub-counter. The status of each reservation with an event id is
+# recorded under <prefix><event id>; an event id seen before is not applied again and gets its
+# recorded status. A reservation with a hold id that was applied adds its quantities to that hold.
+# Returns {statuses, stocks, duplicates, stale}: a status per reservation (0 reserved, i when
+# KEYS[i] has not enough stock, -i when KEYS[i] does not exist), the final stock per item (nil for
+# missing and hot items), 1 per reservation that was a duplicate, 0 otherwise, and the (index,
+# sub-counters) pairs of the items the caller got wrong, flattened.
+RESERVE_STOCK_LUA = """
+local items = tonumber(ARGV[6])
+local values = {}
+-- position in KEYS before the first sub-counter of each item
+local shard_keys = {}
+local stale = {}
+local next_shard_key = items
+for i = 1, items do
+    local entry = redis.call('GET', KEYS[i])
+    local shards = 0
+    if entry then
+        values[i] = cmsgpack.unpack(entry)
+        shards = values[i].shards or 0
+    end
+    if shards ~= tonumber(ARGV[6 + i]) then
+        stale[#stale + 1] = i
+        stale[#stale + 1] = shards
+    end
+    shard_keys[i] = next_shard_key
+    next_shard_key = next_shard_key + tonumber(ARGV[6 + i])
+end
+if #stale > 0 then
+    return {{}, {}, {}, stale}
+end
+-- sub-counter values read so far and the ones changed, per key index
+local shards = {}
+local shards_changed = {}
+local function shard(index, k)
+    local cache = shards[index]
+    if cache == nil then
+        cache = {}
+        shards[index] = cache
+    end
+    if cache[k] == nil then
+        cache[k] = tonumber(redis.call('GET', KEYS[shard_keys[index] + k + 1]) or '0')
+    end
+    return cache[k]
+end
+local function set_shard(index, k, value)
+    shards[index][k] = value
+    shards_changed[index] = shards_changed[index] or {}
+    shards_changed[index][k] = true
+end
+local function available(index, quantity, first)
+    local value = values[index]
+    if not value.shards then
+        return value.stock >= quantity
+    end
+    local total = shard(index, first)
+    local k = first
+    for _ = 2, value.shards do
+        if total >= quantity then
+            return true
+        end
+        k = (k + 1) % value.shards
+        total = total + shard(index, k)
+    end
+    return total + value.stock >= quantity
+end
+local changed = {}
+local function take(index, quantity, first)
+    local value = values[index]
+    if value.shards then
+        if quantity < 0 then
+            set_shard(index, first, shard(index, first) - quantity)
+            return
+        end
+        local k = first
+        for _ = 1, value.shards do
+            local n = math.min(shard(index, k), quantity)
+            if n > 0 then
+                set_shard(index, k, shards[index][k] - n)
+                quantity = quantity - n
+            end
+            if quantity == 0 then
+                return
+            end
+            k = (k + 1) % value.shards
+        end
+    end
+    value.stock = value.stock - quantity
+    changed[index] = true
+end
+local prefix = ARGV[1]
+local ttl = ARGV[2]
+local hold_prefix = ARGV[3]
+local statuses = {}
+local duplicates = {}
+local pos = 7 + items
+while pos <= #ARGV do
+    local event_id = ARGV[pos]
+    local hold_id = ARGV[pos + 1]
+    local first = tonumber(ARGV[pos + 2])
+    local n = tonumber(ARGV[pos + 3])
+    -- the (index into KEYS, quantity) pairs start at ARGV[pairs_at]
+    local pairs_at = pos + 4
+    local recorded = event_id ~= '' and redis.call('GET', prefix .. event_id)
+    local status = 0
+    if recorded and recorded ~= '0' then
+        -- recorded as "<sign><item>", mapped back to the item's index in this call
+        local sign = string.sub(recorded, 1, 1) == '-' and -1 or 1
+        local item = string.sub(recorded, 2)
+        for j = 0, n - 1 do
+            local index = tonumber(ARGV[pairs_at + 2 * j])
+            if KEYS[index] == item then
+                status = sign * index
+            end
+        end
+    elseif not recorded then
+        for j = 0, n - 1 do
+            local index = tonumber(ARGV[pairs_at + 2 * j])
+            local quantity = tonumber(ARGV[pairs_at + 1 + 2 * j])
+            if values[index] == nil then
+                status = -index
+                break
+            end
+            if not available(index, quantity, values[index].shards and first % values[index].shards) then
+                status = index
+                break
+            end
+        end
+        if status == 0 then
+            for j = 0, n - 1 do
+                local index = tonumber(ARGV[pairs_at + 2 * j])
+                take(index, tonumber(ARGV[pairs_at + 1 + 2 * j]), values[index].shards and first % values[index].shards)
+            end
+            if hold_id ~= '' then
+                -- flat list of item, quantity; a second reservation for the same hold is appended
+                local held = redis.call('GET', hold_prefix .. hold_id)
+                held = held and cmsgpack.unpack(held) or {}
+                for j = 0, n - 1 do
+                    held[#held + 1] = KEYS[tonumber(ARGV[pairs_at + 2 * j])]
+                    held[#held + 1] = tonumber(ARGV[pairs_at + 1 + 2 * j])
+                end
+                redis.call('SET', hold_prefix .. hold_id, cmsgpack.pack(held))
+                redis.call('ZADD', ARGV[4], ARGV[5], hold_id)
+            end
+        end
+        if event_id ~= '' then
+            local record = status == 0 and '0' or ((status < 0 and '-' or '+') .. KEYS[math.abs(status)])
+            redis.call('SET', prefix .. event_id, record, 'EX', ttl)
+        end
+    end
+    statuses[#statuses + 1] = status
+    duplicates[#duplicates + 1] = recorded and 1 or 0
+    pos = pairs_at + 2 * n
+end
+for index in pairs(changed) do
+    redis.call('SET', KEYS[index], cmsgpack.pack(values[index]))
+end
+for index, ks in pairs(shards_changed) do
+    for k in pairs(ks) do
+        redis.call('SET', KEYS[shard_keys[index] + k + 1], string.format('%d', shards[index][k]))
+    end
+end
+local stocks = {}
+for i = 1, items do
+    stocks[i] = values[i] ~= nil and not values[i].shards and values[i].stock or false
+end
+return {statuses, stocks, duplicates, {}}
+"""
+
+# KEYS[1]: the hold index. ARGV: the hold prefix, how long finalized holds are remembered and
+# "commit" or "release" followed by hold ids, or "expire", now and a batch size to release up to
+# that many holds that expired by now.
+# Finalizing deletes the hold and remembers the outcome under <hold>:done, "committed" or what a
+# release gave back. Releasing adds the hold's quantities back to the items' own stock. A commit
+# of a hold that was released or expired already takes those quantities again, even below zero,
+# because its order was approved. Each item is written once. Returns per hold id 1 when it was
+# finalized, 2 when a commit took released stock again or 0 when there was nothing to do, or the
+# expired hold ids.
+HOLDS_LUA = """
+local prefix = ARGV[1]
+local ttl = ARGV[2]
+local action = ARGV[3]
+local hold_ids = {}
+if action == 'expire' then
+    hold_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[4], 'LIMIT', 0, tonumber(ARGV[5]))
+    action = 'release'
+else
+    for i = 4, #ARGV do
+        hold_ids[#hold_ids + 1] = ARGV[i]
+    end
+end
+local results = {}
+local deltas = {}
+local function apply(held, sign)
+    held = cmsgpack.unpack(held)
+    for j = 1, #held, 2 do
+        deltas[held[j]] = (deltas[held[j]] or 0) + sign * held[j + 1]
+    end
+end
+for i, hold_id in ipairs(hold_ids) do
+    local key = prefix .. hold_id
+    local held = redis.call('GET', key)
+    results[i] = 0
+    if held then
+        if action == 'release' then
+            apply(held, 1)
+        end
+        redis.call('DEL', key)
+        redis.call('SET', key .. ':done', action == 'release' and held or 'committed', 'EX', ttl)
+        results[i] = 1
+    elseif action == 'commit' then
+        local done = redis.call('GET', key .. ':done')
+        if done and done ~= 'committed' then
+            apply(done, -1)
+            redis.call('SET', key .. ':done', 'committed', 'EX', ttl)
+            results[i] = 2
+        end
+    end
+    redis.call('ZREM', KEYS[1], hold_id)
+end
+for item_id, quantity in pairs(deltas) do
+    local entry = redis.call('GET', item_id)
+    if entry and quantity ~= 0 then
+        local value = cmsgpack.unpack(entry)
+        value.stock = value.stock + quantity
+        redis.call('SET', item_id, cmsgpack.pack(value))
+    end
+end
+if ARGV[3] == 'expire' then
+    return hold_ids
+end
+return results
+"""
+
+# KEYS[1]: the item, KEYS[2]: the set of hot items, then the n sub-counters to create.
+# Moves the item's stock into the sub-counters, evenly with the remainder on the first.
+# Returns 0 when the item does not exist, 1 otherwise (also when it was hot already).
+PROMOTE_LUA = """
+local entry = redis.call('GET', KEYS[1])
+if not entry then
+    return 0
+end
+local value = cmsgpack.unpack(entry)
+if value.shards then
+    return 1
+end
+local n = #KEYS - 2
+local share = math.floor(value.stock / n)
+for k = 0, n - 1 do
+    redis.call('SET', KEYS[3 + k], string.format('%d', k == 0 and value.stock - share * (n - 1) or share))
+end
+value.stock = 0
+value.shards = n
+redis.call('SET', KEYS[1], cmsgpack.pack(value))
+redis.call('SADD', KEYS[2], KEYS[1])
+return 1
+"""
+
+# KEYS[1]: the item, KEYS[2]: the set of hot items, then the item's sub-counters. Adds the
+# sub-counters back into the item's stock and deletes them. Returns 0 when the item does not
+# exist, 1 otherwise, or -1 without doing anything when the item has a different number of
+# sub-counters.
+DEMOTE_LUA = """
+local entry = redis.call('GET', KEYS[1])
+local value = entry and cmsgpack.unpack(entry)
+if value and (value.shards or 0) ~= #KEYS - 2 then
+    return -1
+end
+redis.call('SREM', KEYS[2], KEYS[1])
+if not value then
+    return 0
+end
+if not value.shards then
+    return 1
+end
+for k = 0, value.shards - 1 do
+    value.stock = value.stock + tonumber(redis.call('GET', KEYS[3 + k]) or '0')
+    redis.call('DEL', KEYS[3 + k])
+end
+value.shards = nil
+redis.call('SET', KEYS[1], cmsgpack.pack(value))
+return 1
+"""
+
+# KEYS[1]: the item, ARGV[1]: its new price. Returns 0 when the item does not exist.
+SET_PRICE_LUA = """
+local entry = redis.call('GET', KEYS[1])
+if not entry then
+    return 0
+end
+local value = cmsgpack.unpack(entry)
+value.price = tonumber(ARGV[1])
+redis.call('SET', KEYS[1], cmsgpack.pack(value))
+return 1
+"""
+
+
+class ReservationFailure(NamedTuple):
+    item_id: str
+    reason: str
+
+
+NOT_FOUND = "not found"
+NOT_ENOUGH_STOCK = "not enough stock"
+
+HOT_ITEMS_KEY = "stock:hot"
+# per window reservation counts of common.hot_items
+HITS_KEY_PREFIX = "stock:hits:"
+
+# Holds are released when not committed within STOCK_HOLD_TTL seconds, which has to be well
+# above the saga timeout. Every STOCK_HOLD_SWEEP_INTERVAL seconds stock-consumer releases expired
+# holds in batches of HOLD_SWEEP_BATCH.
+STOCK_HOLD_TTL = float(os.environ.get('STOCK_HOLD_TTL', 300))
+STOCK_HOLD_SWEEP_INTERVAL = float(os.environ.get('STOCK_HOLD_SWEEP_INTERVAL', 1))
+HOLD_SWEEP_BATCH = 1000
+HOLD_KEY_PREFIX = "hold:"
+HOLDS_KEY = "stock:holds"
+
+# what the stock Redis keeps besides the items, dropped by batch_init since it reuses item ids
+STOCK_STATE_PATTERNS = (f"{HOLD_KEY_PREFIX}*", HOLDS_KEY, HOT_ITEMS_KEY, f"{HITS_KEY_PREFIX}*", "*:shard:*")
+
+# outcomes of finalizing a hold
+HOLD_NOT_FOUND = 0
+HOLD_FINALIZED = 1
+HOLD_RETAKEN = 2
+
+# calls with the sub-counters of the last reply before giving up on items being promoted and
+# demoted all the time
+RESERVE_ATTEMPTS = 3
+
+
+def shard_key(item_id: str, k: int) -> str:
+    return f"{item_id}:shard:{k}"
+
+
+def first_shard(event_id: str | None) -> int:
+    # the sub-counter a reservation of a hot item starts at is s % n: stable per event, so the
+    # consumer's lanes can be picked by it, and random for reservations without an event id
+    return zlib.crc32(event_id.encode()) if event_id else random.randrange(1 << 30)
+
+
+class StockStore:
+    def __init__(self, db: redis.Redis):
+        self.db = db
+        self._reserve_stock = db.register_script(RESERVE_STOCK_LUA)
+        self._set_price = db.register_script(SET_PRICE_LUA)
+        self._promote = db.register_script(PROMOTE_LUA)
+        self._demote = db.register_script(DEMOTE_LUA)
+        self._holds = db.register_script(HOLDS_LUA)
+        # reservations skipped as already applied, counted by all consumer threads
+        self.duplicates = 0
+        self._duplicates_lock = threading.Lock()
+        # sub-counters per hot item, learned from the reserve script whenever a call got them wrong
+        self._shards: dict[str, int] = {}
+
+    def set_price(self, item_id: str, price: int) -> bool:
+        # in place, so it cannot undo a reservation running at the same time
+        return self._set_price(keys=[item_id], args=[int(price)]) == 1
+
+    def reserve(self, reservations: Iterable[Iterable[tuple[str, int]]],
+                event_ids: Iterable[str | None] | None = None, hold_ids: Iterable[str | None] | None = None,
+                hold_ttl: float = STOCK_HOLD_TTL) \
+            -> tuple[list[ReservationFailure | None], dict[str, int]]:
+        # Atomically reserves each list of (item_id, quantity), all or nothing per list. A
+        # reservation whose event id was already applied is not applied again, it gets the
+        # original outcome. With a hold id the reservation is held for hold_ttl seconds. Returns
+        # None or the failure per reservation, and the resulting stock per item that is not hot.
+        keys: dict[str, int] = {}
+        calls: list[tuple[str, str, int, Counter]] = []
+        event_ids = itertools.repeat(None) if event_ids is None else event_ids
+        hold_ids = itertools.repeat(None) if hold_ids is None else hold_ids
+        for reservation, event_id, hold_id in zip(reservations, event_ids, hold_ids):
+            quantities = Counter()
+            for item_id, quantity in reservation:
+                quantities[item_id] += int(quantity)
+                keys.setdefault(item_id, len(keys) + 1)
+            calls.append((event_id or "", hold_id or "", first_shard(event_id), quantities))
+        if not calls:
+            return [], {}
+        item_ids = list(keys)
+        for _ in range(RESERVE_ATTEMPTS):
+            # the sub-counters of the items known to be hot are passed after the items
+            shards = [self._shards.get(item_id, 0) for item_id in item_ids]
+            args: list[int | str | float] = [PROCESSED_KEY_PREFIX, IDEMPOTENCY_TTL, HOLD_KEY_PREFIX, HOLDS_KEY,
+                                             time.time() + hold_ttl, len(item_ids), *shards]
+            for event_id, hold_id, first, quantities in calls:
+                args.extend((event_id, hold_id, first, len(quantities)))
+                for item_id, quantity in quantities.items():
+                    args.extend((keys[item_id], quantity))
+            statuses, stocks, duplicates, stale = self._reserve_stock(
+                keys=item_ids + [shard_key(item_id, k) for item_id, n in zip(item_ids, shards) for k in range(n)],
+                args=args)
+            if not stale:
+                break
+            for index, n in zip(stale[::2], stale[1::2]):
+                self._learn(item_ids[index - 1], n)
+        else:
+            raise redis.exceptions.RedisError(f"Hot items of the reservation kept changing: {item_ids}")
+        with self._duplicates_lock:
+            self.duplicates += sum(duplicates)
+        failures = [None if status == 0 else
+                    ReservationFailure(item_ids[abs(status) - 1], NOT_FOUND if status < 0 else NOT_ENOUGH_STOCK)
+                    for status in statuses]
+        return failures, {item_id: stock for item_id, stock in zip(item_ids, stocks) if stock is not None}
+
+    def release(self, releases: Iterable[Iterable[tuple[str, int]]],
+                event_ids: Iterable[str | None] | None = None) -> list[ReservationFailure | None]:
+        # Gives reserved stock back. Negative quantities always pass the script's stock check,
+        # so a release only fails when an item no longer exists.
+        failures, _ = self.reserve(([(item_id, -int(quantity)) for item_id, quantity in release]
+                                    for release in releases), event_ids)
+        return failures
+
+    def commit_holds(self, hold_ids: list[str]) -> list[int]:
+        # keeps the held stock taken. HOLD_RETAKEN for holds that were released or expired, whose
+        # stock is taken again, HOLD_NOT_FOUND for holds committed already or never made.
+        if not hold_ids:
+            return []
+        return self._holds(keys=[HOLDS_KEY], args=[HOLD_KEY_PREFIX, IDEMPOTENCY_TTL, "commit", *hold_ids])
+
+    def release_holds(self, hold_ids: list[str]) -> list[int]:
+        # gives the held stock back, HOLD_NOT_FOUND for holds that were finalized or expired already
+        if not hold_ids:
+            return []
+        return self._holds(keys=[HOLDS_KEY], args=[HOLD_KEY_PREFIX, IDEMPOTENCY_TTL, "release", *hold_ids])
+
+    def expire_holds(self, now: float | None = None, batch_size: int = HOLD_SWEEP_BATCH) -> list[str]:
+        # releases up to batch_size holds past their expiry, returns their ids
+        expired = self._holds(keys=[HOLDS_KEY], args=[HOLD_KEY_PREFIX, IDEMPOTENCY_TTL, "expire",
+                                                      time.time() if now is None else now, batch_size])
+        return [hold_id.decode() for hold_id in expired]
+
+    def promote(self, item_id: str, shards: int) -> bool:
+        return self._promote(keys=[item_id, HOT_ITEMS_KEY, *(shard_key(item_id, k) for k in range(int(shards)))]) == 1
+
+    def demote(self, item_id: str) -> bool:
+        for _ in range(RESERVE_ATTEMPTS):
+            entry = self.db.get(item_id)
+            shards = msgpack.decode(entry).get("shards", 0) if entry else 0
+            result = self._demote(keys=[item_id, HOT_ITEMS_KEY, *(shard_key(item_id, k) for k in range(shards))])
+            if result >= 0:
+                self._learn(item_id, 0)
+                return result == 1
+        raise redis.exceptions.RedisError(f"Sub-counters of item: {item_id} kept changing")
+
+    def shards(self, item_id: str) -> int:
+        # the number of sub-counters of the item as last seen by this store, 0 when not hot
+        return self._shards.get(item_id, 0)
+
+    def _learn(self, item_id: str, shards: int):
+        if shards:
+            self._shards[item_id] = shards
+        else:
+            self._shards.pop(item_id, None)
+
+    def hot_items(self) -> set[str]:
+        return {item_id.decode() for item_id in self.db.smembers(HOT_ITEMS_KEY)}
+
+    def shard_stock(self, item_id: str, shards: int) -> int:
+        # the stock in a hot item's sub-counters
+        return self.shard_stocks([(item_id, shards)])[item_id]
+
+    def shard_stocks(self, items: list[tuple[str, int]]) -> dict[str, int]:
+        # shard_stock of each (item_id, shards) with one MGET
+        keys = [shard_key(item_id, k) for item_id, shards in items for k in range(shards)]
+        values = iter(self.db.mget(keys) if keys else [])
+        return {item_id: sum(int(value) for value in itertools.islice(values, shards) if value)
+                for item_id, shards in items}
@@ -0,0 +1,109 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from common.metrics import METRICS_PORT, serve_metrics
+from common.partitioning import QUEUE_PARTITIONS
+
+# Runs one consumer process per queue partition and restarts the ones that exit:
+#   python -m common.supervisor consumer.py
+# OWNED_PARTITIONS (e.g. "0-3" or "0,2,5", default all) limits this supervisor to a subset, so
+# the partitions can be spread over several containers or nodes. The supervisor serves the merged
+# metrics of its workers on METRICS_PORT.
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.5
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30
+# a worker that ran this long before exiting is restarted without backoff
+STABLE_AFTER = 30
+STOP_TIMEOUT = 10
+
+
+def parse_partitions(spec: str, partitions: int) -> list[int]:
+    if not spec:
+        return list(range(partitions))
+    owned: set[int] = set()
+    for part in spec.split(","):
+        first, _, last = part.strip().partition("-")
+        owned.update(range(int(first), int(last or first) + 1))
+    invalid = [partition for partition in owned if not 0 <= partition < partitions]
+    if invalid:
+        raise ValueError(f"Partitions {sorted(invalid)} outside of 0-{partitions - 1}")
+    return sorted(owned)
+
+
+class _Worker:
+    def __init__(self, partition: int):
+        self.partition = partition
+        self.process: subprocess.Popen | None = None
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.restart_delay = RESTART_DELAY
+
+
+class Supervisor:
+    def __init__(self, argv: list[str], partitions: list[int]):
+        self.argv = argv
+        self.workers = [_Worker(partition) for partition in partitions]
+        self.stopping = False
+
+    def start(self, worker: _Worker):
+        env = dict(os.environ, PARTITION=str(worker.partition))
+        worker.process = subprocess.Popen([sys.executable, *self.argv], env=env)
+        worker.started_at = time.monotonic()
+        logger.info(f"Started partition {worker.partition} as pid {worker.process.pid}")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker in self.workers:
+            self.start(worker)
+        while not self.stopping:
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process is None:
+                    if now >= worker.restart_at:
+                        self.start(worker)
+                    continue
+                code = worker.process.poll()
+                if code is None:
+                    continue
+                if now - worker.started_at >= STABLE_AFTER:
+                    worker.restart_delay = RESTART_DELAY
+                logger.warning(f"Partition {worker.partition} exited with {code}, "
+                               f"restarting in {worker.restart_delay}s")
+                worker.process = None
+                worker.restart_at = now + worker.restart_delay
+                worker.restart_delay = min(worker.restart_delay * 2, MAX_RESTART_DELAY)
+            time.sleep(POLL_INTERVAL)
+        self.shutdown()
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def shutdown(self):
+        running = [worker.process for worker in self.workers if worker.process is not None]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in running:
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit("usage: python -m common.supervisor <consumer script> [args...]")
+    owned = parse_partitions(os.environ.get('OWNED_PARTITIONS', ''), QUEUE_PARTITIONS)
+    logger.info(f"Supervising partitions {owned} of {QUEUE_PARTITIONS}")
+    serve_metrics()
+    logger.info(f"Serving metrics on port {METRICS_PORT}")
+    Supervisor(sys.argv[1:], owned).run()
@@ -0,0 +1,115 @@
+import os
+import time
+import uuid
+
+import msgspec
+
+from common.metrics import histogram
+from events.tracing import Hop, Trace
+
+# Checkout traces, kept in the order Redis. Per order one hash trace:<order_id>, written by the
+# checkout script (trace_id, started_at) and by order-consumer (one hop:<event name> field per
+# message the checkout caused, finished_at and outcome once the saga ended). For percentiles
+# over all checkouts, every span is also pushed onto a capped list trace:samples:<span>, and the
+# span names are kept in the set trace:spans.
+TRACE_TTL = int(os.environ.get('TRACE_TTL', 24 * 60 * 60))
+TRACE_SAMPLE_SIZE = int(os.environ.get('TRACE_SAMPLE_SIZE', 10000))
+TRACE_KEY_PREFIX = "trace:"
+TRACE_SAMPLES_PREFIX = "trace:samples:"
+TRACE_SPANS_KEY = "trace:spans"
+PERCENTILES = (50, 90, 95, 99)
+
+# spans: "<event name>:<phase>" with phase outbox (checkout until published, first hops only),
+# queue (published until received) or handler (received until handled), and "checkout" for the
+# whole checkout until its saga ended
+CHECKOUT_SPAN = "checkout"
+
+HOP_SECONDS = histogram("checkout_hop_seconds", "Time a checkout message spent in one phase of a hop",
+                        ("hop", "phase"))
+CHECKOUT_SECONDS = histogram("checkout_seconds", "Time from checkout until its saga ended", ("outcome",))
+
+_hop_encoder = msgspec.json.Encoder()
+_hop_decoder = msgspec.json.Decoder(Hop)
+
+
+def trace_key(order_id: str) -> str:
+    return f"{TRACE_KEY_PREFIX}{order_id}"
+
+
+def new_trace() -> Trace:
+    return Trace(trace_id=uuid.uuid4().hex, started_at=time.time())
+
+
+def hop_spans(hop: Hop, started_at: float, first: bool) -> list[tuple[str, str, float]]:
+    spans = [(hop.name, "queue", hop.dequeued_at - hop.enqueued_at), (hop.name, "handler", hop.done_at - hop.dequeued_at)]
+    if first:
+        spans.append((hop.name, "outbox", hop.enqueued_at - started_at))
+    return spans
+
+
+def _queue_sample(pipe, span: str, seconds: float):
+    pipe.sadd(TRACE_SPANS_KEY, span)
+    pipe.lpush(f"{TRACE_SAMPLES_PREFIX}{span}", seconds)
+    pipe.ltrim(f"{TRACE_SAMPLES_PREFIX}{span}", 0, TRACE_SAMPLE_SIZE - 1)
+
+
+def queue_record_hops(pipe, order_id: str, trace: Trace, hops: list[Hop]):
+    # hops of one path through the checkout, the first one is the message published by the outbox
+    key = trace_key(order_id)
+    pipe.hset(key, mapping={f"hop:{hop.name}": _hop_encoder.encode(hop) for hop in hops})
+    pipe.expire(key, TRACE_TTL)
+    for i, hop in enumerate(hops):
+        for name, phase, seconds in hop_spans(hop, trace.started_at, i == 0):
+            HOP_SECONDS.labels(name, phase).observe(seconds)
+            _queue_sample(pipe, f"{name}:{phase}", seconds)
+
+
+def queue_record_finish(pipe, order_id: str, started_at: float, outcome: str, finished_at: float | None = None):
+    finished_at = time.time() if finished_at is None else finished_at
+    pipe.hset(trace_key(order_id), mapping={"finished_at": finished_at, "outcome": outcome})
+    CHECKOUT_SECONDS.labels(outcome).observe(finished_at - started_at)
+    _queue_sample(pipe, CHECKOUT_SPAN, finished_at - started_at)
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+def trace_to_json(order_id: str, fields: dict[bytes, bytes]) -> dict:
+    # the per hop breakdown of one checkout, in milliseconds
+    fields = {name.decode(): value for name, value in fields.items()}
+    started_at = float(fields["started_at"])
+    hops = sorted((_hop_decoder.decode(value) for name, value in fields.items() if name.startswith("hop:")),
+                  key=lambda hop: hop.enqueued_at)
+    return {
+        "order_id": order_id,
+        "trace_id": fields["trace_id"].decode(),
+        "started_at": started_at,
+        "outcome": fields["outcome"].decode() if "outcome" in fields else None,
+        "total_ms": _ms(float(fields["finished_at"]) - started_at) if "finished_at" in fields else None,
+        "hops": [{
+            "event": hop.name,
+            "published_ms": _ms(hop.enqueued_at - started_at),
+            "queue_ms": _ms(hop.dequeued_at - hop.enqueued_at),
+            "handler_ms": _ms(hop.done_at - hop.dequeued_at),
+        } for hop in hops],
+    }
+
+
+def percentiles(samples: list[bytes]) -> dict:
+    values = sorted(float(sample) for sample in samples)
+    if not values:
+        return {"count": 0}
+    stats = {"count": len(values), "max_ms": _ms(values[-1])}
+    for p in PERCENTILES:
+        stats[f"p{p}_ms"] = _ms(values[min(len(values) - 1, len(values) * p // 100)])
+    return stats
+
+
+def queue_sample_reads(pipe, spans: list[bytes]):
+    for span in spans:
+        pipe.lrange(f"{TRACE_SAMPLES_PREFIX}{span.decode()}", 0, -1)
+
+
+def span_stats(spans: list[bytes], samples: list[list[bytes]]) -> dict:
+    return {span.decode(): percentiles(values) for span, values in sorted(zip(spans, samples))}
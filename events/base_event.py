@@ -1,20 +1,14 @@
 
-from abc import ABC
-import ast
+import uuid
 from typing import ClassVar
-from pydantic import BaseModel
+from msgspec import Struct, field
 
-class BaseEvent(ABC, BaseModel):
+class BaseEvent(Struct, tag_field="name", kw_only=True):
+    # set from the struct tag by events.registry.register_event
     name: ClassVar[str]
+    # unique per event and kept across redeliveries, consumers use it to skip events already applied
+    event_id: str = field(default_factory=lambda: uuid.uuid4().hex)
 
-    def to_message_queue_body(self):
-        body = self.model_dump()
-        body['name'] = self.name
-        return str(body)
-    
-    @classmethod
-    def from_db(cls, entry):
-        return cls(**ast.literal_eval(entry.decode("utf-8")))
-    
-    def to_db_entry(self):
-        return str(self.model_dump())
\ No newline at end of file
+    def partition_key(self) -> str:
+        # key that picks the queue partition, see common.partitioning
+        raise NotImplementedError
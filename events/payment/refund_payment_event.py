@@ -0,0 +1,12 @@
+from events.base_event import BaseEvent
+from events.registry import register_event
+
+# compensation: gives back the credit charged for an order whose saga was rejected
+@register_event
+class RefundPaymentEvent(BaseEvent, tag='refund payment'):
+    amount: float
+    user_id: str
+    order_id: str
+
+    def partition_key(self) -> str:
+        return self.user_id
@@ -1,8 +1,11 @@
-from typing import ClassVar
 from events.base_event import BaseEvent
+from events.registry import register_event
 
-class ReservePaymentEvent(BaseEvent):
-    name: ClassVar[str] = 'Reserve payment'
+@register_event
+class ReservePaymentEvent(BaseEvent, tag='Reserve payment'):
     amount: float
     user_id: str
-    order_id: str
\ No newline at end of file
+    order_id: str
+
+    def partition_key(self) -> str:
+        return self.user_id
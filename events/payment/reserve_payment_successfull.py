@@ -1,7 +1,10 @@
 
 from events.base_event import BaseEvent
-from typing import ClassVar
+from events.registry import register_event
 
-class ReservePaymentSucessfull(BaseEvent):
-    name: ClassVar[str] = 'reserve payment successfull'
-    order_id: str
\ No newline at end of file
+@register_event
+class ReservePaymentSucessfull(BaseEvent, tag='reserve payment successfull'):
+    order_id: str
+
+    def partition_key(self) -> str:
+        return self.order_id
@@ -0,0 +1,133 @@
+import threading
+import time
+from typing import Callable, Protocol, TypeVar
+
+from events.base_event import BaseEvent
+from events.codec import EventDecoder
+from events.retry import RetryPolicy
+from events.tracing import Delivery, received, trace_headers
+
+E = TypeVar("E", bound=type[BaseEvent])
+
+# event name (the msgpack "name" tag) -> event class
+EVENT_TYPES: dict[str, type[BaseEvent]] = {}
+
+
+def register_event(cls: E) -> E:
+    name = cls.__struct_config__.tag
+    if name in EVENT_TYPES and EVENT_TYPES[name] is not cls:
+        raise ValueError(f"Event name {name!r} is already registered to {EVENT_TYPES[name].__name__}")
+    cls.name = name
+    EVENT_TYPES[name] = cls
+    return cls
+
+
+class RecentEvents(Protocol):
+    def get(self, event_id: str) -> bool | None: ...
+
+    def put(self, event_id: str, handled: bool): ...
+
+
+class HandlerMetrics(Protocol):
+    def observe(self, handler: str, count: int, seconds: float, failed: bool): ...
+
+
+class EventDispatcher:
+    # Consumers register one handler per event type. Bodies are decoded in one pass into the
+    # handled types only, so unknown or unhandled events fail decoding.
+    # With recent_events, ids of events settled as handled are remembered and redeliveries of them
+    # are skipped before reaching a handler. The consumer runtime settles a message as handled only
+    # once the confirms of its replies arrived and it was acked, so a redelivery after a lost reply
+    # runs the handler again and the reply is sent again. The consumer runtime sends failed messages where retry
+    # routes them, it sets a policy for its queue when there is none. With metrics, every handler
+    # call is timed. The traces of the deliveries being
+    # handled are kept until they are settled, handlers continue them with trace_headers(event).
+    def __init__(self, recent_events: RecentEvents | None = None, retry: RetryPolicy | None = None,
+                 metrics: HandlerMetrics | None = None):
+        self._handlers: dict[type[BaseEvent], Callable[[BaseEvent], None]] = {}
+        self._batch_handlers: dict[type[BaseEvent], Callable[[list[BaseEvent]], None]] = {}
+        self._decoder: EventDecoder | None = None
+        self._recent_events = recent_events
+        self.retry = retry
+        self._metrics = metrics
+        self._deliveries: dict[str, Delivery] = {}
+        self.skipped = 0
+        self._skipped_lock = threading.Lock()
+
+    def handler(self, *event_types: type[BaseEvent]):
+        def register(fn: Callable[[BaseEvent], None]):
+            for event_type in event_types:
+                self._handlers[event_type] = fn
+            self._decoder = None
+            return fn
+        return register
+
+    def batch_handler(self, *event_types: type[BaseEvent]):
+        # A batch handler gets all events of its types from one batch, in arrival order. It should
+        # deal with per-event failures itself and only raise when the whole batch has to be retried.
+        def register(fn: Callable[[list[BaseEvent]], None]):
+            for event_type in event_types:
+                self._batch_handlers[event_type] = fn
+            self._decoder = None
+            return fn
+        return register
+
+    def decode(self, body: bytes, properties=None) -> BaseEvent:
+        if self._decoder is None:
+            self._decoder = EventDecoder(self._handlers.keys() | self._batch_handlers.keys())
+        return self._decoder.decode(body, properties)
+
+    def received(self, event: BaseEvent, properties):
+        delivery = received(event.name, properties)
+        if delivery is not None:
+            self._deliveries[event.event_id] = delivery
+
+    def settled(self, events: list[BaseEvent], handled: bool = False):
+        for event in events:
+            self._deliveries.pop(event.event_id, None)
+            if handled and self._recent_events is not None:
+                self._recent_events.put(event.event_id, True)
+
+    def delivery(self, event: BaseEvent) -> Delivery | None:
+        return self._deliveries.get(event.event_id)
+
+    def trace_headers(self, event: BaseEvent) -> dict[str, str] | None:
+        # headers continuing the trace of a delivery being handled, None when it has none
+        delivery = self._deliveries.get(event.event_id)
+        return None if delivery is None else trace_headers(delivery.continued())
+
+    def _seen(self, event: BaseEvent) -> bool:
+        if self._recent_events is None or not self._recent_events.get(event.event_id):
+            return False
+        with self._skipped_lock:
+            self.skipped += 1
+        return True
+
+    def _call(self, handler: Callable, arg, count: int):
+        if self._metrics is None:
+            handler(arg)
+            return
+        start = time.perf_counter()
+        try:
+            handler(arg)
+        except Exception:
+            self._metrics.observe(handler.__name__, count, time.perf_counter() - start, True)
+            raise
+        self._metrics.observe(handler.__name__, count, time.perf_counter() - start, False)
+
+    def dispatch(self, event: BaseEvent):
+        if self._seen(event):
+            return
+        self._call(self._handlers[type(event)], event, 1)
+
+    def dispatch_batch(self, events: list[BaseEvent]):
+        groups: dict[Callable[[list[BaseEvent]], None], list[BaseEvent]] = {}
+        for event in events:
+            batch_handler = self._batch_handlers.get(type(event))
+            if batch_handler is not None:
+                if not self._seen(event):
+                    groups.setdefault(batch_handler, []).append(event)
+                continue
+            self.dispatch(event)
+        for batch_handler, group in groups.items():
+            self._call(batch_handler, group, len(group))
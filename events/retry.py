@@ -0,0 +1,82 @@
+import logging
+import os
+
+import msgspec
+
+from events.codec import EventDecodeError
+
+logger = logging.getLogger(__name__)
+
+# A message whose handler failed is acked and published again to a retry queue of its queue.
+# Retry queue n holds it for RETRY_BASE_DELAY_MS * 2**n and then dead-letters it back to the
+# queue. After MAX_RETRIES attempts, or right away for terminal failures, it goes to the
+# queue's dead-letter queue, where python -m common.dlq can inspect and replay it.
+MAX_RETRIES = int(os.environ.get('MAX_RETRIES', 5))
+RETRY_BASE_DELAY_MS = int(os.environ.get('RETRY_BASE_DELAY_MS', 1000))
+
+RETRIES_HEADER = "x-retries"
+ERROR_HEADER = "x-error"
+QUEUE_HEADER = "x-queue"
+MAX_ERROR_LENGTH = 500
+
+
+class TerminalError(Exception):
+    # raised by handlers for a failure retrying cannot fix. Missing users and items are answered
+    # with failed reply events instead.
+    pass
+
+
+TERMINAL_ERRORS = (TerminalError, EventDecodeError, msgspec.ValidationError)
+
+
+def retryable(error: Exception) -> bool:
+    return not isinstance(error, TERMINAL_ERRORS)
+
+
+def retry_queue(queue: str, attempt: int) -> str:
+    return f"{queue}.retry.{attempt}"
+
+
+def dead_letter_queue(queue: str) -> str:
+    return f"{queue}.dlq"
+
+
+def retry_delay_ms(attempt: int) -> int:
+    return RETRY_BASE_DELAY_MS * 2 ** attempt
+
+
+def retry_queues(queue: str, max_retries: int = MAX_RETRIES) -> list[tuple[str, dict | None]]:
+    # (name, arguments) of the retry queues and the dead-letter queue of a queue
+    queues: list[tuple[str, dict | None]] = [(retry_queue(queue, attempt), {
+        "x-message-ttl": retry_delay_ms(attempt),
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": queue,
+    }) for attempt in range(max_retries)]
+    queues.append((dead_letter_queue(queue), None))
+    return queues
+
+
+class RetryPolicy:
+    def __init__(self, queue: str, max_retries: int = MAX_RETRIES):
+        self.queue = queue
+        self.max_retries = max_retries
+        self.retried = 0
+        self.dead_lettered = 0
+
+    def route(self, properties, error: Exception) -> tuple[str, dict]:
+        # the queue a failed message goes to next and its new headers
+        headers = dict(getattr(properties, "headers", None) or {})
+        attempt = int(headers.get(RETRIES_HEADER, 0))
+        headers[ERROR_HEADER] = f"{type(error).__name__}: {error}"[:MAX_ERROR_LENGTH]
+        headers[QUEUE_HEADER] = self.queue
+        if retryable(error) and attempt < self.max_retries:
+            headers[RETRIES_HEADER] = attempt + 1
+            routing_key = retry_queue(self.queue, attempt)
+            self.retried += 1
+            logger.warning(f"Retrying message in {retry_delay_ms(attempt)}ms "
+                           f"(attempt {attempt + 1} of {self.max_retries}): {error}")
+        else:
+            routing_key = dead_letter_queue(self.queue)
+            self.dead_lettered += 1
+            logger.error(f"Dead-lettering message after {attempt} retries: {error}")
+        return routing_key, headers
@@ -0,0 +1,12 @@
+from events.base_event import BaseEvent
+from events.registry import register_event
+
+# the saga of the order was approved: its stock hold becomes final
+@register_event
+class CommitStockEvent(BaseEvent, tag='commit stock'):
+    order_id: str
+    # event id of the reservation whose hold is committed, "" for the order id
+    hold_id: str = ""
+
+    def partition_key(self) -> str:
+        return self.order_id
@@ -0,0 +1,11 @@
+from events.base_event import BaseEvent
+from events.registry import register_event
+
+# published by stock-service on the price changes fanout exchange
+@register_event
+class ItemPriceChanged(BaseEvent, tag='item price changed'):
+    item_id: str
+    price: int
+
+    def partition_key(self) -> str:
+        return self.item_id
@@ -0,0 +1,15 @@
+from events.base_event import BaseEvent
+from events.registry import register_event
+from events.stock.reserve_stock_event import StockItem
+
+# compensation: gives back the stock reserved for an order whose saga was rejected
+@register_event
+class ReleaseStockEvent(BaseEvent, tag='release stock'):
+    order_id: str
+    stock_items: list[StockItem]
+    # event id of the reservation whose hold is released, "" for the order id
+    hold_id: str = ""
+
+    def partition_key(self) -> str:
+        # same partition as the reservation it undoes
+        return min((item.item_id for item in self.stock_items), default=self.order_id)
@@ -1,12 +1,18 @@
-from typing import ClassVar
 from events.base_event import BaseEvent
-from pydantic import BaseModel
+from events.registry import register_event
+from msgspec import Struct
 
-class StockItem(BaseModel):
+class StockItem(Struct, kw_only=True):
     item_id: str
     quantity: int
 
-class ReserveStockEvent(BaseEvent):
-    name = 'reserve stock'
+@register_event
+class ReserveStockEvent(BaseEvent, tag='reserve stock'):
     order_id: str
-    stock_items: list[StockItem]
\ No newline at end of file
+    stock_items: list[StockItem]
+
+    def partition_key(self) -> str:
+        # An order with several items lands on the partition of its smallest item id. The Lua
+        # script keeps multi-item reservations atomic across partitions. stock-consumer spreads
+        # the reservations of hot items over its lanes, see StockHandlers.lane_key.
+        return min((item.item_id for item in self.stock_items), default=self.order_id)
@@ -0,0 +1,10 @@
+from events.base_event import BaseEvent
+from events.registry import register_event
+
+@register_event
+class ReserveStockFailed(BaseEvent, tag='reserve stock failed'):
+    order_id: str
+    reason: str
+
+    def partition_key(self) -> str:
+        return self.order_id
@@ -1,7 +1,10 @@
 
-from typing import ClassVar
 from events.base_event import BaseEvent
+from events.registry import register_event
 
-class ReserveStockSucessfull(BaseEvent):
-    name: ClassVar[str] = 'reserve stock successfull'
-    order_id: str
\ No newline at end of file
+@register_event
+class ReserveStockSucessfull(BaseEvent, tag='reserve stock successfull'):
+    order_id: str
+
+    def partition_key(self) -> str:
+        return self.order_id
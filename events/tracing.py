@@ -0,0 +1,68 @@
+import time
+
+import msgspec
+from msgspec import Struct
+
+# A checkout's trace travels in the AMQP headers of every message it causes. x-trace holds the
+# trace id, the checkout time and the hops so far, x-published-at the time the message was
+# published. A consumer continuing the trace appends the hop of the message it handled, so
+# order-consumer gets the whole path with the replies.
+TRACE_HEADER = "x-trace"
+PUBLISHED_AT_HEADER = "x-published-at"
+
+
+class Hop(Struct, array_like=True):
+    # one message: its event name and when it was published, received and handled
+    name: str
+    enqueued_at: float
+    dequeued_at: float
+    done_at: float
+
+
+class Trace(Struct):
+    trace_id: str
+    started_at: float
+    hops: list[Hop] = []
+
+
+_encoder = msgspec.json.Encoder()
+_decoder = msgspec.json.Decoder(Trace)
+
+
+def trace_headers(trace: Trace) -> dict[str, str]:
+    return {TRACE_HEADER: _encoder.encode(trace).decode()}
+
+
+def published(headers: dict | None) -> dict | None:
+    # stamps the publish time on the headers of a traced message
+    if not headers or TRACE_HEADER not in headers:
+        return headers
+    return {**headers, PUBLISHED_AT_HEADER: time.time()}
+
+
+class Delivery(Struct):
+    # a received traced message
+    trace: Trace
+    name: str
+    enqueued_at: float
+    dequeued_at: float
+
+    def hop(self, done_at: float | None = None) -> Hop:
+        return Hop(self.name, self.enqueued_at, self.dequeued_at, time.time() if done_at is None else done_at)
+
+    def continued(self) -> Trace:
+        # the trace for the messages published while handling this one
+        return Trace(self.trace.trace_id, self.trace.started_at, [*self.trace.hops, self.hop()])
+
+
+def received(event_name: str, properties, dequeued_at: float | None = None) -> Delivery | None:
+    headers = getattr(properties, "headers", None) or {}
+    raw = headers.get(TRACE_HEADER)
+    if raw is None:
+        return None
+    try:
+        trace = _decoder.decode(raw)
+    except (msgspec.DecodeError, msgspec.ValidationError):
+        return None
+    dequeued_at = time.time() if dequeued_at is None else dequeued_at
+    return Delivery(trace, event_name, float(headers.get(PUBLISHED_AT_HEADER, dequeued_at)), dequeued_at)
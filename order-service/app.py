@@ -1,24 +1,27 @@
-import json
 import logging
 import os
 import atexit
-import random
-from typing import Literal
 import uuid
-from collections import defaultdict
 
-from events.base_event import BaseEvent
-from events.payment.reserve_payment_event import ReservePaymentEvent
-from events.stock.reserve_stock_event import ReserveStockEvent, StockItem
 import redis
 import requests
 
-from flask import Flask, jsonify, abort, Response
-import pika
-from msgspec import msgpack, Struct
-import logging
+from flask import Flask, jsonify, abort, Response, request
+import msgspec
+from common.batch_init import clear_keys, get_job_status, hset_chunk, start_job, write_chunks
+from common.bulk import InvalidIdList, decode_id_list, stream_json_array
+from common.http_client import get_internal_client
+from common.checkout_results import NotCheckedOut, finished, wait_for_result, wait_timeout
+from common.outbox import ALREADY_CHECKED_OUT, ORDER_NOT_FOUND, Outbox
+from common.orders import (DATA_CHECKED_OUT, DATA_NOT_FOUND, ORDER_FIELDS, SET_ORDER_DATA_LUA, OrderValue,
+                           checkout_events, get_order_entries, order_data, order_fields, order_from_fields,
+                           order_to_json, random_order_chunks, saga_follow_ups)
+from common.price_cache import get_price_cache
+from common.saga import SAGA_STATE_PATTERNS
+from common.tracing import TRACE_SPANS_KEY, new_trace, queue_sample_reads, span_stats, trace_key, trace_to_json
+from common.flask_metrics import instrument_flask
+from common.metrics import TimedRedis
 import sys
-import ast
 
 logging.basicConfig(
     level=logging.INFO,
@@ -43,20 +46,17 @@ REQ_ERROR_STR = "Requests error"
 GATEWAY_URL = os.environ['GATEWAY_URL']
 
 app = Flask("order-service")
+instrument_flask(app)
 
-db: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST'],
-                              port=int(os.environ['REDIS_PORT']),
-                              password=os.environ['REDIS_PASSWORD'],
-                              db=int(os.environ['REDIS_DB']))
+db: redis.Redis = TimedRedis(host=os.environ['REDIS_HOST'],
+                             port=int(os.environ['REDIS_PORT']),
+                             password=os.environ['REDIS_PASSWORD'],
+                             db=int(os.environ['REDIS_DB']))
+outbox = Outbox(db)
+set_order_data = db.register_script(SET_ORDER_DATA_LUA)
 
 
-# define channels
-connection = pika.BlockingConnection(pika.ConnectionParameters(
-    host='rabbitmq', port=5672, heartbeat=600, blocked_connection_timeout=300))
-channel = connection.channel()
-channel.queue_declare(queue="stock", durable=True)
-channel.queue_declare(queue="payment", durable=True)
-channel.queue_declare(queue="order", durable=True)
+order_items_decoder = msgspec.json.Decoder(list[tuple[str, int]])
 
 def close_db_connection():
     db.close()
@@ -64,21 +64,14 @@ def close_db_connection():
 atexit.register(close_db_connection)
 
 
-class OrderValue(Struct):
-    items: list[tuple[str, int]]
-    user_id: str
-    total_cost: int
-    payment_status: Literal['pending', 'approved', 'rejected']
-    stock_status: Literal['pending', 'approved', 'rejected']
-
 def get_order_from_db(order_id: str) -> OrderValue | None:
     try:
-        # get serialized data
-        entry: bytes = db.get(order_id)
+        # get the order's hash fields
+        fields = db.hmget(order_id, ORDER_FIELDS)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
     # deserialize data if it exists else return null
-    entry: OrderValue | None = msgpack.decode(entry, type=OrderValue) if entry else None
+    entry: OrderValue | None = order_from_fields(fields)
     if entry is None:
         # if order does not exist in the database; abort
         abort(400, f"Order: {order_id} not found!")
@@ -88,9 +81,9 @@ def get_order_from_db(order_id: str) -> OrderValue | None:
 @app.post('/create/<user_id>')
 def create_order(user_id: str):
     key = str(uuid.uuid4())
-    value = msgpack.encode(OrderValue(payment_status='pending', stock_status='pending', items=[], user_id=user_id, total_cost=0))
+    value = order_fields(OrderValue(payment_status='pending', stock_status='pending', items=[], user_id=user_id, total_cost=0))
     try:
-        db.set(key, value)
+        db.hset(key, mapping=value)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
     return jsonify({'order_id': key})
@@ -104,43 +97,56 @@ def batch_init_users(n: int, n_items: int, n_users: int, item_price: int):
     n_users = int(n_users)
     item_price = int(item_price)
 
-    def generate_entry() -> OrderValue:
-        user_id = random.randint(0, n_users - 1)
-        item1_id = random.randint(0, n_items - 1)
-        item2_id = random.randint(0, n_items - 1)
-        value = OrderValue(payment_status='pending', stock_status='pending',
-                           items=[(f"{item1_id}", 1), (f"{item2_id}", 1)],
-                           user_id=f"{user_id}",
-                           total_cost=2*item_price)
-        return value
-
-    kv_pairs: dict[str, bytes] = {f"{i}": msgpack.encode(generate_entry())
-                                  for i in range(n)}
+    generate_chunk = random_order_chunks(n_items, n_users, item_price)
     try:
-        db.mset(kv_pairs)
+        # a saga still running for an old order would finish the new one under its id
+        if request.args.get("background"):
+            # returns right away, the job clears them too, progress is at /batch_init/status/<job_id>
+            return jsonify({"job_id": start_job(db, n, generate_chunk, write_chunk=hset_chunk,
+                                                clear_patterns=SAGA_STATE_PATTERNS)}), 202
+        clear_keys(db, SAGA_STATE_PATTERNS)
+        write_chunks(db, n, generate_chunk, write_chunk=hset_chunk)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
     return jsonify({"msg": "Batch init for orders successful"})
 
 
+@app.get('/batch_init/status/<job_id>')
+def batch_init_status(job_id: str):
+    try:
+        status = get_job_status(db, job_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if status is None:
+        abort(400, f"Batch init job: {job_id} not found!")
+    return jsonify(status)
+
+
 @app.get('/find/<order_id>')
 def find_order(order_id: str):
     order_entry: OrderValue = get_order_from_db(order_id)
-    return jsonify(
-        {
-            "order_id": order_id,
-            "items": order_entry.items,
-            "user_id": order_entry.user_id,
-            "total_cost": order_entry.total_cost,
-            "payment_status": order_entry.payment_status,
-            "stock_status": order_entry.stock_status
-        }
-    )
-
-
-def send_post_request(url: str):
+    return jsonify(order_to_json(order_id, order_entry))
+
+
+@app.post('/find_batch')
+def find_orders():
+    # body: JSON array of order ids, response: JSON array with an order or null per id, in order
     try:
-        response = requests.post(url)
+        order_ids = decode_id_list(request.get_data())
+    except InvalidIdList as e:
+        return abort(400, str(e))
+    try:
+        body = stream_json_array(db, order_ids,
+                                 lambda order_id, entry: order_to_json(order_id, order_from_fields(entry)),
+                                 fetch=lambda chunk: get_order_entries(db, chunk))
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    return Response(body, status=200, mimetype="application/json")
+
+
+def send_post_request(url: str, json=None, idempotent: bool = False):
+    try:
+        response = get_internal_client().post(url, json=json, idempotent=idempotent)
     except requests.exceptions.RequestException:
         abort(400, REQ_ERROR_STR)
     else:
@@ -149,81 +155,161 @@ def send_post_request(url: str):
 
 def send_get_request(url: str):
     try:
-        response = requests.get(url)
+        response = get_internal_client().get(url)
     except requests.exceptions.RequestException:
         abort(400, REQ_ERROR_STR)
     else:
         return response
 
 
+def get_item_price(item_id: str) -> int:
+    # prices are served from the worker's cache, only misses go to the stock service
+    price_cache = get_price_cache()
+    price = price_cache.get(item_id)
+    if price is None:
+        item_reply = send_get_request(f"{GATEWAY_URL}/stock/find/{item_id}")
+        if item_reply.status_code != 200:
+            # Request failed because item does not exist
+            abort(400, f"Item: {item_id} does not exist!")
+        price = item_reply.json()["price"]
+        price_cache.put(item_id, price)
+    return price
+
+
+def store_order_data(order_id: str, order_entry: OrderValue):
+    try:
+        result = set_order_data(keys=[order_id], args=[order_data(order_entry)])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if result == DATA_NOT_FOUND:
+        abort(400, f"Order: {order_id} not found!")
+    if result == DATA_CHECKED_OUT:
+        abort(400, f"Order: {order_id} is already checked out!")
+
+
 @app.post('/addItem/<order_id>/<item_id>/<quantity>')
 def add_item(order_id: str, item_id: str, quantity: int):
     order_entry: OrderValue = get_order_from_db(order_id)
-    item_reply = send_get_request(f"{GATEWAY_URL}/stock/find/{item_id}")
-    if item_reply.status_code != 200:
-        # Request failed because item does not exist
-        abort(400, f"Item: {item_id} does not exist!")
-    item_json: dict = item_reply.json()
+    price = get_item_price(item_id)
     order_entry.items.append((item_id, int(quantity)))
-    order_entry.total_cost += int(quantity) * item_json["price"]
-    try:
-        db.set(order_id, msgpack.encode(order_entry))
-    except redis.exceptions.RedisError:
-        return abort(400, DB_ERROR_STR)
+    order_entry.total_cost += int(quantity) * price
+    # only the data field, the statuses may be updated by order-consumer at the same time
+    store_order_data(order_id, order_entry)
     return Response(f"Item: {item_id} added to: {order_id} price updated to: {order_entry.total_cost}",
                     status=200)
 
 
-def publish_payment_event(event: BaseEvent):
-    channel.basic_publish(
-        exchange="",  
-        routing_key="payment",  
-        body=event.to_message_queue_body(),  
-        properties=pika.BasicProperties(
-            delivery_mode=2  
-        )
-    )
-    
-
-def publish_stock_event(event: BaseEvent):
-    channel.basic_publish(
-        exchange="",  
-        routing_key="stock",  
-        body=event.to_message_queue_body(),  
-        properties=pika.BasicProperties(
-            delivery_mode=2  
-        )
-    )
+def get_item_prices(item_ids: list[str]) -> dict[str, int]:
+    # cached prices first, the misses are fetched with one batch lookup
+    price_cache = get_price_cache()
+    prices: dict[str, int] = {}
+    missing: list[str] = []
+    for item_id in dict.fromkeys(item_ids):
+        price = price_cache.get(item_id)
+        if price is None:
+            missing.append(item_id)
+        else:
+            prices[item_id] = price
+    if missing:
+        items_reply = send_post_request(f"{GATEWAY_URL}/stock/find_batch", json=missing, idempotent=True)
+        if items_reply.status_code != 200:
+            abort(400, REQ_ERROR_STR)
+        for item_id, item in zip(missing, items_reply.json()):
+            if item is None:
+                abort(400, f"Item: {item_id} does not exist!")
+            prices[item_id] = item["price"]
+            price_cache.put(item_id, item["price"])
+    return prices
+
+
+@app.post('/addItems/<order_id>')
+def add_items(order_id: str):
+    # body: JSON array of [item_id, quantity] pairs
+    try:
+        items = order_items_decoder.decode(request.get_data())
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        return abort(400, f"Expected a JSON array of [item_id, quantity] pairs: {e}")
+    order_entry: OrderValue = get_order_from_db(order_id)
+    prices = get_item_prices([item_id for item_id, _ in items])
+    for item_id, quantity in items:
+        order_entry.items.append((item_id, quantity))
+        order_entry.total_cost += quantity * prices[item_id]
+    store_order_data(order_id, order_entry)
+    return Response(f"{len(items)} items added to: {order_id} price updated to: {order_entry.total_cost}",
+                    status=200)
+
+
+@app.get('/cache/stats')
+def cache_stats():
+    return jsonify(get_price_cache().stats())
+
+
+@app.get('/http/stats')
+def http_stats():
+    return jsonify(get_internal_client().stats())
 
 
 @app.post('/checkout/<order_id>')
 def checkout(order_id: str):
+    logger.info(f"Checking out {order_id}")
+    order_entry: OrderValue = get_order_from_db(order_id)
+    payment_event, stock_event = checkout_events(order_id, order_entry)
+    # one Redis call marks the order, starts its saga and queues both events in the outbox,
+    # the outbox relay publishes them
+    trace = new_trace()
+    try:
+        result = outbox.checkout(order_id, [("payment", payment_event), ("stock", stock_event)], trace,
+                                 saga_follow_ups(order_id, order_entry, stock_event))
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if result == ORDER_NOT_FOUND:
+        abort(400, f"Order: {order_id} not found!")
+    if result == ALREADY_CHECKED_OUT:
+        abort(400, f"Order: {order_id} is already checked out!")
+    logger.info("checked out order")
+    return Response("CHeckout successfull", 200, headers={"X-Trace-Id": trace.trace_id})
+
+
+@app.get('/checkout/<order_id>/result')
+def checkout_result(order_id: str):
+    # long poll: answers 200 once the saga finished, or 202 with the pending order after ?timeout=
+    # seconds. Each waiting request holds a sync worker, asyncio mode holds thousands per worker.
+    try:
+        timeout = wait_timeout(request.args.get("timeout"))
+    except ValueError:
+        abort(400, "Invalid timeout")
     try:
-        logger.info(f"Checking out {order_id}")
-        order_entry: OrderValue = get_order_from_db(order_id)
-        payment_event = ReservePaymentEvent(
-                amount=order_entry.total_cost,
-                user_id=order_entry.user_id,
-                order_id=order_id
-            )
-        publish_payment_event(
-            payment_event
-        )
-        stock_event = ReserveStockEvent(
-                order_id=order_id,
-                stock_items=[
-                    StockItem(
-                        item_id=item_id, quantity=quanitity
-                    ) for item_id, quanitity in order_entry.items
-                ]
-            )
-        publish_stock_event(
-            stock_event
-        )
-        logger.info("checked out order")
-    except Exception as e:
-        return str(e)
-    return Response("CHeckout successfull", 200)
+        order_entry = wait_for_result(db, order_id, timeout)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    except NotCheckedOut as e:
+        abort(400, str(e))
+    if order_entry is None:
+        abort(400, f"Order: {order_id} not found!")
+    return jsonify(order_to_json(order_id, order_entry)), 200 if finished(order_entry) else 202
+
+
+@app.get('/trace/<order_id>')
+def find_trace(order_id: str):
+    try:
+        fields = db.hgetall(trace_key(order_id))
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if not fields:
+        abort(400, f"No trace for order: {order_id}!")
+    return jsonify(trace_to_json(order_id, fields))
+
+
+@app.get('/trace_stats')
+def trace_stats():
+    try:
+        spans = list(db.smembers(TRACE_SPANS_KEY))
+        pipe = db.pipeline(transaction=False)
+        queue_sample_reads(pipe, spans)
+        samples = pipe.execute()
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    return jsonify(span_stats(spans, samples))
 
 @app.get("/")
 def healthcheck():
@@ -0,0 +1,525 @@
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import aiohttp
+import msgspec
+import redis.asyncio as redis
+from aiohttp import web
+
+from common.batch_init import (clear_keys_async, hset_chunk, job_key, job_status, start_job_async,
+                               write_chunks_async)
+from common.http_client import (BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT, HTTP_CONNECT_TIMEOUT, HTTP_POOL_SIZE,
+                                HTTP_READ_TIMEOUT, HTTP_RETRIES, HTTP_RETRY_BACKOFF, RETRYABLE_STATUS_CODES,
+                                CircuitBreaker, UpstreamUnavailable)
+from common.bulk import BULK_CHUNK_SIZE, InvalidIdList, decode_id_list, render_chunk
+from common.checkout_results import CheckoutWaiters, NotCheckedOut, finished, wait_timeout
+from common.outbox import ALREADY_CHECKED_OUT, CHECKOUT_LUA, ORDER_NOT_FOUND, checkout_call
+from common.orders import (DATA_CHECKED_OUT, DATA_NOT_FOUND, ORDER_FIELDS, SET_ORDER_DATA_LUA, OrderValue,
+                           checkout_events, found_orders, order_data, order_fields, order_from_fields, order_to_json,
+                           queue_order_reads, random_order_chunks, saga_follow_ups)
+from common.price_cache import get_price_cache
+from common.saga import SAGA_STATE_PATTERNS
+from common.tracing import TRACE_SPANS_KEY, new_trace, queue_sample_reads, span_stats, trace_key, trace_to_json
+from common import metrics
+from common.metrics import HTTP_REQUEST_DURATION, HTTP_REQUESTS_IN_FLIGHT
+
+# asyncio serving mode of order-service with the same routes as app.py. Run it with
+#   gunicorn async_app:app --worker-class aiohttp.GunicornWebWorker -b 0.0.0.0:5000 -w 2
+# One worker keeps any number of requests in flight while they wait on Redis, the stock
+# service or broker confirms.
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+DB_ERROR_STR = "DB error"
+REQ_ERROR_STR = "Requests error"
+
+GATEWAY_URL = os.environ['GATEWAY_URL']
+
+routes = web.RouteTableDef()
+
+order_items_decoder = msgspec.json.Decoder(list[tuple[str, int]])
+
+
+class AsyncInternalClient:
+    # InternalClient on the worker's aiohttp session: the same pool size and timeouts, bounded
+    # retries of idempotent calls with full jitter and a circuit breaker per upstream. Its
+    # counters are fed by the session's trace hooks and served at /http/stats.
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, retries: int = HTTP_RETRIES):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.session: aiohttp.ClientSession | None = None
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.retried = 0
+        self.failed = 0
+        self.rejected = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def open(self):
+        # keep-alive pool to the gateway, opened on the worker's loop
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=30),
+            timeout=aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+            trace_configs=[self.trace_config()])
+
+    async def close(self):
+        await self.session.close()
+
+    async def get(self, url: str, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request("GET", url, idempotent=True, **kwargs)
+
+    async def post(self, url: str, idempotent: bool = False, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request("POST", url, idempotent=idempotent, **kwargs)
+
+    async def request(self, method: str, url: str, idempotent: bool, **kwargs) -> aiohttp.ClientResponse:
+        # the returned response is read already, so its json() needs no open connection
+        upstream = self._upstream(url)
+        breaker = self._breaker(upstream)
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            if not breaker.allow():
+                self.rejected += 1
+                raise UpstreamUnavailable(f"Circuit open for {upstream}")
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                breaker.record_failure()
+                if attempt + 1 == attempts:
+                    self.failed += 1
+                    raise
+                logger.warning(f"{method} {url} failed, retrying: {e}")
+            else:
+                if response.status not in RETRYABLE_STATUS_CODES:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                if attempt + 1 == attempts:
+                    self.failed += 1
+                    return response
+            self.retried += 1
+            # full jitter: sleep somewhere between 0 and the exponential backoff
+            await asyncio.sleep(random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** attempt))
+
+    def _upstream(self, url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.netloc}/{parts.path.lstrip('/').split('/', 1)[0]}"
+
+    def _breaker(self, upstream: str) -> CircuitBreaker:
+        breaker = self._breakers.get(upstream)
+        if breaker is None:
+            breaker = self._breakers[upstream] = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        return breaker
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_request_exception.append(self._on_request_exception)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    async def _on_request_end(self, session, context, params):
+        self.in_flight -= 1
+
+    async def _on_request_exception(self, session, context, params):
+        self.in_flight -= 1
+
+    async def _on_connection_create_end(self, session, context, params):
+        self.connections_opened += 1
+
+    async def _on_connection_reuseconn(self, session, context, params):
+        self.connections_reused += 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "pool_size": self.pool_size,
+            "utilization": self.in_flight / self.pool_size,
+            "requests": self.requests,
+            "retried": self.retried,
+            "failed": self.failed,
+            "rejected_by_breaker": self.rejected,
+            "breakers": {upstream: breaker.state for upstream, breaker in self._breakers.items()},
+            "connections_opened": self.connections_opened,
+            "connections_reused": self.connections_reused,
+        }
+
+
+async def on_startup(app: web.Application):
+    app['db'] = metrics.TimedAsyncRedis(host=os.environ['REDIS_HOST'],
+                                        port=int(os.environ['REDIS_PORT']),
+                                        password=os.environ['REDIS_PASSWORD'],
+                                        db=int(os.environ['REDIS_DB']))
+    app['http'] = AsyncInternalClient()
+    app['http'].open()
+    app['checkout'] = app['db'].register_script(CHECKOUT_LUA)
+    app['set_order_data'] = app['db'].register_script(SET_ORDER_DATA_LUA)
+    app['checkout_waiters'] = CheckoutWaiters()
+    app['checkout_listener'] = asyncio.create_task(app['checkout_waiters'].listen(app['db']))
+    metrics.callback("checkout_waiters", "Requests waiting for a checkout result", metrics.GAUGE,
+                     lambda: len(app['checkout_waiters']))
+    metrics.start_flusher()
+
+
+async def on_cleanup(app: web.Application):
+    app['checkout_listener'].cancel()
+    await app['http'].close()
+    await app['db'].aclose()
+
+
+async def get_order_from_db(db: redis.Redis, order_id: str) -> OrderValue:
+    try:
+        # get the order's hash fields
+        fields = await db.hmget(order_id, ORDER_FIELDS)
+    except redis.RedisError:
+        raise web.HTTPBadRequest(text=DB_ERROR_STR)
+    # deserialize data if it exists else return null
+    entry: OrderValue | None = order_from_fields(fields)
+    if entry is None:
+        # if order does not exist in the database; abort
+        raise web.HTTPBadRequest(text=f"Order: {order_id} not found!")
+    return entry
+
+
+@routes.post('/create/{user_id}')
+async def create_order(request: web.Request):
+    key = str(uuid.uuid4())
+    value = order_fields(OrderValue(payment_status='pending', stock_status='pending', items=[],
+                                    user_id=request.match_info['user_id'], total_cost=0))
+    try:
+        await request.app['db'].hset(key, mapping=value)
+    except redis.RedisError:
+        raise web.HTTPBadRequest(text=DB_ERROR_STR)
+    return web.json_response({'order_id': key})
+
+
+@routes.post('/batch_init/{n}/{n_items}/{n_users}/{item_price}')
+async def batch_init_users(request: web.Request):
+    n = int(request.match_info['n'])
+    n_items = int(request.match_info['n_items'])
+    n_users = int(request.match_info['n_users'])
+    item_price = int(request.match_info['item_price'])
+    db: redis.Redis = request.app['db']
+    generate_chunk = random_order_chunks(n_items, n_users, item_price)
+    try:
+        # a saga still running for an old order would finish the new one under its id
+        if request.query.get("background"):
+            # returns right away, the job clears them too, progress is at /batch_init/status/{job_id}
+            job_id = await start_job_async(db, n, generate_chunk, write_chunk=hset_chunk,
+                                           clear_patterns=SAGA_STATE_PATTERNS)
+            return web.json_response({"job_id": job_id}, status=202)
+        await clear_keys_async(db, SAGA_STATE_PATTERNS)
+        await write_chunks_async(db, n, generate_chunk, write_chunk=hset_chunk)
+    except redis.RedisError:
+        raise web.HTTPBadRequest(text=DB_ERROR_STR)
+    return web.json_response({"msg": "Batch init for orders successful"})
+
+
+@routes.get('/batch_init/status/{job_id}')
+async def batch_init_status(request: web.Request):
+    job_id = request.match_info['job_id']
+    try:
+        entry = await request.app['db'].hgetall(job_key(job_id))
+    except redis.RedisError:
+        raise web.HTTPBadRequest(text=DB_ERROR_STR)
+    if not entry:
+        raise web.HTTPBadRequest(text=f"Batch init job: {job_id} not found!")
+    return web.json_response(job_status(entry))
+
+
+@routes.get('/find/{order_id}')
+async def find_order(request: web.Request):
+    order_id = request.match_info['order_id']
+    order_entry = await get_order_from_db(request.app['db'], order_id)
+    return web.json_response(order_to_json(order_id, order_entry))
+
+
+@routes.post('/find_batch')
+async def find_orders(request: web.Request):
+    # body: JSON array of order ids, response: JSON array with an order or null per id, in order
+    try:
+        order_ids = decode_id_list(await request.read())
+    except InvalidIdList as e:
+        raise web.HTTPBadRequest(text=str(e))
+    db: redis.Redis = request.app['db']
+
+    def render(order_id: str, entry: list[bytes | None]) -> dict:
+        return order_to_json(order_id, order_from_fields(entry))
+
+    async def fetch(chunk: list[str]) -> list[list[bytes | None] | None]:
+        pipe = db.pipeline(transaction=False)
+        queue_order_reads(pipe, chunk)
+        return found_orders(await pipe.execute())
+
+    try:
+        # the first chunk is read before the response starts, so Redis errors can still be a 400
+        first = order_ids[:BULK_CHUNK_SIZE]
+        first_entries = await fetch(first) if first else []
+    except redis.RedisError:
+        raise web.HTTPBadRequest(text=DB_ERROR_STR)
+    response = web.StreamResponse(headers={"Content-Type": "application/json"})
+    await response.prepare(request)
+    await response.write(b"[" + render_chunk(first, first_entries, render))
+    for start in range(BULK_CHUNK_SIZE, len(order_ids), BULK_CHUNK_SIZE):
+        chunk = order_ids[start:start + BULK_CHUNK_SIZE]
+        await response.write(b"," + render_chunk(chunk, await fetch(chunk), render))
+    await response.write(b"]")
+    await response.write_eof()
+    return response
+
+
+async def get_item_price(http: AsyncInternalClient, item_id: str) -> int:
+    # prices are served from the worker's cache, only misses go to the stock service
+    price_cache = get_price_cache()
+    price = price_cache.get(item_id)
+    if price is None:
+        try:
+            item_reply = await http.get(f"{GATEWAY_URL}/stock/find/{item_id}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamUnavailable):
+            raise web.HTTPBadRequest(text=REQ_ERROR_STR)
+        if item_reply.status != 200:
+            # Request failed because item does not exist
+            raise web.HTTPBadRequest(text=f"Item: {item_id} does not exist!")
+        price = (await item_reply.json())["price"]
+        price_cache.put(item_id, price)
+    return price
+
+
+async def store_order_data(app: web.Application, order_id: str, order_entry: OrderValue):
+    try:
+        result = await app['set_order_data'](keys=[order_id], args=[order_data(order_entry)])
+    except redis.RedisError:
+        raise web.HTTPBadRequest(text=DB_ERROR_STR)
+    if result == DATA_NOT_FOUND:
+        raise web.HTTPBadRequest(text=f"Order: {order_id} not found!")
+    if result == DATA_CHECKED_OUT:
+        raise web.HTTPBadRequest(text=f"Order: {order_id} is already checked out!")
+
+
+@routes.post('/addItem/{order_id}/{item_id}/{quantity}')
+async def add_item(request: web.Request):
+    order_id = request.match_info['order_id']
+    item_id = request.match_info['item_id']
+    quantity = int(request.match_info['quantity'])
+    db: redis.Redis = request.app['db']
+    order_entry = await get_order_from_db(db, order_id)
+    price = await get_item_price(request.app['http'], item_id)
+    order_entry.items.append((item_id, quantity))
+    order_entry.total_cost += quantity * price
+    # only the data field, the statuses may be updated by order-consumer at the same time
+    await store_order_data(request.app, order_id, order_entry)
+    return web.Response(text=f"Item: {item_id} added to: {order_id} price updated to: {order_entry.total_cost}")
+
+
+async def get_item_prices(http: AsyncInternalClient, item_ids: list[str]) -> dict[str, int]:
+    # cached prices first, the misses are fetched with one batch lookup
+    price_cache = get_price_cache()
+    prices: dict[str, int] = {}
+    missing: list[str] = []
+    for item_id in dict.fromkeys(item_ids):
+        price = price_cache.get(item_id)
+        if price is None:
+            missing.append(item_id)
+        else:
+            prices[item_id] = price
+    if missing:
+        try:
+            items_reply = await http.post(f"{GATEWAY_URL}/stock/find_batch", idempotent=True, json=missing)
+        except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamUnavailable):
+            raise web.HTTPBadRequest(text=REQ_ERROR_STR)
+        if items_reply.status != 200:
+            raise web.HTTPBadRequest(text=REQ_ERROR_STR)
+        items = await items_reply.json()
+        for item_id, item in zip(missing, items):
+            if item is None:
+                raise web.HTTPBadRequest(text=f"Item: {item_id} does not exist!")
+            prices[item_id] = item["price"]
+            price_cache.put(item_id, item["price"])
+    return prices
+
+
+@routes.post('/addItems/{order_id}')
+async def add_items(request: web.Request):
+    # body: JSON array of [item_id, quantity] pairs
+    order_id = request.match_info['order_id']
+    try:
+        items = order_items_decoder.decode(await request.read())
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        raise web.HTTPBadRequest(text=f"Expected a JSON array of [item_id, quantity] pairs: {e}")
+    db: redis.Redis = request.app['db']
+    order_entry = await get_order_from_db(db, order_id)
+    prices = await get_item_prices(request.app['http'], [item_id for item_id, _ in items])
+    for item_id, quantity in items:
+        order_entry.items.append((item_id, quantity))
+        order_entry.total_cost += quantity * prices[item_id]
+    await store_order_data(request.app, order_id, order_entry)
+    return web.Response(text=f"{len(items)} items added to: {order_id} price updated to: {order_entry.total_cost}")
+
+
+@routes.get('/cache/stats')
+async def cache_stats(request: web.Request):
+    return web.json_response(get_price_cache().stats())
+
+
+@routes.get('/http/stats')
+async def http_stats(request: web.Request):
+    return web.json_response(request.app['http'].stats())
+
+
+@routes.post('/checkout/{order_id}')
+async def checkout(request: web.Request):
+    order_id = request.match_info['order_id']
+    logger.info(f"Checking out {order_id}")
+    order_entry = await get_order_from_db(request.app['db'], order_id)
+    payment_event, stock_event = checkout_events(order_id, order_entry)
+    # one Redis call marks the order, starts its saga and queues both events in the outbox,
+    # the outbox relay publishes them
+    trace = new_trace()
+    keys, args = checkout_call(order_id, [("payment", payment_event), ("stock", stock_event)], trace,
+                               saga_follow_ups(order_id, order_entry, stock_event))
+    try:
+        result = await request.app['checkout'](keys=keys, args=args)
+    except redis.RedisError:
+        raise web.HTTPBadRequest(text=DB_ERROR_STR)
+    if result == ORDER_NOT_FOUND:
+        raise web.HTTPBadRequest(text=f"Order: {order_id} not found!")
+    if result == ALREADY_CHECKED_OUT:
+        raise web.HTTPBadRequest(text=f"Order: {order_id} is already checked out!")
+    logger.info("checked out order")
+    return web.Response(text="CHeckout successfull", headers={"X-Trace-Id": trace.trace_id})
+
+
+async def wait_for_checkout(request: web.Request, order_id: str, on_keepalive=None) -> OrderValue:
+    try:
+        timeout = wait_timeout(request.query.get('timeout'))
+    except ValueError:
+        raise web.HTTPBadRequest(text="Invalid timeout")
+    try:
+        order_entry = await request.app['checkout_waiters'].wait(request.app['db'], order_id, timeout, on_keepalive)
+    except redis.RedisError:
+        raise web.HTTPBadRequest(text=DB_ERROR_STR)
+    except NotCheckedOut as e:
+        raise web.HTTPBadRequest(text=str(e))
+    if order_entry is None:
+        raise web.HTTPBadRequest(text=f"Order: {order_id} not found!")
+    return order_entry
+
+
+@routes.get('/checkout/{order_id}/result')
+async def checkout_result(request: web.Request):
+    # long poll: answers 200 once the saga finished, or 202 with the pending order after ?timeout=
+    # seconds. A waiting request is only a future resolved by the worker's results subscription.
+    order_id = request.match_info['order_id']
+    order_entry = await wait_for_checkout(request, order_id)
+    return web.json_response(order_to_json(order_id, order_entry), status=200 if finished(order_entry) else 202)
+
+
+@routes.get('/checkout/{order_id}/events')
+async def checkout_result_events(request: web.Request):
+    # server-sent events: one "result" event, or "pending" after ?timeout= seconds, with keepalive
+    # comments in between. The stream only starts with the first keepalive, so errors found
+    # before it are still a 400.
+    order_id = request.match_info['order_id']
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no'})
+
+    async def keepalive():
+        if not response.prepared:
+            await response.prepare(request)
+        await response.write(b": keepalive\n\n")
+
+    order_entry = await wait_for_checkout(request, order_id, keepalive)
+    if not response.prepared:
+        await response.prepare(request)
+    event = "result" if finished(order_entry) else "pending"
+    await response.write(f"event: {event}\ndata: ".encode() + msgspec.json.encode(order_to_json(order_id, order_entry))
+                         + b"\n\n")
+    await response.write_eof()
+    return response
+
+
+@routes.get('/trace/{order_id}')
+async def find_trace(request: web.Request):
+    order_id = request.match_info['order_id']
+    try:
+        fields = await request.app['db'].hgetall(trace_key(order_id))
+    except redis.RedisError:
+        raise web.HTTPBadRequest(text=DB_ERROR_STR)
+    if not fields:
+        raise web.HTTPBadRequest(text=f"No trace for order: {order_id}!")
+    return web.json_response(trace_to_json(order_id, fields))
+
+
+@routes.get('/trace_stats')
+async def trace_stats(request: web.Request):
+    db = request.app['db']
+    try:
+        spans = list(await db.smembers(TRACE_SPANS_KEY))
+        pipe = db.pipeline(transaction=False)
+        queue_sample_reads(pipe, spans)
+        samples = await pipe.execute()
+    except redis.RedisError:
+        raise web.HTTPBadRequest(text=DB_ERROR_STR)
+    return web.json_response(span_stats(spans, samples))
+
+
+@routes.get('/')
+async def healthcheck(request: web.Request):
+    return web.Response(text="OK")
+
+
+@routes.get('/metrics')
+async def prometheus_metrics(request: web.Request):
+    # reads the other workers' snapshot files, off the event loop
+    body = await asyncio.get_running_loop().run_in_executor(None, metrics.render)
+    return web.Response(text=body, headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    # same series as the Flask apps, streamed responses are timed until they end
+    start = time.perf_counter()
+    HTTP_REQUESTS_IN_FLIGHT.inc()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_REQUESTS_IN_FLIGHT.dec()
+        route = request.match_info.route.resource
+        HTTP_REQUEST_DURATION.labels(request.method, route.canonical if route is not None else "unmatched",
+                                     str(status)).observe(time.perf_counter() - start)
+
+
+app = web.Application(middlewares=[metrics_middleware])
+app.add_routes(routes)
+app.on_startup.append(on_startup)
+app.on_cleanup.append(on_cleanup)
+
+
+if __name__ == '__main__':
+    web.run_app(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,29 @@
+import logging
+import os
+
+import redis
+
+from common.amqp import ConfirmingPublisher
+from common.metrics import COUNTER, TimedRedis, callback, serve_metrics
+from common.outbox import OutboxRelay
+from common.partitioning import partition_queues
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+logger.info("Outbox relay started")
+
+db: redis.Redis = TimedRedis(host=os.environ['REDIS_HOST'],
+                             port=int(os.environ['REDIS_PORT']),
+                             password=os.environ['REDIS_PASSWORD'],
+                             db=int(os.environ['REDIS_DB']))
+
+# every partition of every queue checkout events are routed to
+QUEUES = tuple(queue for name in ("stock", "payment", "order") for queue in partition_queues(name))
+
+if __name__ == '__main__':
+    relay = OutboxRelay(db, ConfirmingPublisher(QUEUES))
+    callback("outbox_published_total", "Outbox entries published and confirmed", COUNTER, lambda: relay.published)
+    callback("outbox_failed_total", "Outbox entry publishes that were not confirmed", COUNTER, lambda: relay.failed)
+    serve_metrics()
+    relay.run()
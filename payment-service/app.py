@@ -6,17 +6,25 @@ import uuid
 import redis
 
 from msgspec import msgpack, Struct
-from flask import Flask, jsonify, abort, Response
+from flask import Flask, jsonify, abort, Response, request
+
+from common.batch_init import constant_chunks, get_job_status, start_job, write_chunks
+from common.bulk import InvalidIdList, decode_id_list, stream_json_array
+from common.payment_store import NOT_FOUND, PaymentStore
+from common.flask_metrics import instrument_flask
+from common.metrics import TimedRedis
 
 DB_ERROR_STR = "DB error"
 
 
 app = Flask("payment-service")
+instrument_flask(app)
 
-db: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST'],
-                              port=int(os.environ['REDIS_PORT']),
-                              password=os.environ['REDIS_PASSWORD'],
-                              db=int(os.environ['REDIS_DB']))
+db: redis.Redis = TimedRedis(host=os.environ['REDIS_HOST'],
+                             port=int(os.environ['REDIS_PORT']),
+                             password=os.environ['REDIS_PASSWORD'],
+                             db=int(os.environ['REDIS_DB']))
+payment_store = PaymentStore(db)
 
 
 def close_db_connection():
@@ -30,6 +38,9 @@ class UserValue(Struct):
     credit: int
 
 
+user_value_decoder = msgpack.Decoder(UserValue)
+
+
 def get_user_from_db(user_id: str) -> UserValue | None:
     try:
         # get serialized data
@@ -59,15 +70,28 @@ def create_user():
 def batch_init_users(n: int, starting_money: int):
     n = int(n)
     starting_money = int(starting_money)
-    kv_pairs: dict[str, bytes] = {f"{i}": msgpack.encode(UserValue(credit=starting_money))
-                                  for i in range(n)}
+    generate_chunk = constant_chunks(msgpack.encode(UserValue(credit=starting_money)))
     try:
-        db.mset(kv_pairs)
+        if request.args.get("background"):
+            # returns right away, progress is at /batch_init/status/<job_id>
+            return jsonify({"job_id": start_job(db, n, generate_chunk)}), 202
+        write_chunks(db, n, generate_chunk)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
     return jsonify({"msg": "Batch init for users successful"})
 
 
+@app.get('/batch_init/status/<job_id>')
+def batch_init_status(job_id: str):
+    try:
+        status = get_job_status(db, job_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if status is None:
+        abort(400, f"Batch init job: {job_id} not found!")
+    return jsonify(status)
+
+
 @app.get('/find_user/<user_id>')
 def find_user(user_id: str):
     user_entry: UserValue = get_user_from_db(user_id)
@@ -79,31 +103,51 @@ def find_user(user_id: str):
     )
 
 
+@app.post('/find_batch')
+def find_users():
+    # body: JSON array of user ids, response: JSON array with a user or null per id, in order
+    try:
+        user_ids = decode_id_list(request.get_data())
+    except InvalidIdList as e:
+        return abort(400, str(e))
+
+    def render(user_id: str, entry: bytes) -> dict:
+        return {"user_id": user_id, "credit": user_value_decoder.decode(entry).credit}
+
+    try:
+        body = stream_json_array(db, user_ids, render)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    return Response(body, status=200, mimetype="application/json")
+
+
 @app.post('/add_funds/<user_id>/<amount>')
 def add_credit(user_id: str, amount: int):
-    user_entry: UserValue = get_user_from_db(user_id)
-    # update credit, serialize and update database
-    user_entry.credit += int(amount)
+    # in the same script as payments, so it cannot overwrite one running at the same time
     try:
-        db.set(user_id, msgpack.encode(user_entry))
+        [failure], credits = payment_store.reserve([(user_id, -int(amount))])
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
-    return Response(f"User: {user_id} credit updated to: {user_entry.credit}", status=200)
+    if failure == NOT_FOUND:
+        abort(400, f"User: {user_id} not found!")
+    if failure is not None:
+        abort(400, f"User: {user_id} credit cannot get reduced below zero!")
+    return Response(f"User: {user_id} credit updated to: {credits[user_id]}", status=200)
 
 
 @app.post('/pay/<user_id>/<amount>')
 def remove_credit(user_id: str, amount: int):
     app.logger.debug(f"Removing {amount} credit from user: {user_id}")
-    user_entry: UserValue = get_user_from_db(user_id)
-    # update credit, serialize and update database
-    user_entry.credit -= int(amount)
-    if user_entry.credit < 0:
-        abort(400, f"User: {user_id} credit cannot get reduced below zero!")
+    # check and decrement run as one atomic script, so concurrent payments cannot lose updates
     try:
-        db.set(user_id, msgpack.encode(user_entry))
+        [failure], credits = payment_store.reserve([(user_id, int(amount))])
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
-    return Response(f"User: {user_id} credit updated to: {user_entry.credit}", status=200)
+    if failure == NOT_FOUND:
+        abort(400, f"User: {user_id} not found!")
+    if failure is not None:
+        abort(400, f"User: {user_id} credit cannot get reduced below zero!")
+    return Response(f"User: {user_id} credit updated to: {credits[user_id]}", status=200)
 
 
 if __name__ == '__main__':
@@ -3,20 +3,33 @@ import os
 import atexit
 import uuid
 
+import pika
 import redis
 
 from msgspec import msgpack, Struct
-from flask import Flask, jsonify, abort, Response
+from flask import Flask, jsonify, abort, Response, request
+
+from common.amqp import PUBLISH_TIMEOUT, get_publisher
+from common.batch_init import clear_keys, constant_chunks, get_job_status, start_job, write_chunks
+from common.bulk import InvalidIdList, decode_id_list, stream_json_array
+from common.price_cache import PRICE_CHANGES_EXCHANGE
+from common.stock_store import NOT_FOUND, STOCK_STATE_PATTERNS, StockStore
+from common.flask_metrics import instrument_flask
+from common.metrics import TimedRedis
+from events.codec import encode_event
+from events.stock.item_price_changed_event import ItemPriceChanged
 
 
 DB_ERROR_STR = "DB error"
 
 app = Flask("stock-service")
+instrument_flask(app)
 
-db: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST'],
-                              port=int(os.environ['REDIS_PORT']),
-                              password=os.environ['REDIS_PASSWORD'],
-                              db=int(os.environ['REDIS_DB']))
+db: redis.Redis = TimedRedis(host=os.environ['REDIS_HOST'],
+                             port=int(os.environ['REDIS_PORT']),
+                             password=os.environ['REDIS_PASSWORD'],
+                             db=int(os.environ['REDIS_DB']))
+stock_store = StockStore(db)
 
 
 def close_db_connection():
@@ -26,9 +39,14 @@ def close_db_connection():
 atexit.register(close_db_connection)
 
 
-class StockValue(Struct):
+class StockValue(Struct, omit_defaults=True):
     stock: int
     price: int
+    # hot items only, the number of sub-counters holding the rest of their stock
+    shards: int = 0
+
+
+stock_value_decoder = msgpack.Decoder(StockValue)
 
 
 def get_item_from_db(item_id: str) -> StockValue | None:
@@ -45,6 +63,22 @@ def get_item_from_db(item_id: str) -> StockValue | None:
     return entry
 
 
+def available_stock(item_id: str, item_entry: StockValue) -> int:
+    if not item_entry.shards:
+        return item_entry.stock
+    try:
+        return item_entry.stock + stock_store.shard_stock(item_id, item_entry.shards)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+
+
+def updated_stock(item_id: str, stocks: dict[str, int]) -> int:
+    # hot items are not in the stocks returned by reserve
+    if item_id in stocks:
+        return stocks[item_id]
+    return available_stock(item_id, get_item_from_db(item_id))
+
+
 @app.post('/item/create/<price>')
 def create_item(price: int):
     key = str(uuid.uuid4())
@@ -62,51 +96,143 @@ def batch_init_users(n: int, starting_stock: int, item_price: int):
     n = int(n)
     starting_stock = int(starting_stock)
     item_price = int(item_price)
-    kv_pairs: dict[str, bytes] = {f"{i}": msgpack.encode(StockValue(stock=starting_stock, price=item_price))
-                                  for i in range(n)}
+    generate_chunk = constant_chunks(msgpack.encode(StockValue(stock=starting_stock, price=item_price)))
     try:
-        db.mset(kv_pairs)
+        # holds, sub-counters and hot item state of the old items would apply to the new ones
+        if request.args.get("background"):
+            # returns right away, the job clears them too, progress is at /batch_init/status/<job_id>
+            return jsonify({"job_id": start_job(db, n, generate_chunk, clear_patterns=STOCK_STATE_PATTERNS)}), 202
+        clear_keys(db, STOCK_STATE_PATTERNS)
+        write_chunks(db, n, generate_chunk)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
     return jsonify({"msg": "Batch init for stock successful"})
 
 
+@app.get('/batch_init/status/<job_id>')
+def batch_init_status(job_id: str):
+    try:
+        status = get_job_status(db, job_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if status is None:
+        abort(400, f"Batch init job: {job_id} not found!")
+    return jsonify(status)
+
+
 @app.get('/find/<item_id>')
 def find_item(item_id: str):
     item_entry: StockValue = get_item_from_db(item_id)
     return jsonify(
         {
-            "stock": item_entry.stock,
+            "stock": available_stock(item_id, item_entry),
             "price": item_entry.price
         }
     )
 
 
+@app.post('/find_batch')
+def find_items():
+    # body: JSON array of item ids, response: JSON array with an item or null per id, in order
+    try:
+        item_ids = decode_id_list(request.get_data())
+    except InvalidIdList as e:
+        return abort(400, str(e))
+
+    def fetch(chunk: list[str]) -> list[tuple[StockValue, int] | None]:
+        # the sub-counters of the chunk's hot items are read with it, render makes no Redis calls
+        entries = [stock_value_decoder.decode(entry) if entry else None for entry in db.mget(chunk)]
+        shard_stocks = stock_store.shard_stocks([(item_id, entry.shards) for item_id, entry in zip(chunk, entries)
+                                                 if entry and entry.shards])
+        return [entry and (entry, entry.stock + shard_stocks.get(item_id, 0)) for item_id, entry in zip(chunk, entries)]
+
+    def render(item_id: str, entry: tuple[StockValue, int]) -> dict:
+        item_entry, stock = entry
+        return {"item_id": item_id, "stock": stock, "price": item_entry.price}
+
+    try:
+        body = stream_json_array(db, item_ids, render, fetch)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    return Response(body, status=200, mimetype="application/json")
+
+
 @app.post('/add/<item_id>/<amount>')
 def add_stock(item_id: str, amount: int):
-    item_entry: StockValue = get_item_from_db(item_id)
-    # update stock, serialize and update database
-    item_entry.stock += int(amount)
+    # in the same script as reservations, so it cannot overwrite one running at the same time
+    try:
+        [failure], stocks = stock_store.reserve([[(item_id, -int(amount))]])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if failure is not None:
+        if failure.reason == NOT_FOUND:
+            abort(400, f"Item: {item_id} not found!")
+        abort(400, f"Item: {item_id} stock cannot get reduced below zero!")
+    stock = updated_stock(item_id, stocks)
+    return Response(f"Item: {item_id} stock updated to: {stock}", status=200)
+
+
+@app.post('/item/price/<item_id>/<price>')
+def set_price(item_id: str, price: int):
     try:
-        db.set(item_id, msgpack.encode(item_entry))
+        found = stock_store.set_price(item_id, int(price))
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
-    return Response(f"Item: {item_id} stock updated to: {item_entry.stock}", status=200)
+    if not found:
+        abort(400, f"Item: {item_id} not found!")
+    # order-service workers drop the item from their price caches when this arrives
+    body, properties = encode_event(ItemPriceChanged(item_id=item_id, price=int(price)))
+    confirm = get_publisher(fanout_exchanges=(PRICE_CHANGES_EXCHANGE,)).publish(
+        "", body, pika.BasicProperties(delivery_mode=2, **properties), exchange=PRICE_CHANGES_EXCHANGE)
+    try:
+        confirm.result(timeout=PUBLISH_TIMEOUT)
+    except Exception as e:
+        # cached prices still expire after their TTL
+        app.logger.warning(f"Price change of {item_id} not published: {e}")
+    return Response(f"Item: {item_id} price updated to: {price}", status=200)
 
 
 @app.post('/subtract/<item_id>/<amount>')
 def remove_stock(item_id: str, amount: int):
-    item_entry: StockValue = get_item_from_db(item_id)
-    # update stock, serialize and update database
-    item_entry.stock -= int(amount)
-    app.logger.debug(f"Item: {item_id} stock updated to: {item_entry.stock}")
-    if item_entry.stock < 0:
+    # check and decrement run as one atomic script, so concurrent subtracts cannot oversell
+    try:
+        [failure], stocks = stock_store.reserve([[(item_id, int(amount))]])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if failure is not None:
+        if failure.reason == NOT_FOUND:
+            abort(400, f"Item: {item_id} not found!")
         abort(400, f"Item: {item_id} stock cannot get reduced below zero!")
+    stock = updated_stock(item_id, stocks)
+    app.logger.debug(f"Item: {item_id} stock updated to: {stock}")
+    return Response(f"Item: {item_id} stock updated to: {stock}", status=200)
+
+
+@app.post('/item/hot/<item_id>/<shards>')
+def promote_item(item_id: str, shards: int):
+    # splits the item's stock over sub-counters ahead of a flash sale, stock-consumer does the same
+    # on its own with HOT_ITEM_SHARDS set
+    if int(shards) < 1:
+        abort(400, f"Item: {item_id} needs at least one sub-counter!")
     try:
-        db.set(item_id, msgpack.encode(item_entry))
+        found = stock_store.promote(item_id, int(shards))
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
-    return Response(f"Item: {item_id} stock updated to: {item_entry.stock}", status=200)
+    if not found:
+        abort(400, f"Item: {item_id} not found!")
+    return Response(f"Item: {item_id} split over {shards} sub-counters", status=200)
+
+
+@app.post('/item/cold/<item_id>')
+def demote_item(item_id: str):
+    # merges the sub-counters back into the item's stock
+    try:
+        found = stock_store.demote(item_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if not found:
+        abort(400, f"Item: {item_id} not found!")
+    return Response(f"Item: {item_id} stock merged", status=200)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,455 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import msgspec
+
+from common import metrics
+from common.batch_init import constant_chunks
+from common.checkout_results import CheckoutResult, CheckoutWaiters, NotCheckedOut
+from common.consumer_runtime import ConsumerRuntime
+from common.hot_items import HITS_KEY_PREFIX, HotItemTracker
+from common.http_client import CircuitBreaker
+from common.lru import TTLCache
+from common.outbox import OUTBOX_STREAM, checkout_call, entry_properties
+from common.orders import (DATA_FIELD, ORDER_FIELDS, OrderValue, order_fields, order_from_fields,
+                           checkout_events, random_order_chunks, saga_follow_ups)
+from common.partitioning import HashRing, route
+from common.saga import COMMIT_STOCK, REFUND_PAYMENT, RELEASE_STOCK
+from common.supervisor import parse_partitions
+from common.tracing import new_trace, percentiles, trace_key, trace_to_json
+from events.codec import EventDecoder, encode_event
+from events.payment.refund_payment_event import RefundPaymentEvent
+from events.registry import EventDispatcher
+from events.retry import retry_queue
+from events.stock.reserve_stock_successful_event import ReserveStockSucessfull
+from events.stock.reserve_stock_event import ReserveStockEvent, StockItem
+from events.tracing import Hop, received
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_entries_expire(self):
+        cache = TTLCache(maxsize=2, ttl=0.01)
+        cache.put("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_invalidate(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.put("a", 1)
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.invalidations, 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.state, "open")
+
+    def test_half_open_allows_one_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        self.assertEqual(breaker.state, "half_open")
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+        self.assertTrue(breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.01)
+        for _ in range(3):
+            breaker.record_failure()
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+
+
+class TestBatchInitChunks(unittest.TestCase):
+
+    def test_constant_chunks(self):
+        self.assertEqual(constant_chunks(b"v")(3, 5), {"3": b"v", "4": b"v"})
+
+    def test_random_order_chunks(self):
+        chunk = random_order_chunks(n_items=4, n_users=2, item_price=5)(10, 20)
+        self.assertEqual(list(chunk), [f"{i}" for i in range(10, 20)])
+        for fields in chunk.values():
+            order = order_from_fields([fields[field] if field == DATA_FIELD else fields[field].encode()
+                                       for field in ORDER_FIELDS])
+            self.assertEqual(order.total_cost, 10)
+            self.assertIn(order.user_id, {"0", "1"})
+            self.assertEqual(len(order.items), 2)
+            self.assertTrue(all(item_id in {"0", "1", "2", "3"} for item_id, _ in order.items))
+
+
+class TestPartitioning(unittest.TestCase):
+
+    def test_keys_spread_over_partitions(self):
+        ring = HashRing(4)
+        counts = [0] * 4
+        for i in range(10000):
+            counts[ring.partition(str(i))] += 1
+        self.assertTrue(all(count > 1500 for count in counts), counts)
+
+    def test_adding_a_partition_only_moves_keys_onto_it(self):
+        before, after = HashRing(4), HashRing(5)
+        moved = [str(i) for i in range(10000) if before.partition(str(i)) != after.partition(str(i))]
+        self.assertTrue(all(after.partition(key) == 4 for key in moved))
+        self.assertLess(len(moved), 3000)
+
+    def test_stock_event_routes_by_smallest_item(self):
+        event = ReserveStockEvent(order_id="o", stock_items=[StockItem(item_id="b", quantity=1),
+                                                             StockItem(item_id="a", quantity=1)])
+        self.assertEqual(event.partition_key(), "a")
+        self.assertEqual(ReserveStockEvent(order_id="o", stock_items=[]).partition_key(), "o")
+
+    def test_parse_partitions(self):
+        self.assertEqual(parse_partitions("", 3), [0, 1, 2])
+        self.assertEqual(parse_partitions("0-1,5", 8), [0, 1, 5])
+        with self.assertRaises(ValueError):
+            parse_partitions("4", 4)
+
+
+class TestOrderFields(unittest.TestCase):
+
+    def test_round_trip(self):
+        order = OrderValue(items=[("a", 2)], user_id="u", total_cost=4,
+                           payment_status='approved', stock_status='pending')
+        fields = order_fields(order)
+        self.assertEqual(order_from_fields([fields[DATA_FIELD], b"approved", b"pending"]), order)
+
+    def test_missing_order(self):
+        self.assertIsNone(order_from_fields([None, None, None]))
+
+
+class TestOutbox(unittest.TestCase):
+
+    def test_checkout_call_round_trip(self):
+        event = ReserveStockEvent(order_id="o", stock_items=[StockItem(item_id="b", quantity=1)])
+        trace = new_trace()
+        keys, args = checkout_call("o", [("stock", event)], trace)
+        self.assertEqual(keys, ["o", "saga:o", "saga:deadlines", OUTBOX_STREAM, trace_key("o")])
+        self.assertEqual(args[6], 1)
+        routing_key, body, content_encoding, trace_header = args[7:]
+        self.assertEqual(routing_key, route("stock", event))
+        properties = entry_properties({b"routing_key": routing_key.encode(), b"body": body,
+                                       b"content_encoding": content_encoding.encode(),
+                                       b"trace": trace_header.encode()})
+        self.assertEqual(EventDecoder([ReserveStockEvent]).decode(body, properties), event)
+        delivery = received(event.name, properties)
+        self.assertEqual(delivery.trace.trace_id, trace.trace_id)
+        self.assertGreaterEqual(delivery.enqueued_at, trace.started_at)
+
+    def test_checkout_call_packs_follow_ups(self):
+        order = OrderValue(items=[("b", 2)], user_id="u", total_cost=6, payment_status='pending',
+                           stock_status='pending')
+        _, stock_event = checkout_events("o", order)
+        keys, args = checkout_call("o", [], new_trace(), saga_follow_ups("o", order, stock_event))
+        self.assertEqual(args[6], 0)
+        follow_ups = {args[i]: args[i + 1:i + 5] for i in range(7, len(args), 5)}
+        self.assertEqual(set(follow_ups), {COMMIT_STOCK, RELEASE_STOCK, REFUND_PAYMENT})
+        routing_key, body, content_encoding, _ = follow_ups[REFUND_PAYMENT]
+        self.assertEqual(routing_key, route("payment", RefundPaymentEvent(amount=6, user_id="u", order_id="o")))
+        properties = entry_properties({b"body": body, b"content_encoding": content_encoding.encode()})
+        refund = EventDecoder([RefundPaymentEvent]).decode(body, properties)
+        self.assertEqual((refund.amount, refund.user_id), (6, "u"))
+
+
+class HitsDb:
+    # the hash commands of a Redis pipeline, over dicts
+    def __init__(self):
+        self.hashes: dict[str, dict[bytes, int]] = {}
+        self.commands = []
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def hincrby(self, key, field, amount):
+        self.commands.append(lambda: self.hashes.setdefault(key, {}).update(
+            {field.encode(): self.hashes.get(key, {}).get(field.encode(), 0) + amount}))
+
+    def expire(self, key, seconds):
+        self.commands.append(lambda: True)
+
+    def hgetall(self, key):
+        self.commands.append(lambda: dict(self.hashes.get(key, {})))
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command() for command in commands]
+
+
+class HotItems:
+    # the promote and demote of a StockStore
+    def __init__(self):
+        self.db = HitsDb()
+        self.hot: dict[str, int] = {}
+
+    def hot_items(self):
+        return set(self.hot)
+
+    def promote(self, item_id, shards):
+        self.hot[item_id] = shards
+        return True
+
+    def demote(self, item_id):
+        self.hot.pop(item_id, None)
+        return True
+
+
+class TestHotItemTracker(unittest.TestCase):
+
+    def test_promotes_and_demotes_on_the_last_complete_window(self):
+        store = HotItems()
+        tracker = HotItemTracker(store, shards=4, window=10, promote_at=3, demote_below=2)
+        other = HotItemTracker(store, shards=4, window=10, promote_at=3, demote_below=2)
+        tracker.observe([[("a", 1), ("b", 1)], [("a", 2)]], now=5)
+        # releases are not counted
+        other.observe([[("a", 1)], [("b", -1)]], now=6)
+        self.assertEqual(store.hot, {})
+        # both processes add their counts when they move on, the second one decides
+        tracker.observe([], now=12)
+        other.observe([], now=13)
+        self.assertEqual(store.db.hashes[HITS_KEY_PREFIX + "0"], {b"a": 3, b"b": 1})
+        self.assertEqual(store.hot, {"a": 4})
+        tracker.observe([[("a", 1)]], now=15)
+        tracker.observe([], now=25)
+        self.assertEqual(store.hot, {})
+
+
+class Message:
+    # the parts of an aio-pika incoming message the runtime uses
+    def __init__(self, event):
+        self.body, properties = encode_event(event)
+        self.content_type = properties["content_type"]
+        self.content_encoding = properties.get("content_encoding")
+        self.headers = {}
+        self.acked = False
+
+    async def ack(self, multiple=False):
+        self.acked = True
+
+
+class Exchange:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, message, routing_key):
+        await asyncio.sleep(0.001)
+        self.published.append((routing_key, message))
+
+
+class TestConsumerRuntime(unittest.TestCase):
+
+    def test_replies_are_sent_again_when_their_confirm_failed(self):
+        handled = []
+
+        class FailingExchange(Exchange):
+            # the broker does not confirm the first reply
+            async def publish(self, message, routing_key):
+                if routing_key.startswith("order") and not self.published:
+                    self.published.append(("nack", message))
+                    raise ConnectionError("publish not confirmed")
+                await super().publish(message, routing_key)
+
+        async def run():
+            runtime = ConsumerRuntime("stock", concurrency=1)
+            exchange = FailingExchange()
+            dispatcher = EventDispatcher(recent_events=TTLCache(maxsize=10, ttl=60))
+
+            @dispatcher.handler(ReserveStockEvent)
+            def reserve(event):
+                handled.append(event.order_id)
+                runtime.publisher.publish("order", ReserveStockSucessfull(order_id=event.order_id))
+
+            lanes = runtime.start_lanes(dispatcher, type("Channel", (), {"default_exchange": exchange})())
+            event = ReserveStockEvent(order_id="o", stock_items=[StockItem(item_id="a", quantity=1)])
+            first, redelivered, again = Message(event), Message(event), Message(event)
+            await runtime.on_message(first)
+            await runtime.drain()
+            await runtime.on_message(redelivered)
+            await runtime.drain()
+            await runtime.on_message(again)
+            await runtime.drain()
+            for lane in lanes:
+                lane.cancel()
+            return [first, redelivered, again], exchange.published, dispatcher
+
+        messages, published, dispatcher = asyncio.run(run())
+        self.assertTrue(all(message.acked for message in messages))
+        # the redelivery runs the handler again, only the one after the confirmed reply is skipped
+        self.assertEqual(handled, ["o", "o"])
+        reply = route("order", ReserveStockSucessfull(order_id="o"))
+        self.assertEqual([key for key, _ in published], ["nack", retry_queue(dispatcher.retry.queue, 0), reply])
+        self.assertEqual(dispatcher.skipped, 1)
+
+    def test_lanes_keep_key_order_and_retry_failures(self):
+        handled = []
+
+        async def run():
+            runtime = ConsumerRuntime("stock", concurrency=4, batch_size=2)
+            exchange = Exchange()
+            dispatcher = EventDispatcher()
+
+            @dispatcher.batch_handler(ReserveStockEvent)
+            def reserve(events):
+                for event in events:
+                    if event.order_id.startswith("bad"):
+                        raise ValueError("bad order")
+                for event in events:
+                    time.sleep(0.001)
+                    handled.append(event.order_id)
+                    runtime.publisher.publish("order", ReserveStockSucessfull(order_id=event.order_id))
+
+            dispatcher.handler(ReserveStockEvent)(lambda event: reserve([event]))
+            lanes = runtime.start_lanes(dispatcher, type("Channel", (), {"default_exchange": exchange})())
+            messages = [Message(ReserveStockEvent(order_id=f"{item}:{i}",
+                                                  stock_items=[StockItem(item_id=item, quantity=1)]))
+                        for i in range(5) for item in ("a", "b", "c")]
+            messages.append(Message(ReserveStockEvent(order_id="bad", stock_items=[StockItem(item_id="a", quantity=1)])))
+            for message in messages:
+                await runtime.on_message(message)
+            await runtime.drain()
+            for lane in lanes:
+                lane.cancel()
+            return messages, exchange.published, dispatcher.retry
+
+        messages, published, retry = asyncio.run(run())
+        for item in ("a", "b", "c"):
+            self.assertEqual([order_id for order_id in handled if order_id.startswith(item)],
+                             [f"{item}:{i}" for i in range(5)])
+        self.assertTrue(all(message.acked for message in messages))
+        # a reply per handled event, the failed one went to the first retry queue
+        self.assertEqual(len([key for key, _ in published if key.startswith("order")]), 15)
+        self.assertEqual([key for key, _ in published if not key.startswith("order")], [retry_queue(retry.queue, 0)])
+        self.assertEqual(retry.retried, 1)
+
+
+class TestTracing(unittest.TestCase):
+
+    def test_trace_to_json(self):
+        fields = {b"trace_id": b"t", b"started_at": b"10", b"finished_at": b"10.5", b"outcome": b"approved",
+                  b"hop:reply": msgspec.json.encode(Hop("reply", 10.3, 10.35, 10.4)),
+                  b"hop:request": msgspec.json.encode(Hop("request", 10.1, 10.2, 10.25))}
+        trace = trace_to_json("o", fields)
+        self.assertEqual((trace["trace_id"], trace["outcome"], trace["total_ms"]), ("t", "approved", 500.0))
+        self.assertEqual([hop["event"] for hop in trace["hops"]], ["request", "reply"])
+        self.assertAlmostEqual(trace["hops"][0]["published_ms"], 100.0, places=3)
+        self.assertAlmostEqual(trace["hops"][0]["queue_ms"], 100.0, places=3)
+        self.assertAlmostEqual(trace["hops"][0]["handler_ms"], 50.0, places=3)
+
+    def test_percentiles(self):
+        stats = percentiles([str(i / 1000).encode() for i in range(1, 101)])
+        self.assertEqual(stats["count"], 100)
+        self.assertEqual((stats["p50_ms"], stats["p99_ms"], stats["max_ms"]), (51.0, 100.0, 100.0))
+        self.assertEqual(percentiles([]), {"count": 0})
+
+
+class OrderDb:
+    # the HMGET of an asyncio Redis client over one order hash
+    def __init__(self, fields: dict):
+        self.fields = fields
+
+    async def hmget(self, key, fields):
+        return [self.fields.get(field) for field in fields]
+
+
+class TestCheckoutWaiters(unittest.TestCase):
+
+    def order_db(self, status: bytes, checked_out: bool = True) -> OrderDb:
+        order = OrderValue(items=[("a", 1)], user_id="u", total_cost=1, payment_status='pending',
+                           stock_status='pending')
+        fields = {DATA_FIELD: order_fields(order)[DATA_FIELD], "payment_status": status, "stock_status": status}
+        if checked_out:
+            fields["checkout"] = b"1"
+        return OrderDb(fields)
+
+    def test_result_wakes_waiter(self):
+        async def run():
+            waiters = CheckoutWaiters()
+            task = asyncio.create_task(waiters.wait(self.order_db(b"pending"), "o", timeout=5))
+            await asyncio.sleep(0)
+            self.assertEqual(len(waiters), 1)
+            waiters.resolve(CheckoutResult("o", "approved", "rejected"))
+            order = await task
+            self.assertEqual((order.payment_status, order.stock_status), ("approved", "rejected"))
+            self.assertEqual(len(waiters), 0)
+        asyncio.run(run())
+
+    def test_finished_and_timed_out_waits(self):
+        async def run():
+            waiters = CheckoutWaiters()
+            order = await waiters.wait(self.order_db(b"approved"), "o", timeout=5)
+            self.assertEqual(order.payment_status, "approved")
+            order = await waiters.wait(self.order_db(b"pending"), "o", timeout=0.01)
+            self.assertEqual(order.payment_status, "pending")
+            with self.assertRaises(NotCheckedOut):
+                await waiters.wait(self.order_db(b"pending", checked_out=False), "o", timeout=5)
+            self.assertEqual(len(waiters), 0)
+        asyncio.run(run())
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_exposition(self):
+        histogram = metrics.Metric("test_seconds", "test", metrics.HISTOGRAM, ("route",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.labels("/a").observe(value)
+        merged = {}
+        # two processes with the same series are summed
+        metrics._merge(merged, {"test_seconds": ["histogram", "test", ["route"], [0.1, 1.0], histogram.samples()]})
+        metrics._merge(merged, {"test_seconds": ["histogram", "test", ["route"], [0.1, 1.0], histogram.samples()]})
+        lines = metrics.render(merged).splitlines()
+        self.assertIn('test_seconds_bucket{route="/a",le="0.1"} 4', lines)
+        self.assertIn('test_seconds_bucket{route="/a",le="1.0"} 6', lines)
+        self.assertIn('test_seconds_bucket{route="/a",le="+Inf"} 8', lines)
+        self.assertIn('test_seconds_count{route="/a"} 8', lines)
+
+    def test_updates_from_threads_are_not_lost(self):
+        counter = metrics.Metric("test_total", "test", metrics.COUNTER)
+        histogram = metrics.Metric("test_thread_seconds", "test", metrics.HISTOGRAM, buckets=(1.0,))
+
+        def update():
+            for _ in range(10_000):
+                counter.inc()
+                histogram.observe(0.5)
+
+        threads = [threading.Thread(target=update) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.samples(), [[[], 80_000]])
+        self.assertEqual(histogram.samples(), [[[], [80_000, 0, 40_000]]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import unittest
+
+from common.lru import TTLCache
+from events.codec import COMPRESSED_ENCODING, CONTENT_TYPE, EventDecodeError, EventDecoder, encode_event
+from events.payment.reserve_payment_event import ReservePaymentEvent
+from events.registry import EVENT_TYPES, EventDispatcher
+from events.retry import (ERROR_HEADER, QUEUE_HEADER, RETRIES_HEADER, RetryPolicy, TerminalError,
+                          dead_letter_queue, retry_queue)
+from events.stock.reserve_stock_event import ReserveStockEvent, StockItem
+from events.stock.reserve_stock_successful_event import ReserveStockSucessfull
+from events.tracing import PUBLISHED_AT_HEADER, TRACE_HEADER, Trace, published, received, trace_headers
+
+
+class Properties:
+    def __init__(self, content_type=None, content_encoding=None, headers=None):
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.headers = headers
+
+
+def deliver(dispatcher: EventDispatcher, body: bytes, properties: Properties):
+    # what the consumer runtime does with one message
+    event = dispatcher.decode(body, properties)
+    dispatcher.received(event, properties)
+    try:
+        dispatcher.dispatch(event)
+    except Exception:
+        dispatcher.settled([event])
+        raise
+    dispatcher.settled([event], handled=True)
+
+
+class TestEventCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = EventDecoder(EVENT_TYPES.values())
+
+    def test_round_trip(self):
+        event = ReservePaymentEvent(amount=10, user_id="1", order_id="2")
+        body, properties = encode_event(event)
+        self.assertEqual(properties, {"content_type": CONTENT_TYPE})
+        self.assertEqual(self.decoder.decode(body, Properties(**properties)), event)
+
+    def test_large_bodies_are_compressed(self):
+        event = ReserveStockEvent(order_id="1",
+                                  stock_items=[StockItem(item_id=f"{i}", quantity=1) for i in range(500)])
+        body, properties = encode_event(event)
+        self.assertEqual(properties["content_encoding"], COMPRESSED_ENCODING)
+        self.assertEqual(self.decoder.decode(body, Properties(**properties)), event)
+
+    def test_legacy_text_body(self):
+        body = str({"amount": 10.0, "user_id": "1", "order_id": "2", "name": ReservePaymentEvent.name}).encode()
+        event = self.decoder.decode(body, Properties())
+        # legacy bodies carry no event id, it is derived from the body
+        self.assertEqual(event, ReservePaymentEvent(amount=10, user_id="1", order_id="2", event_id=event.event_id))
+        self.assertEqual(self.decoder.decode(body, Properties()).event_id, event.event_id)
+        other = str({"amount": 10.0, "user_id": "1", "order_id": "3", "name": ReservePaymentEvent.name}).encode()
+        self.assertNotEqual(self.decoder.decode(other, Properties()).event_id, event.event_id)
+
+    def test_unknown_event_name(self):
+        body, properties = encode_event(ReserveStockSucessfull(order_id="1"))
+        with self.assertRaises(EventDecodeError):
+            EventDecoder([ReservePaymentEvent]).decode(body, Properties(**properties))
+
+
+class TestEventDispatcher(unittest.TestCase):
+
+    def test_dispatches_to_handler(self):
+        dispatcher = EventDispatcher()
+        handled = []
+        dispatcher.handler(ReserveStockSucessfull)(handled.append)
+
+        event = ReserveStockSucessfull(order_id="1")
+        body, properties = encode_event(event)
+        deliver(dispatcher, body, Properties(**properties))
+        self.assertEqual(handled, [event])
+
+    def test_skips_recently_handled_events(self):
+        dispatcher = EventDispatcher(recent_events=TTLCache(maxsize=10, ttl=60))
+        handled = []
+        dispatcher.handler(ReserveStockSucessfull)(handled.append)
+
+        event = ReserveStockSucessfull(order_id="1")
+        body, properties = encode_event(event)
+        deliver(dispatcher, body, Properties(**properties))
+        deliver(dispatcher, body, Properties(**properties))
+        dispatcher.dispatch_batch([event, ReserveStockSucessfull(order_id="1")])
+        self.assertEqual(len(handled), 2)
+        self.assertEqual(dispatcher.skipped, 2)
+
+    def test_only_events_settled_as_handled_are_skipped(self):
+        dispatcher = EventDispatcher(recent_events=TTLCache(maxsize=10, ttl=60))
+        handled = []
+        dispatcher.handler(ReserveStockSucessfull)(handled.append)
+
+        event = ReserveStockSucessfull(order_id="1")
+        dispatcher.dispatch(event)
+        dispatcher.settled([event])
+        dispatcher.dispatch(event)
+        dispatcher.settled([event], handled=True)
+        dispatcher.dispatch(event)
+        self.assertEqual(handled, [event, event])
+        self.assertEqual(dispatcher.skipped, 1)
+
+    def test_times_handlers(self):
+        observed = []
+
+        class Metrics:
+            def observe(self, handler, count, seconds, failed):
+                observed.append((handler, count, failed))
+
+        dispatcher = EventDispatcher(metrics=Metrics())
+
+        @dispatcher.batch_handler(ReserveStockSucessfull)
+        def on_success_batch(events):
+            pass
+
+        @dispatcher.handler(ReservePaymentEvent)
+        def on_payment(event):
+            raise ConnectionError("redis down")
+
+        dispatcher.dispatch_batch([ReserveStockSucessfull(order_id="1"), ReserveStockSucessfull(order_id="2")])
+        with self.assertRaises(ConnectionError):
+            dispatcher.dispatch(ReservePaymentEvent(amount=1, user_id="1", order_id="1"))
+        self.assertEqual(observed, [("on_success_batch", 2, False), ("on_payment", 1, True)])
+
+    def test_continues_traces(self):
+        dispatcher = EventDispatcher()
+        replies = []
+
+        @dispatcher.handler(ReserveStockEvent)
+        def on_reserve(event):
+            replies.append(published(dispatcher.trace_headers(event)))
+
+        event = ReserveStockEvent(order_id="1", stock_items=[StockItem(item_id="a", quantity=1)])
+        body, properties = encode_event(event)
+        headers = {**trace_headers(Trace("t", 10.0)), PUBLISHED_AT_HEADER: 11.0}
+        deliver(dispatcher, body, Properties(headers=headers, **properties))
+        deliver(dispatcher, body, Properties(**properties))
+
+        traced, untraced = replies
+        self.assertIsNone(untraced)
+        self.assertIn(PUBLISHED_AT_HEADER, traced)
+        delivery = received("reply", Properties(headers=traced))
+        self.assertEqual(delivery.trace.trace_id, "t")
+        [hop] = delivery.trace.hops
+        self.assertEqual((hop.name, hop.enqueued_at), (event.name, 11.0))
+        self.assertLessEqual(hop.dequeued_at, hop.done_at)
+        self.assertIsNone(dispatcher.delivery(event))
+
+    def test_ignores_malformed_traces(self):
+        self.assertIsNone(received("event", Properties(headers={TRACE_HEADER: "{"})))
+        self.assertIsNone(received("event", Properties()))
+
+    def test_unhandled_events_fail_decoding(self):
+        dispatcher = EventDispatcher()
+        dispatcher.handler(ReserveStockSucessfull)(lambda event: None)
+
+        body, properties = encode_event(ReservePaymentEvent(amount=1, user_id="1", order_id="1"))
+        with self.assertRaises(EventDecodeError):
+            dispatcher.decode(body, Properties(**properties))
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def fail(self, error, headers=None, max_retries=3):
+        return RetryPolicy("stock.1", max_retries).route(Properties(headers=headers), error)
+
+    def test_retries_with_growing_attempts(self):
+        routing_key, headers = self.fail(ConnectionError("redis down"))
+        self.assertEqual(routing_key, retry_queue("stock.1", 0))
+        self.assertEqual(headers[RETRIES_HEADER], 1)
+        self.assertEqual(headers[QUEUE_HEADER], "stock.1")
+        routing_key, headers = self.fail(ConnectionError("redis down"), headers)
+        self.assertEqual((routing_key, headers[RETRIES_HEADER]), (retry_queue("stock.1", 1), 2))
+
+    def test_dead_letters_after_max_retries(self):
+        routing_key, headers = self.fail(ConnectionError("redis down"), {RETRIES_HEADER: 3})
+        self.assertEqual(routing_key, dead_letter_queue("stock.1"))
+        self.assertEqual(headers[ERROR_HEADER], "ConnectionError: redis down")
+
+    def test_terminal_errors_are_not_retried(self):
+        routing_key, _ = self.fail(TerminalError("User: 1 not found!"))
+        self.assertEqual(routing_key, dead_letter_queue("stock.1"))
+
+    def test_undecodable_messages_are_dead_lettered(self):
+        dispatcher = EventDispatcher()
+        dispatcher.handler(ReserveStockSucessfull)(lambda event: None)
+        with self.assertRaises(EventDecodeError) as failure:
+            dispatcher.decode(b"garbage", Properties(content_type=CONTENT_TYPE))
+        routing_key, _ = self.fail(failure.exception)
+        self.assertEqual(routing_key, dead_letter_queue("stock.1"))
+
+    def test_does_not_change_the_original_headers(self):
+        headers = {RETRIES_HEADER: 1}
+        self.fail(ConnectionError("redis down"), headers)
+        self.assertEqual(headers, {RETRIES_HEADER: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -75,6 +75,41 @@ class TestMicroservices(unittest.TestCase):
         credit_after_payment: int = tu.find_user(user_id)['credit']
         self.assertEqual(credit_after_payment, 5)
 
+    def test_batch_lookups(self):
+        item_ids = [tu.create_item(price)['item_id'] for price in (3, 4)]
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+
+        items = tu.find_items(item_ids + ['missing'])
+        self.assertEqual([item['price'] for item in items[:2]], [3, 4])
+        self.assertIsNone(items[2])
+
+        self.assertEqual(tu.find_users([user_id])[0]['credit'], 0)
+
+        add_items_response = tu.add_items_to_order(order_id, [(item_ids[0], 2), (item_ids[1], 1)])
+        self.assertTrue(tu.status_code_is_success(add_items_response))
+        [order, missing] = tu.find_orders([order_id, 'missing'])
+        self.assertEqual(order['total_cost'], 10)
+        self.assertIsNone(missing)
+
+        add_items_response = tu.add_items_to_order(order_id, [('missing', 1)])
+        self.assertTrue(tu.status_code_is_failure(add_items_response))
+
+    def test_add_item_sees_price_change(self):
+        item: dict = tu.create_item(5)
+        item_id: str = item['item_id']
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id, 1)))
+
+        # the price change invalidates the item in the order-service price cache
+        self.assertTrue(tu.status_code_is_success(tu.set_item_price(item_id, 7)))
+        time.sleep(1)
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id, 1)))
+
+        self.assertEqual(tu.find_order(order_id)['total_cost'], 12)
+
     def test_order_approved(self):
         user: dict = tu.create_user()
         self.assertIn('user_id', user)
@@ -104,9 +139,11 @@ class TestMicroservices(unittest.TestCase):
         self.assertTrue(tu.status_code_is_success(add_item_response))
 
         tu.checkout_order(order_id).status_code
-        time.sleep(1)
 
-        order = tu.find_order(order_id)
+        # returns as soon as the saga finished
+        result = tu.wait_for_checkout(order_id)
+        self.assertEqual(result.status_code, 200)
+        order = result.json()
         assert order['payment_status'] == 'approved'
         assert order['stock_status'] == 'approved'
         
@@ -143,13 +180,50 @@ class TestMicroservices(unittest.TestCase):
         self.assertTrue(tu.status_code_is_success(add_item_response))
 
         tu.checkout_order(order_id).status_code
-        stock_after_checkout: int = tu.find_item(item_id)['stock']
-        self.assertEqual(stock_after_checkout, 0)
-        time.sleep(1)
-        
-        order = tu.find_order(order_id)
+
+        result = tu.wait_for_checkout(order_id)
+        self.assertEqual(result.status_code, 200)
+        order = result.json()
         assert order['payment_status'] == 'rejected'
         assert order['stock_status'] == 'approved'
+        # the reserved stock is released again, the credit was never taken
+        self.assertEqual(tu.wait_until(lambda: tu.find_item(item_id)['stock'], 1), 1)
+        self.assertEqual(tu.find_user(user_id)['credit'], 1)
+
+    def test_checkout_stock_declined_refunds_payment(self):
+        user_id: str = tu.create_user()['user_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 15)))
+
+        # no stock
+        item_id: str = tu.create_item(5)['item_id']
+
+        order_id: str = tu.create_order(user_id)['order_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id, 1)))
+
+        tu.checkout_order(order_id)
+
+        result = tu.wait_for_checkout(order_id)
+        self.assertEqual(result.status_code, 200)
+        order = result.json()
+        self.assertEqual(order['stock_status'], 'rejected')
+        self.assertEqual(order['payment_status'], 'approved')
+        self.assertEqual(tu.wait_until(lambda: tu.find_user(user_id)['credit'], 15), 15)
+
+    def test_checkout_twice_is_refused(self):
+        user_id: str = tu.create_user()['user_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 15)))
+        item_id: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 2)))
+        order_id: str = tu.create_order(user_id)['order_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id, 1)))
+
+        self.assertTrue(tu.status_code_is_success(tu.checkout_order(order_id).status_code))
+        self.assertTrue(tu.status_code_is_failure(tu.checkout_order(order_id).status_code))
+        self.assertEqual(tu.wait_for_checkout(order_id).status_code, 200)
+
+        # charged and reserved once
+        self.assertEqual(tu.find_user(user_id)['credit'], 10)
+        self.assertEqual(tu.find_item(item_id)['stock'], 1)
             
 
 
@@ -0,0 +1,369 @@
+import os
+import time
+import unittest
+
+import redis
+from msgspec import msgpack
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+from common.migrate_orders import migrate
+from common.orders import ORDER_FIELDS, OrderValue, checkout_events, order_fields, order_from_fields, saga_follow_ups
+from common.outbox import (ALREADY_CHECKED_OUT, CHECKED_OUT, ORDER_NOT_FOUND, OUTBOX_STREAM, Outbox,
+                           entry_properties)
+from common.payment_store import NOT_ENOUGH_CREDIT, NOT_FOUND as USER_NOT_FOUND, PaymentStore
+from common.stock_store import (HOLD_FINALIZED, HOLD_NOT_FOUND, HOLD_RETAKEN, HOLDS_KEY, HOT_ITEMS_KEY,
+                                NOT_ENOUGH_STOCK, NOT_FOUND as ITEM_NOT_FOUND, STOCK_HOLD_TTL, ReservationFailure,
+                                StockStore, shard_key)
+from common.saga import (COMPLETE, DUPLICATE, EXPIRED, LATE, SAGA_DEADLINES_KEY, SAGA_TIMEOUT, UNKNOWN, WAITING,
+                         SagaReply, SagaStore, saga_key)
+from common.stock_handlers import StockHandlers
+from common.tracing import new_trace
+from events.codec import EventDecoder
+from events.payment.refund_payment_event import RefundPaymentEvent
+from events.payment.reserve_payment_event import ReservePaymentEvent
+from events.registry import EVENT_TYPES
+from events.stock.commit_stock_event import CommitStockEvent
+from events.stock.release_stock_event import ReleaseStockEvent
+from events.stock.reserve_stock_event import ReserveStockEvent, StockItem
+
+# Behaviour tests of the Redis scripts against a real redis-server, skipped when none answers at
+# REDIS_TEST_HOST:REDIS_TEST_PORT. The database REDIS_TEST_DB is flushed before every test:
+#   redis-server --port 6390 --save '' &
+#   REDIS_TEST_PORT=6390 python -m pytest test/test_redis.py
+REDIS_TEST_HOST = os.environ.get('REDIS_TEST_HOST', 'localhost')
+REDIS_TEST_PORT = int(os.environ.get('REDIS_TEST_PORT', 6379))
+REDIS_TEST_DB = int(os.environ.get('REDIS_TEST_DB', 15))
+
+
+class RedisTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # no retries, so a missing server is noticed at once
+        cls.db = redis.Redis(host=REDIS_TEST_HOST, port=REDIS_TEST_PORT, db=REDIS_TEST_DB, socket_timeout=1,
+                             retry=Retry(NoBackoff(), 0))
+        try:
+            cls.db.ping()
+        except redis.exceptions.RedisError:
+            raise unittest.SkipTest(f"no redis-server at {REDIS_TEST_HOST}:{REDIS_TEST_PORT}")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+
+    def setUp(self):
+        self.db.flushdb()
+
+
+class StockTestCase(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.store = StockStore(self.db)
+
+    def add_item(self, item_id: str, stock: int, price: int = 1):
+        self.db.set(item_id, msgpack.encode({"stock": stock, "price": price}))
+
+    def item(self, item_id: str) -> dict:
+        return msgpack.decode(self.db.get(item_id))
+
+
+class TestStockStore(StockTestCase):
+
+    def test_reservations_are_all_or_nothing(self):
+        self.add_item("a", 5)
+        self.add_item("b", 1)
+        failures, stocks = self.store.reserve([[("a", 2), ("b", 2)], [("a", 2), ("b", 1)], [("a", 1), ("c", 1)]])
+        self.assertEqual(failures, [ReservationFailure("b", NOT_ENOUGH_STOCK), None,
+                                    ReservationFailure("c", ITEM_NOT_FOUND)])
+        self.assertEqual(stocks, {"a": 3, "b": 0})
+        self.assertEqual((self.item("a")["stock"], self.item("b")["stock"]), (3, 0))
+
+    def test_later_reservations_see_earlier_ones_of_the_batch(self):
+        self.add_item("a", 3)
+        failures, stocks = self.store.reserve([[("a", 2)], [("a", 2)], [("a", 1)]])
+        self.assertEqual(failures, [None, ReservationFailure("a", NOT_ENOUGH_STOCK), None])
+        self.assertEqual(stocks, {"a": 0})
+
+    def test_release_gives_stock_back(self):
+        self.add_item("a", 3)
+        self.store.reserve([[("a", 3)]])
+        self.assertEqual(self.store.release([[("a", 2)], [("gone", 1)]]),
+                         [None, ReservationFailure("gone", ITEM_NOT_FOUND)])
+        self.assertEqual(self.item("a")["stock"], 2)
+
+    def test_replayed_reservations_keep_their_outcome(self):
+        self.add_item("a", 2)
+        failures, _ = self.store.reserve([[("a", 2)], [("a", 1)]], ["e1", "e2"])
+        self.assertEqual(failures, [None, ReservationFailure("a", NOT_ENOUGH_STOCK)])
+        self.add_item("a", 5)
+        # e1 is not taken again and e2 still fails, though there is stock now
+        failures, stocks = self.store.reserve([[("a", 2)], [("a", 1)], [("a", 1)]], ["e1", "e2", "e3"])
+        self.assertEqual(failures, [None, ReservationFailure("a", NOT_ENOUGH_STOCK), None])
+        self.assertEqual(stocks, {"a": 4})
+        self.assertEqual(self.store.duplicates, 2)
+
+    def test_replayed_releases_give_stock_back_once(self):
+        self.add_item("a", 0)
+        self.store.release([[("a", 3)], [("a", 3)]], ["r1", "r1"])
+        self.assertEqual(self.item("a")["stock"], 3)
+        self.assertEqual(self.store.duplicates, 1)
+
+    def test_set_price_keeps_the_stock(self):
+        self.add_item("a", 3, price=5)
+        self.assertTrue(self.store.set_price("a", 7))
+        self.assertFalse(self.store.set_price("gone", 7))
+        self.assertEqual(self.item("a"), {"stock": 3, "price": 7})
+
+    def test_promote_splits_the_stock_over_shards(self):
+        self.add_item("a", 10)
+        self.assertTrue(self.store.promote("a", 3))
+        self.assertTrue(self.store.promote("a", 5))
+        self.assertFalse(self.store.promote("gone", 3))
+        self.assertEqual(self.item("a"), {"stock": 0, "price": 1, "shards": 3})
+        self.assertEqual([int(self.db.get(shard_key("a", k))) for k in range(3)], [4, 3, 3])
+        self.assertEqual(self.store.hot_items(), {"a"})
+
+    def test_hot_reservations_draw_across_shards(self):
+        self.add_item("a", 10)
+        self.store.promote("a", 3)
+        # each reservation is larger than any single shard
+        failures, stocks = self.store.reserve([[("a", 5)], [("a", 4)], [("a", 2)]])
+        self.assertEqual(failures, [None, None, ReservationFailure("a", NOT_ENOUGH_STOCK)])
+        self.assertEqual(stocks, {})
+        self.assertEqual(self.store.shard_stock("a", 3), 1)
+        self.assertEqual(self.store.reserve([[("a", 1)]])[0], [None])
+        self.assertEqual(self.store.shard_stock("a", 3), 0)
+        self.assertTrue(all(int(self.db.get(shard_key("a", k))) >= 0 for k in range(3)))
+
+    def test_hot_items_use_their_own_stock_when_the_shards_run_dry(self):
+        self.add_item("a", 3)
+        self.store.promote("a", 3)
+        # stock added after promotion stays on the item itself
+        self.db.set("a", msgpack.encode({**self.item("a"), "stock": 2}))
+        failures, _ = self.store.reserve([[("a", 4)], [("a", 2)]])
+        self.assertEqual(failures, [None, ReservationFailure("a", NOT_ENOUGH_STOCK)])
+        self.assertEqual(self.store.shard_stock("a", 3), 0)
+        self.assertEqual(self.item("a")["stock"], 1)
+
+    def test_shard_stocks_of_several_items(self):
+        self.add_item("a", 10)
+        self.add_item("b", 5)
+        self.store.promote("a", 3)
+        self.store.promote("b", 2)
+        self.store.reserve([[("a", 4), ("b", 1)]])
+        self.assertEqual(self.store.shard_stocks([("a", 3), ("b", 2), ("c", 2)]), {"a": 6, "b": 4, "c": 0})
+        self.assertEqual(self.store.shard_stocks([]), {})
+
+    def test_demote_merges_the_shards_back(self):
+        self.add_item("a", 10)
+        self.store.promote("a", 4)
+        self.store.reserve([[("a", 3)], [("a", 3)]])
+        self.store.release([[("a", 1)]])
+        self.assertTrue(self.store.demote("a"))
+        self.assertTrue(self.store.demote("a"))
+        self.assertEqual(self.item("a"), {"stock": 5, "price": 1})
+        self.assertEqual(self.db.keys("a:shard:*"), [])
+        self.assertFalse(self.db.sismember(HOT_ITEMS_KEY, "a"))
+
+    def test_stores_follow_items_promoted_and_demoted_by_others(self):
+        self.add_item("a", 10)
+        other = StockStore(self.db)
+        other.promote("a", 2)
+        self.assertEqual(self.store.reserve([[("a", 3)]]), ([None], {}))
+        self.assertEqual(self.store.shards("a"), 2)
+        self.assertEqual(self.store.shard_stock("a", 2), 7)
+        other.demote("a")
+        self.assertEqual(self.store.reserve([[("a", 3)]]), ([None], {"a": 4}))
+        self.assertEqual(self.store.shards("a"), 0)
+
+    def test_hot_reservations_are_spread_over_the_lanes(self):
+        self.add_item("a", 1000)
+        self.add_item("b", 1000)
+        handlers = StockHandlers(self.db, None)
+        handlers.store.promote("a", 4)
+        handlers.store.reserve([[("a", 1)]])
+        lanes = {hash(handlers.lane_key(ReserveStockEvent(order_id=str(i), stock_items=[StockItem(item_id="a", quantity=1)]))) % 4
+                 for i in range(100)}
+        self.assertEqual(lanes, {0, 1, 2, 3})
+        cold = {handlers.lane_key(ReserveStockEvent(order_id=str(i), stock_items=[StockItem(item_id="b", quantity=1)]))
+                for i in range(100)}
+        self.assertEqual(cold, {"b"})
+
+
+class TestStockHolds(StockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_item("a", 5)
+        self.add_item("b", 5)
+        self.store.reserve([[("a", 2), ("b", 1)], [("a", 1)]], ["e1", "e2"], ["e1", "e2"])
+
+    def stocks(self) -> tuple[int, int]:
+        return self.item("a")["stock"], self.item("b")["stock"]
+
+    def test_releasing_a_hold_twice_gives_the_stock_back_once(self):
+        self.assertEqual(self.store.release_holds(["e1", "e1"]), [HOLD_FINALIZED, HOLD_NOT_FOUND])
+        self.assertEqual(self.store.release_holds(["e1"]), [HOLD_NOT_FOUND])
+        self.assertEqual(self.stocks(), (4, 5))
+
+    def test_committing_keeps_the_stock_taken(self):
+        self.assertEqual(self.store.commit_holds(["e1", "e1", "unknown"]),
+                         [HOLD_FINALIZED, HOLD_NOT_FOUND, HOLD_NOT_FOUND])
+        self.assertEqual(self.store.release_holds(["e1"]), [HOLD_NOT_FOUND])
+        self.assertEqual(self.stocks(), (2, 4))
+        self.assertEqual(self.db.zrange(HOLDS_KEY, 0, -1), [b"e2"])
+
+    def test_a_late_commit_takes_released_stock_again(self):
+        self.store.release_holds(["e1"])
+        self.assertEqual(self.store.commit_holds(["e1"]), [HOLD_RETAKEN])
+        self.assertEqual(self.store.commit_holds(["e1"]), [HOLD_NOT_FOUND])
+        self.assertEqual(self.stocks(), (2, 4))
+
+    def test_expired_holds_are_released_in_batches(self):
+        later = time.time() + STOCK_HOLD_TTL + 1
+        self.assertEqual(self.store.expire_holds(time.time()), [])
+        self.assertEqual(self.store.expire_holds(later, batch_size=1), ["e1"])
+        self.assertEqual(self.store.expire_holds(later), ["e2"])
+        self.assertEqual(self.stocks(), (5, 5))
+        self.assertEqual(self.store.commit_holds(["e2"]), [HOLD_RETAKEN])
+        self.assertEqual(self.stocks(), (4, 5))
+
+
+class TestPaymentStore(RedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.store = PaymentStore(self.db)
+
+    def add_user(self, user_id: str, credit: int):
+        self.db.set(user_id, msgpack.encode({"credit": credit}))
+
+    def credit(self, user_id: str) -> int:
+        return msgpack.decode(self.db.get(user_id))["credit"]
+
+    def test_credit_never_goes_negative(self):
+        self.add_user("u", 10)
+        failures, credits = self.store.reserve([("u", 6), ("u", 6), ("u", 4), ("u", 1), ("gone", 1)])
+        self.assertEqual(failures, [None, NOT_ENOUGH_CREDIT, None, NOT_ENOUGH_CREDIT, USER_NOT_FOUND])
+        self.assertEqual(credits, {"u": 0})
+        self.assertEqual(self.credit("u"), 0)
+
+    def test_replayed_reservations_keep_their_outcome(self):
+        self.add_user("u", 5)
+        failures, _ = self.store.reserve([("u", 5), ("u", 1)], ["e1", "e2"])
+        self.assertEqual(failures, [None, NOT_ENOUGH_CREDIT])
+        self.add_user("u", 5)
+        failures, credits = self.store.reserve([("u", 5), ("u", 1)], ["e1", "e2"])
+        self.assertEqual(failures, [None, NOT_ENOUGH_CREDIT])
+        self.assertEqual(credits, {"u": 5})
+        self.assertEqual(self.store.duplicates, 2)
+
+    def test_refund_gives_credit_back(self):
+        self.add_user("u", 5)
+        self.store.reserve([("u", 5)])
+        self.assertEqual(self.store.refund([("u", 3), ("gone", 1)]), [None, USER_NOT_FOUND])
+        self.assertEqual(self.credit("u"), 3)
+
+
+class OrderTestCase(RedisTestCase):
+    order = OrderValue(items=[("a", 2), ("b", 1)], user_id="u", total_cost=7, payment_status='pending',
+                       stock_status='pending')
+
+    def add_order(self, order_id: str):
+        self.db.hset(order_id, mapping=order_fields(self.order))
+
+    def get_order(self, order_id: str) -> OrderValue | None:
+        return order_from_fields(self.db.hmget(order_id, ORDER_FIELDS))
+
+    def checkout(self, order_id: str) -> int:
+        payment_event, self.stock_event = checkout_events(order_id, self.order)
+        return Outbox(self.db).checkout(order_id, [("payment", payment_event), ("stock", self.stock_event)],
+                                        new_trace(), saga_follow_ups(order_id, self.order, self.stock_event))
+
+    def outbox_events(self) -> list:
+        decoder = EventDecoder(EVENT_TYPES.values())
+        return [decoder.decode(fields[b"body"], entry_properties(fields))
+                for _, fields in self.db.xrange(OUTBOX_STREAM)]
+
+
+class TestCheckout(OrderTestCase):
+
+    def test_checks_out_once(self):
+        self.add_order("o")
+        self.assertEqual(self.checkout("o"), CHECKED_OUT)
+        self.assertEqual(self.checkout("o"), ALREADY_CHECKED_OUT)
+        self.assertEqual([type(event) for event in self.outbox_events()], [ReservePaymentEvent, ReserveStockEvent])
+        self.assertIsNotNone(self.db.zscore(SAGA_DEADLINES_KEY, "o"))
+        self.assertEqual(self.db.hget(saga_key("o"), "state"), b"running")
+
+    def test_missing_orders_are_not_checked_out(self):
+        self.assertEqual(self.checkout("o"), ORDER_NOT_FOUND)
+        self.assertEqual(self.db.exists(saga_key("o"), OUTBOX_STREAM), 0)
+
+
+class TestSagaStore(OrderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sagas = SagaStore(self.db, OUTBOX_STREAM)
+        self.add_order("o")
+        self.checkout("o")
+        self.db.delete(OUTBOX_STREAM)
+
+    def test_duplicate_replies_are_recorded_once(self):
+        outcomes = self.sagas.record([SagaReply("o", "stock", True), SagaReply("o", "stock", False),
+                                      SagaReply("x", "stock", True)])
+        self.assertEqual(outcomes, [(WAITING, None), (DUPLICATE, None), (UNKNOWN, None)])
+        (outcome, result), = self.sagas.record([SagaReply("o", "payment", True)])
+        self.assertEqual(outcome, COMPLETE)
+        self.assertTrue(result.approved)
+        self.assertEqual(self.sagas.record([SagaReply("o", "payment", True)]), [(DUPLICATE, None)])
+        commit, = self.outbox_events()
+        self.assertIsInstance(commit, CommitStockEvent)
+        self.assertEqual(commit.hold_id, self.stock_event.event_id)
+        self.assertEqual((self.get_order("o").stock_status, self.get_order("o").payment_status),
+                         ("approved", "approved"))
+        self.assertIsNone(self.db.zscore(SAGA_DEADLINES_KEY, "o"))
+
+    def test_sweep_times_out_sagas_and_compensates(self):
+        self.sagas.record([SagaReply("o", "stock", True)])
+        later = time.time() + SAGA_TIMEOUT + 1
+        self.assertEqual(self.sagas.expire_due(time.time()), [])
+        result, = self.sagas.expire_due(later)
+        self.assertEqual((result.stock, result.payment), (True, None))
+        self.assertEqual(self.sagas.expire_due(later), [])
+        # the payment that arrives afterwards is refunded
+        self.assertEqual(self.sagas.record([SagaReply("o", "payment", True)], later), [(LATE, None)])
+        release, refund = self.outbox_events()
+        self.assertIsInstance(release, ReleaseStockEvent)
+        self.assertEqual(release.hold_id, self.stock_event.event_id)
+        self.assertIsInstance(refund, RefundPaymentEvent)
+        self.assertEqual((refund.user_id, refund.amount), ("u", 7))
+        self.assertEqual(self.get_order("o").payment_status, "rejected")
+
+    def test_replies_past_the_deadline_expire_the_saga(self):
+        self.sagas.record([SagaReply("o", "stock", True)])
+        (outcome, result), = self.sagas.record([SagaReply("o", "payment", True)], time.time() + SAGA_TIMEOUT + 1)
+        self.assertEqual(outcome, EXPIRED)
+        self.assertFalse(result.approved)
+        self.assertEqual([type(event) for event in self.outbox_events()], [ReleaseStockEvent, RefundPaymentEvent])
+        self.assertEqual(self.sagas.expire_due(time.time() + SAGA_TIMEOUT + 1), [])
+
+
+class TestMigrateOrders(OrderTestCase):
+
+    def test_converts_orders_once(self):
+        self.db.set("o", msgpack.encode(self.order))
+        self.db.set("not an order", b"x")
+        self.add_order("converted")
+        self.assertEqual(migrate(self.db, batch_size=2), 1)
+        self.assertEqual(self.get_order("o"), self.order)
+        self.assertEqual(self.db.get("not an order"), b"x")
+        self.assertEqual(migrate(self.db), 0)
+        self.assertEqual(self.get_order("o"), self.order)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import requests
 import os
+import time
 
 ORDER_URL = STOCK_URL = PAYMENT_URL = "http://127.0.0.1:8000"
 
@@ -15,6 +16,10 @@ def find_item(item_id: str) -> dict:
     return requests.get(f"{STOCK_URL}/stock/find/{item_id}").json()
 
 
+def find_items(item_ids: list[str]) -> list[dict | None]:
+    return requests.post(f"{STOCK_URL}/stock/find_batch", json=item_ids).json()
+
+
 def add_stock(item_id: str, amount: int) -> int:
     return requests.post(f"{STOCK_URL}/stock/add/{item_id}/{amount}").status_code
 
@@ -23,6 +28,10 @@ def subtract_stock(item_id: str, amount: int) -> int:
     return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}").status_code
 
 
+def set_item_price(item_id: str, price: int) -> int:
+    return requests.post(f"{STOCK_URL}/stock/item/price/{item_id}/{price}").status_code
+
+
 ########################################################################################################################
 #   PAYMENT MICROSERVICE FUNCTIONS
 ########################################################################################################################
@@ -38,6 +47,10 @@ def find_user(user_id: str) -> dict:
     return requests.get(f"{PAYMENT_URL}/payment/find_user/{user_id}").json()
 
 
+def find_users(user_ids: list[str]) -> list[dict | None]:
+    return requests.post(f"{PAYMENT_URL}/payment/find_batch", json=user_ids).json()
+
+
 def add_credit_to_user(user_id: str, amount: float) -> int:
     return requests.post(f"{PAYMENT_URL}/payment/add_funds/{user_id}/{amount}").status_code
 
@@ -53,14 +66,36 @@ def add_item_to_order(order_id: str, item_id: str, quantity: int) -> int:
     return requests.post(f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}/{quantity}").status_code
 
 
+def add_items_to_order(order_id: str, items: list[tuple[str, int]]) -> int:
+    return requests.post(f"{ORDER_URL}/orders/addItems/{order_id}", json=items).status_code
+
+
 def find_order(order_id: str) -> dict:
     return requests.get(f"{ORDER_URL}/orders/find/{order_id}").json()
 
 
+def find_orders(order_ids: list[str]) -> list[dict | None]:
+    return requests.post(f"{ORDER_URL}/orders/find_batch", json=order_ids).json()
+
+
 def checkout_order(order_id: str) -> requests.Response:
     return requests.post(f"{ORDER_URL}//orders/checkout/{order_id}")
 
 
+def wait_for_checkout(order_id: str, timeout: float = 10) -> requests.Response:
+    return requests.get(f"{ORDER_URL}/orders/checkout/{order_id}/result", params={"timeout": timeout})
+
+
+def wait_until(read, expected, timeout: float = 10):
+    # compensations may still run after the checkout result, so read until expected or timeout
+    deadline = time.monotonic() + timeout
+    value = read()
+    while value != expected and time.monotonic() < deadline:
+        time.sleep(0.1)
+        value = read()
+    return value
+
+
 ########################################################################################################################
 #   STATUS CHECKS
 ########################################################################################################################